@@ -1,8 +1,12 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, Form
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, Form, Query, Request, Response
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from fastapi.staticfiles import StaticFiles
+from email.utils import formatdate, parsedate_to_datetime
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from supabase import create_client, Client
+from supabase import AsyncClient, AsyncClientOptions
+import httpx
 import os
 import logging
 from pathlib import Path
@@ -15,6 +19,32 @@ import jwt
 import shutil
 import tempfile
 import random
+import hashlib
+import json
+import base64
+import threading
+import asyncio
+import time
+import sqlite3
+import signal
+import multiprocessing
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager, contextmanager
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers
+import re
+import contextvars
+import mmap
+import io
+import codecs
+import zipfile
+import posixpath
+import xml.etree.ElementTree as ElementTree
+import orjson
+from html.parser import HTMLParser
+from urllib.parse import unquote
 
 # Remove ROOT_DIR/UPLOAD_DIR usage if no longer needed for static serving, 
 # but ROOT_DIR is used for .env
@@ -29,15 +59,49 @@ SUPABASE_KEY = os.environ.get('SUPABASE_KEY')
 if not SUPABASE_URL or not SUPABASE_KEY:
     raise ValueError("SUPABASE_URL and SUPABASE_KEY must be set in .env")
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+# One pooled HTTP/2 keep-alive connection pool shared by PostgREST and Storage
+SUPABASE_MAX_CONNECTIONS = int(os.environ.get('SUPABASE_MAX_CONNECTIONS', '50'))
+SUPABASE_TIMEOUT_SECONDS = float(os.environ.get('SUPABASE_TIMEOUT_SECONDS', '30'))
+
+supabase_http = httpx.AsyncClient(
+    http2=True,
+    follow_redirects=True,
+    timeout=SUPABASE_TIMEOUT_SECONDS,
+    limits=httpx.Limits(
+        max_connections=SUPABASE_MAX_CONNECTIONS,
+        max_keepalive_connections=SUPABASE_MAX_CONNECTIONS,
+        keepalive_expiry=60,
+    ),
+)
+supabase: AsyncClient = AsyncClient(SUPABASE_URL, SUPABASE_KEY, options=AsyncClientOptions(httpx_client=supabase_http))
 
-# Security
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Security. Hashes made with other bcrypt rounds are upgraded on next login.
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', '12'))
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+# Password hashing runs in this many threads; beyond PASSWORD_HASH_QUEUE_LIMIT
+# waiting or running calls, logins are rejected with 503
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', str(min(4, os.cpu_count() or 1))))
+PASSWORD_HASH_QUEUE_LIMIT = int(os.environ.get('PASSWORD_HASH_QUEUE_LIMIT', '64'))
 security = HTTPBearer()
 JWT_SECRET = os.environ.get('JWT_SECRET', 'your-secret-key-change-in-production')
 JWT_ALGORITHM = "HS256"
 JWT_EXPIRATION_DAYS = 7
 
+# Authenticated user cache. PRINCIPAL_CACHE_PATH points at an optional SQLite
+# file shared by all workers on the host. With AUTH_TRUST_TOKEN_CLAIMS the user
+# embedded in the (signed) token is used as-is and no lookup happens at all.
+PRINCIPAL_CACHE_TTL_SECONDS = float(os.environ.get('PRINCIPAL_CACHE_TTL_SECONDS', '60'))
+PRINCIPAL_CACHE_PATH = os.environ.get('PRINCIPAL_CACHE_PATH')
+AUTH_TRUST_TOKEN_CLAIMS = os.environ.get('AUTH_TRUST_TOKEN_CLAIMS', 'false').lower() in ('1', 'true', 'yes')
+
+# Reading progress write-behind. Off by default on Vercel, where the process
+# can be frozen between requests before a flush happens.
+PROGRESS_WRITE_BEHIND = os.environ.get('PROGRESS_WRITE_BEHIND', 'false' if os.environ.get('VERCEL') else 'true').lower() in ('1', 'true', 'yes')
+PROGRESS_FLUSH_INTERVAL_SECONDS = float(os.environ.get('PROGRESS_FLUSH_INTERVAL_SECONDS', '2'))
+PROGRESS_FLUSH_MAX_PENDING = int(os.environ.get('PROGRESS_FLUSH_MAX_PENDING', '500'))
+# A buffered update that still fails after this many flushes is dropped
+PROGRESS_FLUSH_MAX_ATTEMPTS = int(os.environ.get('PROGRESS_FLUSH_MAX_ATTEMPTS', '10'))
+
 # File upload
 JWT_ALGORITHM = "HS256"
 JWT_EXPIRATION_DAYS = 7
@@ -45,6 +109,77 @@ JWT_EXPIRATION_DAYS = 7
 # Supabase Storage Bucket - User must create this manually if it doesn't exist
 STORAGE_BUCKET = "uploads"
 
+# Where book files live: "supabase" (the bucket above) or "local" (a directory
+# on this host, served under LOCAL_STORAGE_PUBLIC_URL)
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'supabase').lower()
+LOCAL_STORAGE_DIR = Path(os.environ.get('LOCAL_STORAGE_DIR', ROOT_DIR / 'uploads'))
+LOCAL_STORAGE_PUBLIC_URL = os.environ.get('LOCAL_STORAGE_PUBLIC_URL', 'http://localhost:8000/uploads').rstrip('/')
+
+# Uploads are spooled to disk in chunks; files above the resumable threshold
+# are sent to Storage with the TUS protocol in 6 MB parts (Supabase's size)
+MAX_UPLOAD_MB = int(os.environ.get('MAX_UPLOAD_MB', '200'))
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+RESUMABLE_UPLOAD_THRESHOLD_MB = int(os.environ.get('RESUMABLE_UPLOAD_THRESHOLD_MB', '6'))
+RESUMABLE_CHUNK_BYTES = 6 * 1024 * 1024
+RESUMABLE_MAX_RETRIES = 3
+
+# Extraction cache (extracted pages are stored per book id + file hash).
+# On Vercel only the temp directory is writable
+EXTRACTION_CACHE_DIR = Path(os.environ.get(
+    'EXTRACTION_CACHE_DIR',
+    Path(tempfile.gettempdir()) / 'extraction-cache' if os.environ.get('VERCEL') else ROOT_DIR / 'cache' / 'extraction',
+))
+EXTRACTION_CACHE_MEMORY_MB = int(os.environ.get('EXTRACTION_CACHE_MEMORY_MB', '64'))
+EXTRACTION_CACHE_DISK_MB = int(os.environ.get('EXTRACTION_CACHE_DISK_MB', '1024'))
+
+# Full-text search index (SQLite FTS5). Off by default on Vercel, where the
+# deployment is read-only; /api/search then matches metadata in Supabase
+SEARCH_ENABLED = os.environ.get('SEARCH_ENABLED', 'false' if os.environ.get('VERCEL') else 'true').lower() in ('1', 'true', 'yes')
+SEARCH_INDEX_PATH = Path(os.environ.get('SEARCH_INDEX_PATH', ROOT_DIR / 'cache' / 'search.db'))
+
+# Background ingestion after upload (page count, outline, cover, cache warm-up).
+# Off by default on Vercel, where work after the response is not guaranteed.
+INGESTION_ENABLED = os.environ.get('INGESTION_ENABLED', 'false' if os.environ.get('VERCEL') else 'true').lower() in ('1', 'true', 'yes')
+INGESTION_WORKERS = int(os.environ.get('INGESTION_WORKERS', '2'))
+COVER_THUMBNAIL_WIDTH = 320
+
+# Extraction engine: EXTRACTION_WORKERS processes, or threads where subprocesses
+# are unavailable (the default on Vercel, and with EXTRACTION_WORKERS=0 as before)
+EXTRACTION_WORKERS = int(os.environ.get('EXTRACTION_WORKERS', str(os.cpu_count() or 2)))
+EXTRACTION_PROCESSES = os.environ.get(
+    'EXTRACTION_PROCESSES', 'false' if os.environ.get('VERCEL') or EXTRACTION_WORKERS <= 0 else 'true',
+).lower() in ('1', 'true', 'yes')
+EXTRACTION_QUEUE_LIMIT = int(os.environ.get('EXTRACTION_QUEUE_LIMIT', '16'))
+EXTRACTION_TIMEOUT_SECONDS = float(os.environ.get('EXTRACTION_TIMEOUT_SECONDS', '60'))
+EXTRACTION_CHUNK_PAGES = int(os.environ.get('EXTRACTION_CHUNK_PAGES', '16'))
+
+# Plain-text books are split into pages of about this many characters
+TXT_PAGE_CHARS = int(os.environ.get('TXT_PAGE_CHARS', '3000'))
+
+# Upper bound on items in one bookmark/annotation batch request
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', '500'))
+
+# Requests slower than SLOW_REQUEST_SECONDS are logged with their Supabase and
+# storage time (0 disables); SLOW_REQUEST_SAMPLE_RATE logs only a fraction of them
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+SLOW_REQUEST_SECONDS = float(os.environ.get('SLOW_REQUEST_SECONDS', '0'))
+SLOW_REQUEST_SAMPLE_RATE = float(os.environ.get('SLOW_REQUEST_SAMPLE_RATE', '1'))
+
+# GET responses for books, bookmarks, annotations and preferences are cached
+# for this long per process (0 disables); writes through this process drop
+# them at once, other workers serve them for at most the TTL
+RESPONSE_CACHE_TTL_SECONDS = float(os.environ.get('RESPONSE_CACHE_TTL_SECONDS', '5'))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', '10000'))
+
+# Sync cursors overlap the previous sync by this much, so rows written by
+# requests still in flight when it ran are not missed (clients merge by id).
+# Buffered progress keeps the time it was saved but can reach the database
+# up to one flush interval per attempt later, so the overlap covers that too
+SYNC_OVERLAP_SECONDS = float(os.environ.get(
+    'SYNC_OVERLAP_SECONDS',
+    str(5 + (PROGRESS_FLUSH_INTERVAL_SECONDS * PROGRESS_FLUSH_MAX_ATTEMPTS if PROGRESS_WRITE_BEHIND else 0)),
+))
+
 # Create the main app
 app = FastAPI()
 api_router = APIRouter(prefix="/api")
@@ -91,6 +226,7 @@ class Book(BaseModel):
     trending: bool = False
     is_public: bool = True
     uploaded_by: str
+    file_hash: Optional[str] = None
     created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
 
 class BookCreate(BaseModel):
@@ -165,6 +301,22 @@ class AnnotationCreate(BaseModel):
     note: Optional[str] = None
     color: str = "#FFEB3B"
 
+class BookmarkBatchItem(BookmarkCreate):
+    # Client-generated id, so a retried sync does not create duplicates
+    id: Optional[uuid.UUID] = None
+
+class BookmarkBatch(BaseModel):
+    items: List[BookmarkBatchItem] = Field(min_length=1, max_length=BATCH_MAX_ITEMS)
+
+class AnnotationBatchItem(AnnotationCreate):
+    id: Optional[uuid.UUID] = None
+
+class AnnotationBatch(BaseModel):
+    items: List[AnnotationBatchItem] = Field(min_length=1, max_length=BATCH_MAX_ITEMS)
+
+class BatchDelete(BaseModel):
+    ids: List[uuid.UUID] = Field(min_length=1, max_length=BATCH_MAX_ITEMS)
+
 class ReadingPreferences(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -178,6 +330,7 @@ class ReadingPreferences(BaseModel):
     auto_night_mode: bool = True
     page_turn_animation: bool = True
     created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    updated_at: Optional[str] = None
 
 class PreferencesUpdate(BaseModel):
     theme: Optional[str] = None
@@ -189,6 +342,587 @@ class PreferencesUpdate(BaseModel):
     auto_night_mode: Optional[bool] = None
     page_turn_animation: Optional[bool] = None
 
+# ============ METRICS ============
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(names, values) -> str:
+    return ",".join(f'{name}="{_label_value(value)}"' for name, value in zip(names, values))
+
+class Histogram:
+    """Thread-safe Prometheus histogram keyed by label values."""
+
+    def __init__(self, name: str, documentation: str, labels: tuple, buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(labels[name] for name in self.labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # Per-bucket counts, then sum and count
+                series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {key: list(values) for key, values in self._series.items()}
+        for key, values in sorted(series.items()):
+            labels = _labels(self.labels, key)
+            prefix = f"{labels}," if labels else ""
+            for bound, count in zip(self.buckets, values):
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {values[-1]}')
+            lines.append(f"{self.name}_sum{{{labels}}} {values[-2]}")
+            lines.append(f"{self.name}_count{{{labels}}} {values[-1]}")
+        return lines
+
+class Gauge:
+    """Gauge whose value is read from ``collect()`` at scrape time.
+
+    ``collect`` returns a number, or a dict of label value -> number for a
+    single-label gauge.
+    """
+
+    def __init__(self, name: str, documentation: str, collect, label: Optional[str] = None):
+        self.name = name
+        self.documentation = documentation
+        self.collect = collect
+        self.label = label
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        value = self.collect()
+        if self.label is None:
+            lines.append(f"{self.name} {value}")
+        else:
+            for key, item in sorted(value.items()):
+                lines.append(f'{self.name}{{{self.label}="{_label_value(key)}"}} {item}')
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def histogram(self, name: str, documentation: str, labels: tuple) -> Histogram:
+        metric = Histogram(name, documentation, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, documentation: str, collect, label: Optional[str] = None) -> Gauge:
+        metric = Gauge(name, documentation, collect, label)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                logger.warning(f"Metric {metric.name} error: {e}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+request_latency = metrics.histogram("http_request_duration_seconds", "HTTP request latency by route and status.", ("method", "route", "status"))
+supabase_latency = metrics.histogram("supabase_query_duration_seconds", "Supabase table query latency.", ("table", "operation"))
+storage_latency = metrics.histogram("storage_request_duration_seconds", "Book storage call latency.", ("backend", "operation"))
+extraction_page_latency = metrics.histogram("extraction_page_duration_seconds", "Time to extract one page.", ("format",))
+
+# Per-request totals of timed calls, for the slow request log
+request_timings: contextvars.ContextVar = contextvars.ContextVar("request_timings", default=None)
+
+@contextmanager
+def timed(histogram: Histogram, **labels):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        histogram.observe(elapsed, **labels)
+        timings = request_timings.get()
+        if timings is not None:
+            total = timings.setdefault(histogram.name, [0.0, 0])
+            total[0] += elapsed
+            total[1] += 1
+
+# ============ RESPONSES ============
+
+def _json_default(value):
+    if isinstance(value, BaseModel):
+        # Already validated when it was built: dump without validating again
+        return value.model_dump(mode="json")
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def encode_json(content) -> bytes:
+    return orjson.dumps(content, default=_json_default)
+
+class FastJSONResponse(JSONResponse):
+    """JSON response encoded with orjson.
+
+    Returning one skips FastAPI's ``response_model`` re-validation and
+    ``jsonable_encoder`` pass, so handlers that build their models from rows
+    validate each row exactly once; ``response_model`` still documents the
+    route.
+    """
+
+    def render(self, content) -> bytes:
+        return encode_json(content)
+
+
+class ResponseCache:
+    """Short-TTL cache of serialized GET responses, grouped by table and user.
+
+    ``invalidate(table, user_id)`` drops the responses built from that user's
+    rows, ``invalidate(table)`` every response built from the table. Each
+    invalidation bumps a per-table generation; a response whose table
+    changed while it was being built is not stored, so a read racing a write
+    never caches the old rows.
+    """
+
+    def __init__(self, ttl: float, max_entries: int = 10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._tables: Counter = Counter()
+        self._generations: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def generation(self, table: str) -> int:
+        return self._generations[table]
+
+    def get(self, table: str, user_id: Optional[str], key) -> Optional[tuple]:
+        entry_key = (table, user_id, key)
+        with self._lock:
+            hit = self._entries.get(entry_key)
+            if hit is None:
+                return None
+            if hit[0] <= time.monotonic():
+                self._drop(entry_key)
+                return None
+            self._entries.move_to_end(entry_key)
+            return hit[1]
+
+    def set(self, table: str, user_id: Optional[str], key, value: tuple, generation: int) -> None:
+        if self.ttl <= 0:
+            return
+        entry_key = (table, user_id, key)
+        with self._lock:
+            if self._generations[table] != generation:
+                return
+            if entry_key not in self._entries:
+                self._tables[table] += 1
+            self._entries[entry_key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(entry_key)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+
+    def invalidate(self, table: str, user_id: Optional[str] = None) -> None:
+        with self._lock:
+            self._generations[table] += 1
+            if not self._tables[table]:
+                return
+            for entry_key in [k for k in self._entries if k[0] == table and (user_id is None or k[1] == user_id)]:
+                self._drop(entry_key)
+
+    def _drop(self, entry_key: tuple) -> None:
+        del self._entries[entry_key]
+        self._tables[entry_key[0]] -= 1
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_TTL_SECONDS, RESPONSE_CACHE_MAX_ENTRIES)
+
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    return if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]
+
+async def cached_json(request: Request, table: str, user_id: Optional[str], key, load) -> Response:
+    """JSON response for ``await load()``, with a strong ETag and server-side caching.
+
+    ``load`` returns ``(content, headers)``. The body is kept in
+    ``response_cache`` under ``(table, user_id, key)``, so repeated polls
+    skip Supabase until a write invalidates it; a matching ``If-None-Match``
+    gets an empty 304.
+    """
+    entry = response_cache.get(table, user_id, key)
+    if entry is None:
+        generation = response_cache.generation(table)
+        content, headers = await load()
+        body = encode_json(content)
+        entry = (body, f'"{hashlib.sha256(body).hexdigest()[:32]}"', headers)
+        response_cache.set(table, user_id, key, entry, generation)
+
+    body, etag, headers = entry
+    headers = {**headers, "ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+# ============ DATA LAYER ============
+
+class Repository:
+    """Async access to a single Supabase table.
+
+    Filters are passed as keyword arguments and combined as equality matches;
+    a list value matches any of its elements.
+    The client is looked up on every call, so the shared connection pool (or
+    a test double patched over ``supabase``) is always the one in use.
+    Writes invalidate the cached responses of the affected user, or of the
+    whole table when the rows are not scoped to one user.
+    """
+
+    def __init__(self, table: str):
+        self.table = table
+
+    def query(self):
+        return supabase.table(self.table)
+
+    @staticmethod
+    def _filter(query, filters: dict):
+        for column, value in filters.items():
+            if isinstance(value, (list, tuple)):
+                query = query.in_(column, list(value))
+            else:
+                query = query.eq(column, value)
+        return query
+
+    async def _execute(self, query, operation: str):
+        with timed(supabase_latency, table=self.table, operation=operation):
+            return await query.execute()
+
+    async def _write(self, query, operation: str, user_id: Optional[str]):
+        try:
+            return await self._execute(query, operation)
+        finally:
+            # Also on failure: the write may have been applied anyway
+            response_cache.invalidate(self.table, user_id)
+
+    @staticmethod
+    def _owner(rows) -> Optional[str]:
+        """The ``user_id`` shared by all ``rows``, if any."""
+        owners = {row.get("user_id") for row in (rows if isinstance(rows, list) else [rows])}
+        return owners.pop() if len(owners) == 1 else None
+
+    async def find(self, columns: str = "*", **filters) -> List[dict]:
+        response = await self._execute(self._filter(self.query().select(columns), filters), "select")
+        return response.data
+
+    async def get(self, columns: str = "*", **filters) -> Optional[dict]:
+        rows = await self.find(columns, **filters)
+        return rows[0] if rows else None
+
+    async def insert(self, row) -> None:
+        await self._write(self.query().insert(row), "insert", self._owner(row))
+
+    async def update(self, values: dict, **filters) -> None:
+        await self._write(self._filter(self.query().update(values), filters), "update", filters.get("user_id"))
+
+    async def delete(self, **filters) -> List[dict]:
+        response = await self._write(self._filter(self.query().delete(), filters), "delete", filters.get("user_id"))
+        return response.data
+
+    async def find_since(self, column: str, since: Optional[str], columns: str = "*", **filters) -> List[dict]:
+        """Like ``find``, limited to rows whose ``column`` is at or after ``since``."""
+        query = self._filter(self.query().select(columns), filters)
+        if since is not None:
+            query = query.gte(column, since)
+        response = await self._execute(query, "select")
+        return response.data
+
+    async def insert_new(self, rows: List[dict]) -> List[dict]:
+        """Insert rows in one statement, skipping ids that already exist.
+
+        Returns only the rows that were inserted.
+        """
+        response = await self._write(self.query().upsert(rows, on_conflict="id", ignore_duplicates=True), "insert", self._owner(rows))
+        return response.data
+
+    async def upsert(self, row, on_conflict: str) -> List[dict]:
+        """Insert or merge on the ``on_conflict`` unique key in one statement.
+
+        Only the columns present in ``row`` are written on conflict; the
+        stored rows are returned.
+        """
+        response = await self._write(self.query().upsert(row, on_conflict=on_conflict), "upsert", self._owner(row))
+        return response.data
+
+
+def _postgrest_value(value) -> str:
+    """Quote a value for use inside a PostgREST logical (or/and) filter."""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float)):
+        return str(value)
+    escaped = str(value).replace("\\", "\\\\").replace('"', '\\"')
+    return f'"{escaped}"'
+
+
+class BookRepository(Repository):
+    async def list_visible(
+        self,
+        user_id: str,
+        columns: str = "*",
+        filters: Optional[dict] = None,
+        author: Optional[str] = None,
+        sort: str = "created_at",
+        descending: bool = True,
+        after: Optional[tuple] = None,
+        limit: Optional[int] = None,
+    ) -> List[dict]:
+        """Public books plus the ones uploaded by ``user_id``.
+
+        Results are ordered by ``sort`` then ``id``. ``after`` is the
+        ``(sort value, id)`` of the last row of the previous page (keyset
+        pagination), so every page costs the same regardless of its depth.
+        """
+        visibility = ["is_public.eq.true", f"uploaded_by.eq.{user_id}"]
+        if after is not None:
+            op = "lt" if descending else "gt"
+            value, last_id = _postgrest_value(after[0]), _postgrest_value(after[1])
+            keyset = f"or({sort}.{op}.{value},and({sort}.eq.{value},id.{op}.{last_id}))"
+            condition = ",".join(f"and({v},{keyset})" for v in visibility)
+        else:
+            condition = ",".join(visibility)
+
+        query = self._filter(self.query().select(columns).or_(condition), filters or {})
+        if author:
+            query = query.ilike("author", f"%{author}%")
+        query = query.order(sort, desc=descending).order("id", desc=descending)
+        if limit is not None:
+            query = query.limit(limit)
+
+        response = await self._execute(query, "select")
+        return response.data
+
+    async def scan(self, columns: str = "*", page_size: int = 1000):
+        """Yield every book in pages of ``page_size``, keyed on ``id``."""
+        last_id = None
+        while True:
+            query = self.query().select(columns).order("id").limit(page_size)
+            if last_id is not None:
+                query = query.gt("id", last_id)
+            rows = (await self._execute(query, "select")).data
+            if rows:
+                yield rows
+            if len(rows) < page_size:
+                return
+            last_id = rows[-1]["id"]
+
+    async def search_metadata(self, text: str, user_id: str, limit: int, offset: int = 0) -> List[dict]:
+        """Visible books whose title, author or description contain ``text``.
+
+        Shaped like ``SearchIndex.search`` hits, without page, snippet or score.
+        """
+        pattern = _postgrest_value(f"%{text.strip()}%")
+        visibility = f"or(is_public.eq.true,uploaded_by.eq.{_postgrest_value(user_id)})"
+        matches = ",".join(f"{column}.ilike.{pattern}" for column in ("title", "author", "description"))
+        query = (
+            self.query().select("id, title, author")
+            .or_(f"and({visibility},or({matches}))")
+            .order("title").order("id")
+            .range(offset, offset + limit - 1)
+        )
+        rows = (await self._execute(query, "select")).data
+        return [
+            {"book_id": row["id"], "title": row["title"], "author": row["author"], "page": None, "snippet": None, "score": None}
+            for row in rows
+        ]
+
+
+users_repo = Repository("users")
+books_repo = BookRepository("books")
+progress_repo = Repository("reading_progress")
+bookmarks_repo = Repository("bookmarks")
+annotations_repo = Repository("annotations")
+preferences_repo = Repository("reading_preferences")
+
+
+class TombstoneRepository(Repository):
+    """Records deletions so clients can drop their copies on the next sync.
+
+    Tombstones without a ``user_id`` (deleted books) apply to every user.
+    """
+
+    async def record(self, item_type: str, ids: List[str], user_id: Optional[str] = None) -> None:
+        if not ids:
+            return
+        deleted_at = datetime.now(timezone.utc).isoformat()
+        try:
+            await self.insert([
+                {"id": str(uuid.uuid4()), "user_id": user_id, "item_type": item_type, "item_id": item_id, "deleted_at": deleted_at}
+                for item_id in ids
+            ])
+        except Exception as e:
+            # The delete itself succeeded; other devices keep the item until a full sync
+            logger.warning(f"Tombstone error: {e}")
+
+    async def since(self, user_id: str, since: Optional[str]) -> List[dict]:
+        if since is None:
+            # A full sync has nothing to delete
+            return []
+        query = (
+            self.query()
+            .select("item_type, item_id, deleted_at")
+            .or_(f"user_id.eq.{user_id},user_id.is.null")
+            .gte("deleted_at", since)
+        )
+        response = await self._execute(query, "select")
+        return response.data
+
+
+tombstones_repo = TombstoneRepository("deleted_items")
+
+
+class ProgressWriteBuffer:
+    """Write-behind buffer that coalesces reading progress updates.
+
+    Only the latest state per ``(user_id, book_id)`` is kept. Pending changes
+    are written with bulk upserts every ``interval`` seconds, as soon as
+    ``max_pending`` keys are waiting, and on shutdown. Reads overlay pending
+    changes on the stored row, so clients always see their latest save.
+
+    A batch rejected because of its data (an invalid or deleted book id) is
+    split until the offending rows are isolated; those are dropped so they
+    cannot hold back everyone else's saves. Other failures requeue the rows,
+    each for at most ``max_attempts`` flushes.
+    """
+
+    def __init__(self, interval: float, max_pending: int, max_rows: int = 10000, max_attempts: int = 10):
+        self.interval = interval
+        self.max_pending = max_pending
+        self.max_rows = max_rows
+        self.max_attempts = max_attempts
+        self._changes: dict = {}
+        self._attempts: Counter = Counter()
+        self._rows: "OrderedDict[tuple, dict]" = OrderedDict()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        self._threshold_flush = None
+
+    def pending(self, user_id: str, book_id: str) -> Optional[dict]:
+        return self._changes.get((user_id, book_id))
+
+    def pending_for_user(self, user_id: str) -> List[dict]:
+        return [changes for (uid, _), changes in self._changes.items() if uid == user_id]
+
+    def remember(self, row: dict) -> None:
+        """Record the stored state of a row, used as the base for responses."""
+        key = (row["user_id"], row["book_id"])
+        self._rows[key] = row
+        self._rows.move_to_end(key)
+        while len(self._rows) > self.max_rows:
+            self._rows.popitem(last=False)
+
+    def overlay(self, row: dict) -> dict:
+        return {**row, **self._changes.get((row["user_id"], row["book_id"]), {})}
+
+    def put(self, user_id: str, book_id: str, changes: dict) -> Optional[dict]:
+        """Buffer ``changes`` and return the resulting progress state.
+
+        Returns None when the stored row has not been read by this process,
+        so the full state is unknown until the next flush.
+        """
+        key = (user_id, book_id)
+        self._changes[key] = {**self._changes.get(key, {}), **changes, "user_id": user_id, "book_id": book_id}
+
+        if len(self._changes) >= self.max_pending and (self._threshold_flush is None or self._threshold_flush.done()):
+            self._threshold_flush = asyncio.ensure_future(self.flush())
+
+        if key not in self._rows:
+            return None
+        return {**self._rows[key], **self._changes[key]}
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            if not self._changes:
+                return
+            batch, self._changes = self._changes, {}
+
+            # A bulk upsert needs identical columns in every row, otherwise
+            # missing columns would be overwritten with defaults
+            groups = defaultdict(list)
+            for row in batch.values():
+                groups[frozenset(row)].append(row)
+
+            for rows in groups.values():
+                await self._write(rows)
+
+    async def _write(self, rows: List[dict]) -> None:
+        try:
+            stored = await progress_repo.upsert(rows, on_conflict="user_id,book_id")
+        except Exception as e:
+            if _is_row_error(e):
+                if len(rows) > 1:
+                    # Bisect to find the rows the database rejects
+                    middle = len(rows) // 2
+                    await self._write(rows[:middle])
+                    await self._write(rows[middle:])
+                    return
+                logger.error(f"Progress flush dropped {rows[0]['user_id']}/{rows[0]['book_id']}: {e}")
+                self._attempts.pop((rows[0]["user_id"], rows[0]["book_id"]), None)
+                return
+
+            logger.error(f"Progress flush error: {e}")
+            for row in rows:
+                key = (row["user_id"], row["book_id"])
+                self._attempts[key] += 1
+                if self._attempts[key] >= self.max_attempts:
+                    logger.error(f"Progress flush gave up on {key[0]}/{key[1]} after {self._attempts[key]} attempts")
+                    del self._attempts[key]
+                    continue
+                # Requeue, keeping anything newer that arrived meanwhile
+                self._changes[key] = {**row, **self._changes.get(key, {})}
+            return
+
+        for row in rows:
+            self._attempts.pop((row["user_id"], row["book_id"]), None)
+        for row in stored:
+            self.remember(row)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Progress flush loop error: {e}")
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+
+def _is_row_error(error: Exception) -> bool:
+    """Whether PostgreSQL rejected the data itself (SQLSTATE class 22 or 23)."""
+    return str(getattr(error, "code", None) or "")[:2] in ("22", "23")
+
+
+progress_buffer = ProgressWriteBuffer(
+    PROGRESS_FLUSH_INTERVAL_SECONDS, PROGRESS_FLUSH_MAX_PENDING, max_attempts=PROGRESS_FLUSH_MAX_ATTEMPTS
+)
+
 # ============ AUTH HELPERS ============
 
 def hash_password(password: str) -> str:
@@ -197,11 +931,152 @@ def hash_password(password: str) -> str:
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
-def create_access_token(user_id: str) -> str:
+class PasswordHasher:
+    """Runs bcrypt in a small thread pool instead of on the event loop.
+
+    bcrypt releases the GIL while hashing, so the threads run in parallel
+    and other requests keep being served during a login burst. At most
+    ``queue_limit`` calls wait or run at once; callers beyond that get a 503
+    instead of queueing behind the burst. ``stats()`` reports the queue.
+    """
+
+    def __init__(self, workers: int, queue_limit: int):
+        self.workers = max(1, workers)
+        self.queue_limit = queue_limit
+        self.active = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._executor = None
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+        return self._executor
+
+    async def run(self, fn, *args):
+        if self.active >= self.queue_limit:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=503,
+                detail="Too many authentication requests, try again shortly",
+                headers={"Retry-After": "1"},
+            )
+
+        submitted = time.monotonic()
+
+        def timed():
+            return time.monotonic() - submitted, fn(*args)
+
+        self.active += 1
+        try:
+            wait, result = await asyncio.get_running_loop().run_in_executor(self._get_executor(), timed)
+        finally:
+            self.active -= 1
+        self.completed += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        return result
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "queued": max(0, self.active - self.workers),
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "avg_wait_ms": round(self.total_wait / self.completed * 1000, 3) if self.completed else 0.0,
+            "max_wait_ms": round(self.max_wait * 1000, 3),
+        }
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+password_hasher = PasswordHasher(PASSWORD_HASH_WORKERS, PASSWORD_HASH_QUEUE_LIMIT)
+
+def create_access_token(user_id: str, user: Optional[User] = None) -> str:
     expire = datetime.now(timezone.utc) + timedelta(days=JWT_EXPIRATION_DAYS)
     payload = {"sub": user_id, "exp": expire}
+    if user is not None:
+        # Signed profile claims, used when AUTH_TRUST_TOKEN_CLAIMS is enabled
+        payload["usr"] = user.model_dump(exclude={"id"})
     return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
+class PrincipalCache:
+    """TTL cache of authenticated users keyed by user id.
+
+    Entries live in process memory and, when ``path`` is set, in a SQLite file
+    so that every worker on the host shares them. Call ``invalidate`` whenever
+    a user row changes or is deleted.
+    """
+
+    def __init__(self, ttl: float, path: Optional[str] = None, max_entries: int = 10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, timeout=1, check_same_thread=False, isolation_level=None)
+            self._db.execute("pragma journal_mode=wal")
+            self._db.execute(
+                "create table if not exists principals (user_id text primary key, data text not null, expires_at real not null)"
+            )
+
+    def get(self, user_id: str) -> Optional[dict]:
+        with self._lock:
+            hit = self._memory.get(user_id)
+            if hit is not None:
+                if hit[0] > time.time():
+                    self._memory.move_to_end(user_id)
+                    return hit[1]
+                del self._memory[user_id]
+
+        if self._db is not None:
+            row = self._db.execute(
+                "select data, expires_at from principals where user_id = ? and expires_at > ?",
+                (user_id, time.time()),
+            ).fetchone()
+            if row:
+                data = json.loads(row[0])
+                self._remember(user_id, data, row[1])
+                return data
+        return None
+
+    def set(self, user_id: str, data: dict) -> None:
+        expires_at = time.time() + self.ttl
+        self._remember(user_id, data, expires_at)
+        if self._db is not None:
+            self._db.execute(
+                "insert or replace into principals (user_id, data, expires_at) values (?, ?, ?)",
+                (user_id, json.dumps(data), expires_at),
+            )
+
+    def invalidate(self, user_id: str) -> None:
+        with self._lock:
+            self._memory.pop(user_id, None)
+        if self._db is not None:
+            self._db.execute("delete from principals where user_id = ?", (user_id,))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+        if self._db is not None:
+            self._db.execute("delete from principals")
+
+    def _remember(self, user_id: str, data: dict, expires_at: float) -> None:
+        with self._lock:
+            self._memory[user_id] = (expires_at, data)
+            self._memory.move_to_end(user_id)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+
+principal_cache = PrincipalCache(PRINCIPAL_CACHE_TTL_SECONDS, PRINCIPAL_CACHE_PATH)
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> User:
     try:
         token = credentials.credentials
@@ -210,12 +1085,20 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
         if not user_id:
             raise HTTPException(status_code=401, detail="Invalid token")
         
-        response = supabase.table("users").select("*").eq("id", user_id).execute()
-        if not response.data:
-            raise HTTPException(status_code=401, detail="User not found")
+        claims = payload.get("usr")
+        if AUTH_TRUST_TOKEN_CLAIMS and claims:
+            return User(id=user_id, **claims)
+
+        user_data = principal_cache.get(user_id)
+        if user_data is None:
+            user_data = await users_repo.get("id, email, username, created_at", id=user_id)
+            if not user_data:
+                raise HTTPException(status_code=401, detail="User not found")
+            principal_cache.set(user_id, user_data)
         
-        user_data = response.data[0]
         return User(**user_data)
+    except HTTPException:
+        raise
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expired")
     except jwt.InvalidTokenError:
@@ -231,18 +1114,16 @@ async def register(user_data: UserCreate):
     # Check if user exists
     try:
         # Check email
-        res_email = supabase.table("users").select("id").eq("email", user_data.email).execute()
-        if res_email.data:
+        if await users_repo.get("id", email=user_data.email):
             raise HTTPException(status_code=400, detail="Email already exists")
         
         # Check username
-        res_user = supabase.table("users").select("id").eq("username", user_data.username).execute()
-        if res_user.data:
+        if await users_repo.get("id", username=user_data.username):
             raise HTTPException(status_code=400, detail="Username already exists")
         
         # Create user
         user_id = str(uuid.uuid4())
-        password_hash = hash_password(user_data.password)
+        password_hash = await password_hasher.run(hash_password, user_data.password)
         
         new_user = {
             "id": user_id,
@@ -252,17 +1133,18 @@ async def register(user_data: UserCreate):
             "created_at": datetime.now(timezone.utc).isoformat()
         }
         
-        supabase.table("users").insert(new_user).execute()
+        await users_repo.insert(new_user)
         
         # Create default preferences
         prefs = {
             "user_id": user_id,
             "created_at": datetime.now(timezone.utc).isoformat()
         }
-        supabase.table("reading_preferences").insert(prefs).execute()
+        await preferences_repo.insert(prefs)
         
         user = User(**new_user)
-        token = create_access_token(user.id)
+        principal_cache.set(user.id, user.model_dump())
+        token = create_access_token(user.id, user)
         return Token(access_token=token, token_type="bearer", user=user)
         
     except HTTPException:
@@ -274,16 +1156,24 @@ async def register(user_data: UserCreate):
 @api_router.post("/auth/login", response_model=Token)
 async def login(credentials: UserLogin):
     try:
-        response = supabase.table("users").select("*").eq("email", credentials.email).execute()
-        if not response.data:
+        user_doc = await users_repo.get(email=credentials.email)
+        if not user_doc:
             raise HTTPException(status_code=401, detail="Invalid email or password")
         
-        user_doc = response.data[0]
-        if not verify_password(credentials.password, user_doc["password_hash"]):
+        if not await password_hasher.run(verify_password, credentials.password, user_doc["password_hash"]):
             raise HTTPException(status_code=401, detail="Invalid email or password")
+
+        try:
+            if pwd_context.needs_update(user_doc["password_hash"]):
+                # Cost parameters changed since this hash was made
+                new_hash = await password_hasher.run(hash_password, credentials.password)
+                await users_repo.update({"password_hash": new_hash}, id=user_doc["id"])
+        except Exception as rehash_err:
+            logger.warning(f"Password rehash error: {rehash_err}")
         
         user = User(**user_doc)
-        token = create_access_token(user.id)
+        principal_cache.set(user.id, user.model_dump())
+        token = create_access_token(user.id, user)
         return Token(access_token=token, token_type="bearer", user=user)
     except HTTPException:
         raise
@@ -295,6 +1185,228 @@ async def login(credentials: UserLogin):
 async def get_me(current_user: User = Depends(get_current_user)):
     return current_user
 
+# ============ UPLOADS ============
+
+def sniff_format(head: bytes) -> Optional[str]:
+    """Detect the book format from the first bytes of a file."""
+    if head.startswith(b"%PDF-"):
+        return "pdf"
+    if head.startswith(b"PK\x03\x04"):
+        # EPUB is a zip whose first entry is the "mimetype" file
+        return "epub" if b"application/epub+zip" in head[:128] else None
+    if b"\x00" not in head or any(head.startswith(bom) for bom, _ in TEXT_BOMS):
+        # UTF-16/32 text is full of NUL bytes, but starts with a BOM
+        return "txt"
+    return None
+
+async def spool_upload(file: UploadFile, expected_format: str):
+    """Copy an upload to a temp file in chunks, hashing and checking it on the way.
+
+    Returns ``(tmp_path, size, sha256)``. Raises 413 as soon as the size limit
+    is crossed and 400 if the content does not match ``expected_format``.
+    """
+    limit = MAX_UPLOAD_MB * 1024 * 1024
+    digest = hashlib.sha256()
+    size = 0
+    with tempfile.NamedTemporaryFile(delete=False, suffix=f".{expected_format}") as tmp_file:
+        tmp_path = Path(tmp_file.name)
+        try:
+            while True:
+                chunk = await file.read(UPLOAD_CHUNK_BYTES)
+                if not chunk:
+                    break
+                if size == 0 and sniff_format(chunk) != expected_format:
+                    raise HTTPException(status_code=400, detail="File content does not match its format")
+                size += len(chunk)
+                if size > limit:
+                    raise HTTPException(status_code=413, detail=f"File exceeds the {MAX_UPLOAD_MB} MB limit")
+                digest.update(chunk)
+                tmp_file.write(chunk)
+        except BaseException:
+            tmp_file.close()
+            os.unlink(tmp_path)
+            raise
+
+    if size == 0:
+        os.unlink(tmp_path)
+        raise HTTPException(status_code=400, detail="Empty file")
+    return tmp_path, size, digest.hexdigest()
+
+async def resumable_upload(file_path: Path, object_name: str, content_type: str, size: int) -> None:
+    """Upload a file to Storage with the TUS protocol, one 6 MB part at a time.
+
+    A failed part is retried from the offset the server reports, so a dropped
+    connection does not restart the whole upload.
+    """
+    def b64(value: str) -> str:
+        return base64.b64encode(value.encode()).decode()
+
+    headers = {"Authorization": f"Bearer {SUPABASE_KEY}", "apikey": SUPABASE_KEY, "Tus-Resumable": "1.0.0"}
+    created = await supabase_http.post(
+        f"{SUPABASE_URL.rstrip('/')}/storage/v1/upload/resumable",
+        headers={
+            **headers,
+            "Upload-Length": str(size),
+            "x-upsert": "true",
+            "Upload-Metadata": ",".join([
+                f"bucketName {b64(STORAGE_BUCKET)}",
+                f"objectName {b64(object_name)}",
+                f"contentType {b64(content_type)}",
+                f"cacheControl {b64('3600')}",
+            ]),
+        },
+    )
+    created.raise_for_status()
+    upload_url = created.headers["Location"]
+
+    offset = 0
+    retries = 0
+    with open(file_path, "rb") as f:
+        while offset < size:
+            f.seek(offset)
+            chunk = f.read(RESUMABLE_CHUNK_BYTES)
+            try:
+                res = await supabase_http.patch(
+                    upload_url,
+                    content=chunk,
+                    headers={**headers, "Upload-Offset": str(offset), "Content-Type": "application/offset+octet-stream"},
+                )
+                res.raise_for_status()
+                offset = int(res.headers["Upload-Offset"])
+                retries = 0
+            except (httpx.HTTPError, KeyError, ValueError):
+                retries += 1
+                if retries > RESUMABLE_MAX_RETRIES:
+                    raise
+                head = await supabase_http.head(upload_url, headers=headers)
+                head.raise_for_status()
+                offset = int(head.headers["Upload-Offset"])
+
+# ============ STORAGE ============
+
+class SupabaseStorage:
+    """Objects in the Supabase Storage bucket."""
+
+    def __init__(self, bucket: str):
+        self.bucket = bucket
+
+    def local_path(self, object_name: str) -> Optional[Path]:
+        return None
+
+    async def upload_file(self, file_path: Path, object_name: str, content_type: str, size: int) -> None:
+        if size > RESUMABLE_UPLOAD_THRESHOLD_MB * 1024 * 1024:
+            with timed(storage_latency, backend="supabase", operation="resumable_upload"):
+                await resumable_upload(file_path, object_name, content_type, size)
+        else:
+            with timed(storage_latency, backend="supabase", operation="upload"):
+                # A path is streamed from disk by the storage client
+                await supabase.storage.from_(self.bucket).upload(
+                    path=object_name,
+                    file=file_path,
+                    # Objects are content-addressed: overwriting one is a no-op
+                    file_options={"content-type": content_type, "upsert": "true"}
+                )
+
+    async def upload_bytes(self, object_name: str, data: bytes, content_type: str) -> None:
+        with timed(storage_latency, backend="supabase", operation="upload"):
+            await supabase.storage.from_(self.bucket).upload(
+                path=object_name,
+                file=data,
+                file_options={"content-type": content_type, "upsert": "true"},
+            )
+
+    async def download_to(self, object_name: str, file_path: Path) -> str:
+        """Stream an object into ``file_path``; returns its sha256."""
+        digest = hashlib.sha256()
+        with timed(storage_latency, backend="supabase", operation="download"):
+            async with supabase_http.stream(
+                "GET",
+                f"{SUPABASE_URL.rstrip('/')}/storage/v1/object/{self.bucket}/{object_name}",
+                headers={"Authorization": f"Bearer {SUPABASE_KEY}", "apikey": SUPABASE_KEY},
+            ) as res:
+                res.raise_for_status()
+                with open(file_path, "wb") as f:
+                    async for chunk in res.aiter_bytes(UPLOAD_CHUNK_BYTES):
+                        digest.update(chunk)
+                        f.write(chunk)
+        return digest.hexdigest()
+
+    async def exists(self, object_name: str) -> bool:
+        with timed(storage_latency, backend="supabase", operation="exists"):
+            res = await supabase_http.head(
+                f"{SUPABASE_URL.rstrip('/')}/storage/v1/object/{self.bucket}/{object_name}",
+                headers={"Authorization": f"Bearer {SUPABASE_KEY}", "apikey": SUPABASE_KEY},
+            )
+        if res.status_code in (400, 404):
+            return False
+        res.raise_for_status()
+        return True
+
+    async def remove(self, object_names: List[str]) -> None:
+        with timed(storage_latency, backend="supabase", operation="remove"):
+            await supabase.storage.from_(self.bucket).remove(object_names)
+
+    async def public_url(self, object_name: str) -> str:
+        return await supabase.storage.from_(self.bucket).get_public_url(object_name)
+
+
+class LocalStorage:
+    """Objects stored as files under a directory on this host."""
+
+    def __init__(self, root: Path, public_url: str):
+        self.root = Path(root)
+        self.base_url = public_url
+
+    def _path(self, object_name: str) -> Path:
+        path = (self.root / object_name).resolve()
+        if self.root.resolve() not in path.parents:
+            raise ValueError(f"Invalid object name: {object_name}")
+        return path
+
+    def local_path(self, object_name: str) -> Optional[Path]:
+        path = self._path(object_name)
+        return path if path.is_file() else None
+
+    def _write(self, object_name: str, write) -> None:
+        path = self._path(object_name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+        write(tmp_path)
+        os.replace(tmp_path, path)
+
+    async def upload_file(self, file_path: Path, object_name: str, content_type: str, size: int) -> None:
+        with timed(storage_latency, backend="local", operation="upload"):
+            await run_in_threadpool(self._write, object_name, lambda target: shutil.copyfile(file_path, target))
+
+    async def upload_bytes(self, object_name: str, data: bytes, content_type: str) -> None:
+        with timed(storage_latency, backend="local", operation="upload"):
+            await run_in_threadpool(self._write, object_name, lambda target: target.write_bytes(data))
+
+    async def download_to(self, object_name: str, file_path: Path) -> str:
+        def copy() -> str:
+            digest = hashlib.sha256()
+            with open(self._path(object_name), "rb") as src, open(file_path, "wb") as dst:
+                for chunk in iter(lambda: src.read(UPLOAD_CHUNK_BYTES), b""):
+                    digest.update(chunk)
+                    dst.write(chunk)
+            return digest.hexdigest()
+
+        with timed(storage_latency, backend="local", operation="download"):
+            return await run_in_threadpool(copy)
+
+    async def exists(self, object_name: str) -> bool:
+        return self.local_path(object_name) is not None
+
+    async def remove(self, object_names: List[str]) -> None:
+        for object_name in object_names:
+            self._path(object_name).unlink(missing_ok=True)
+
+    async def public_url(self, object_name: str) -> str:
+        return f"{self.base_url}/{object_name}"
+
+
+storage = LocalStorage(LOCAL_STORAGE_DIR, LOCAL_STORAGE_PUBLIC_URL) if STORAGE_BACKEND == "local" else SupabaseStorage(STORAGE_BUCKET)
+
 # ============ BOOK ROUTES ============
 
 @api_router.post("/books", response_model=Book)
@@ -315,81 +1427,186 @@ async def create_book(
     if file_extension not in ["pdf", "epub", "txt"]:
         raise HTTPException(status_code=400, detail="Invalid file format")
     
-    file_id = str(uuid.uuid4())
-    # Save file to Supabase Storage
-    path = f"{file_id}.{file_extension}"
+    # Spool to disk in chunks: hash, size-limit and sniff without buffering
+    tmp_path, file_size, file_hash = await spool_upload(file, file_extension)
+
+    # Storage objects are content-addressed, so identical uploads share one object
+    path = f"{file_hash}.{file_extension}"
+    
+    content_type = file.content_type or "application/octet-stream"
     
     try:
-        # Upload
-        file_bytes = await file.read()
-        res = supabase.storage.from_(STORAGE_BUCKET).upload(
-            path=path,
-            file=file_bytes,
-            file_options={"content-type": file.content_type}
-        )
-        # file_url is usually just the path if we use from_().get_public_url()
-        # but we need to store the relative path for our download logic or full URL
-        # Storing relative path is flexible.
-        storage_path = path 
-        
-        # Get public URL for frontend display
-        public_url_res = supabase.storage.from_(STORAGE_BUCKET).get_public_url(path)
-        # public_url_res is just a string URL
+        try:
+            # Upload, unless another book already references this content
+            async with _source_lock(path):
+                shared = await books_repo.get("id", file_url=path) is not None
+                if not shared:
+                    await storage.upload_file(tmp_path, path, content_type, file_size)
+            # file_url is usually just the path if we use from_().get_public_url()
+            # but we need to store the relative path for our download logic or full URL
+            # Storing relative path is flexible.
+            storage_path = path 
+            
+        except Exception as e:
+            logger.error(f"Upload error: {e}")
+            raise HTTPException(status_code=500, detail="Error uploading file to storage")
         
-        file_size = len(file_bytes)
+        # Create book
+        book_data = {
+            "id": str(uuid.uuid4()),
+            "title": title,
+            "author": author,
+            "description": description,
+            "cover_url": cover_url,
+            "category": category,
+            "file_url": storage_path, # Storing just the filename/path in bucket
+            "file_format": file_extension,
+            "file_size": file_size,
+            "file_hash": file_hash,
+            "language": language,
+            "total_pages": total_pages,
+            "total_chapters": total_chapters,
+            "rating": round(random.uniform(3.5, 5.0), 1),
+            "reviews": random.randint(10, 500),
+            "trending": random.choice([True, False]),
+            "uploaded_by": current_user.id,
+            "created_at": datetime.now(timezone.utc).isoformat()
+        }
         
-    except Exception as e:
-        logger.error(f"Upload error: {e}")
-        raise HTTPException(status_code=500, detail="Error uploading file to storage")
-    
-    # Create book
-    book_data = {
-        "id": str(uuid.uuid4()),
-        "title": title,
-        "author": author,
-        "description": description,
-        "cover_url": cover_url,
-        "category": category,
-        "cover_url": cover_url,
-        "category": category,
-        "file_url": storage_path, # Storing just the filename/path in bucket
-        "file_format": file_extension,
-        "file_format": file_extension,
-        "file_size": file_size,
-        "language": language,
-        "total_pages": total_pages,
-        "total_chapters": total_chapters,
-        "rating": round(random.uniform(3.5, 5.0), 1),
-        "reviews": random.randint(10, 500),
-        "trending": random.choice([True, False]),
-        "uploaded_by": current_user.id,
-        "created_at": datetime.now(timezone.utc).isoformat()
-    }
-    
-    try:
-        supabase.table("books").insert(book_data).execute()
+        try:
+            await books_repo.insert(book_data)
+        except Exception as e:
+            logger.error(f"Create book error: {e}")
+            raise HTTPException(status_code=500, detail="Error creating book")
+
+        if shared:
+            # A delete may have removed the shared object after our check and
+            # before our row existed: put it back (uploads upsert). Deletes
+            # check and remove under the same lock, so on this host the two
+            # cannot interleave
+            try:
+                async with _source_lock(path):
+                    if not await storage.exists(path):
+                        await storage.upload_file(tmp_path, path, content_type, file_size)
+            except Exception as e:
+                logger.error(f"Upload error: {e}")
+                await books_repo.delete(id=book_data["id"])
+                raise HTTPException(status_code=500, detail="Error uploading file to storage")
+
+        try:
+            await run_in_threadpool(search_index.index_book, book_data)
+        except Exception as index_err:
+            # The book exists; its first extraction indexes it again
+            logger.warning(f"Search index error: {index_err}")
+
+        if ingestion_queue.running:
+            # The ingestion job takes over the spooled file, saving a download
+            ingestion_queue.submit(book_data, tmp_path)
+            tmp_path = None
         return Book(**book_data)
-    except Exception as e:
-        logger.error(f"Create book error: {e}")
-        raise HTTPException(status_code=500, detail="Error creating book")
+    finally:
+        if tmp_path is not None:
+            os.unlink(tmp_path)
 
-@api_router.get("/books", response_model=List[Book])
-async def get_books(current_user: User = Depends(get_current_user)):
+BOOK_SORT_FIELDS = {"created_at", "title", "author", "rating", "reviews"}
+BOOK_PAGE_SIZE = 50
+
+def encode_cursor(values: list) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> list:
     try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(values, list):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+@api_router.get("/books", response_model=List[Book])
+async def get_books(
+    request: Request,
+    category: Optional[str] = None,
+    language: Optional[str] = None,
+    author: Optional[str] = None,
+    trending: Optional[bool] = None,
+    sort: str = "created_at",
+    order: str = Query("desc", pattern="^(asc|desc)$"),
+    fields: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=200),
+    cursor: Optional[str] = None,
+    current_user: User = Depends(get_current_user),
+):
+    """List the books visible to the current user.
+
+    Without ``limit``/``cursor`` every matching book is returned. Otherwise a
+    page of ``limit`` books is returned and the cursor for the next one is
+    sent in the ``X-Next-Cursor`` header. ``fields`` restricts the columns
+    (e.g. ``fields=id,title,author,cover_url`` for grid views); the books
+    then carry only those fields (plus ``id``).
+    """
+    if sort not in BOOK_SORT_FIELDS:
+        raise HTTPException(status_code=400, detail=f"sort must be one of {sorted(BOOK_SORT_FIELDS)}")
+
+    projection = None
+    if fields:
+        projection = [f.strip() for f in fields.split(",") if f.strip()]
+        unknown = set(projection) - set(Book.model_fields)
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+        if "id" not in projection:
+            projection.insert(0, "id")
+
+    after = None
+    if cursor:
+        after = tuple(decode_cursor(cursor))
+        if len(after) != 2:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        if limit is None:
+            limit = BOOK_PAGE_SIZE
+
+    filters = {k: v for k, v in {"category": category, "language": language, "trending": trending}.items() if v is not None}
+    columns = "*" if projection is None else ",".join(dict.fromkeys(projection + [sort]))
+
+    async def load():
         # Get public books OR books uploaded by user
-        response = supabase.table("books").select("*").or_(f"is_public.eq.true,uploaded_by.eq.{current_user.id}").execute()
-        return [Book(**book) for book in response.data]
+        rows = await books_repo.list_visible(
+            current_user.id,
+            columns=columns,
+            filters=filters,
+            author=author,
+            sort=sort,
+            descending=order == "desc",
+            after=after,
+            limit=None if limit is None else limit + 1,
+        )
+        headers = {}
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            headers["X-Next-Cursor"] = encode_cursor([rows[-1][sort], rows[-1]["id"]])
+
+        if projection is not None:
+            return [{k: row.get(k) for k in projection} for row in rows], headers
+        return [Book(**book) for book in rows], headers
+
+    try:
+        # Any book write can change any listing, so entries are not per user
+        key = (current_user.id, tuple(sorted(request.query_params.multi_items())))
+        return await cached_json(request, "books", None, key, load)
     except Exception as e:
         logger.error(f"Get books error: {e}")
         return []
 
 @api_router.get("/books/{book_id}", response_model=Book)
-async def get_book(book_id: str, current_user: User = Depends(get_current_user)):
-    try:
-        response = supabase.table("books").select("*").eq("id", book_id).execute()
-        if not response.data:
+async def get_book(book_id: str, request: Request, current_user: User = Depends(get_current_user)):
+    async def load():
+        book = await books_repo.get(id=book_id)
+        if not book:
             raise HTTPException(status_code=404, detail="Book not found")
-        return Book(**response.data[0])
+        return Book(**book), {}
+
+    try:
+        return await cached_json(request, "books", None, book_id, load)
     except Exception as e:
         logger.error(f"Get book error: {e}")
         raise HTTPException(status_code=404, detail="Book not found")
@@ -398,23 +1615,29 @@ async def get_book(book_id: str, current_user: User = Depends(get_current_user))
 async def delete_book(book_id: str, current_user: User = Depends(get_current_user)):
     try:
         # Check ownership
-        response = supabase.table("books").select("uploaded_by").eq("id", book_id).execute()
-        if not response.data:
+        book = await books_repo.get("uploaded_by, file_url", id=book_id)
+        if not book:
             raise HTTPException(status_code=404, detail="Book not found")
         
-        if response.data[0]["uploaded_by"] != current_user.id:
+        if book["uploaded_by"] != current_user.id:
             raise HTTPException(status_code=403, detail="Not authorized")
         
-        # Delete from storage first
+        await books_repo.delete(id=book_id)
+        await tombstones_repo.record("book", [book_id])
+        await run_in_threadpool(extraction_cache.invalidate, book_id)
+        await run_in_threadpool(search_index.remove_book, book_id)
+
+        # Storage objects are shared by books with identical content: only
+        # remove the object once no remaining book references it
         try:
              # Retrieve file_url (which we stored as path)
-             book = response.data[0]
              file_path_in_bucket = book["file_url"]
-             supabase.storage.from_(STORAGE_BUCKET).remove([file_path_in_bucket])
+             async with _source_lock(file_path_in_bucket):
+                 if not await books_repo.get("id", file_url=file_path_in_bucket):
+                     await storage.remove([file_path_in_bucket])
         except Exception as storage_err:
              logger.warning(f"Storage delete error: {storage_err}")
 
-        supabase.table("books").delete().eq("id", book_id).execute()
         return {"message": "Book deleted"}
     except HTTPException:
         raise
@@ -427,19 +1650,25 @@ async def delete_book(book_id: str, current_user: User = Depends(get_current_use
 @api_router.get("/reading/progress/{book_id}", response_model=ReadingProgress)
 async def get_reading_progress(book_id: str, current_user: User = Depends(get_current_user)):
     try:
-        response = supabase.table("reading_progress").select("*").eq("user_id", current_user.id).eq("book_id", book_id).execute()
-        
-        if not response.data:
-            new_progress = {
-                "id": str(uuid.uuid4()),
-                "user_id": current_user.id,
-                "book_id": book_id,
-                "last_read_at": datetime.now(timezone.utc).isoformat()
-            }
-            supabase.table("reading_progress").insert(new_progress).execute()
-            return ReadingProgress(**new_progress)
-        
-        return ReadingProgress(**response.data[0])
+        progress = await progress_repo.get(user_id=current_user.id, book_id=book_id)
+
+        if progress:
+            progress_buffer.remember(progress)
+            return FastJSONResponse(ReadingProgress(**progress_buffer.overlay(progress)))
+
+        pending = progress_buffer.pending(current_user.id, book_id)
+        if pending:
+            # Not flushed yet: the buffered state is the only state
+            return FastJSONResponse(ReadingProgress(**pending))
+
+        new_progress = {
+            "id": str(uuid.uuid4()),
+            "user_id": current_user.id,
+            "book_id": book_id,
+            "last_read_at": datetime.now(timezone.utc).isoformat()
+        }
+        await progress_repo.insert(new_progress)
+        return FastJSONResponse(ReadingProgress(**new_progress))
     except Exception as e:
         logger.error(f"Get progress error: {e}")
         raise HTTPException(status_code=500, detail="Error fetching progress")
@@ -453,23 +1682,72 @@ async def update_reading_progress(
     try:
         update_data = {k: v for k, v in update.model_dump().items() if v is not None}
         update_data["last_read_at"] = datetime.now(timezone.utc).isoformat()
+        update_data["user_id"] = current_user.id
+        update_data["book_id"] = book_id
+
+        if PROGRESS_WRITE_BEHIND:
+            state = progress_buffer.put(current_user.id, book_id, update_data)
+            if state is None:
+                # Stored row not read by this process: return only the saved
+                # fields rather than inventing an id and defaults
+                return FastJSONResponse(progress_buffer.pending(current_user.id, book_id), headers={"X-Progress-Partial": "true"})
+            return FastJSONResponse(ReadingProgress(**state))
         
-        # Check if exists
-        check = supabase.table("reading_progress").select("id").eq("user_id", current_user.id).eq("book_id", book_id).execute()
-        
-        if check.data:
-            supabase.table("reading_progress").update(update_data).eq("user_id", current_user.id).eq("book_id", book_id).execute()
-        else:
-            update_data["user_id"] = current_user.id
-            update_data["book_id"] = book_id
-            supabase.table("reading_progress").insert(update_data).execute()
-        
-        updated = supabase.table("reading_progress").select("*").eq("user_id", current_user.id).eq("book_id", book_id).execute()
-        return ReadingProgress(**updated.data[0])
+        # Atomic insert-or-update on unique(user_id, book_id)
+        updated = await progress_repo.upsert(update_data, on_conflict="user_id,book_id")
+        return FastJSONResponse(ReadingProgress(**updated[0]))
     except Exception as e:
         logger.error(f"Update progress error: {e}")
         raise HTTPException(status_code=500, detail="Error updating progress")
 
+# ============ BATCH HELPERS ============
+
+async def batch_create(repo: Repository, model, items: list, current_user: User) -> dict:
+    """Insert a validated list of items in one statement.
+
+    Each result is ``{"id", "status", "item"}`` in request order, with status
+    ``created`` or ``exists`` (an item with that id was already stored, for
+    example by an earlier attempt of the same sync). A batch the database
+    rejects (e.g. an unknown ``book_id``) is a 422.
+    """
+    now = datetime.now(timezone.utc).isoformat()
+    rows = []
+    for item in items:
+        row = item.model_dump(mode="json")
+        row["id"] = row.get("id") or str(uuid.uuid4())
+        row["user_id"] = current_user.id
+        row["created_at"] = now
+        rows.append(row)
+
+    if len({row["id"] for row in rows}) != len(rows):
+        raise HTTPException(status_code=400, detail="Duplicate ids in batch")
+
+    try:
+        inserted = {row["id"] for row in await repo.insert_new(rows)}
+    except Exception as e:
+        if not _is_row_error(e):
+            raise
+        logger.warning(f"Batch rejected by {repo.table}: {e}")
+        raise HTTPException(status_code=422, detail="Batch references a missing book or holds an invalid value")
+    return {"results": [
+        {"id": row["id"], "status": "created", "item": model(**row)} if row["id"] in inserted
+        else {"id": row["id"], "status": "exists", "item": None}
+        for row in rows
+    ]}
+
+async def batch_delete(repo: Repository, item_type: str, ids: List[uuid.UUID], current_user: User) -> dict:
+    """Delete the user's rows among ``ids`` in one statement.
+
+    Each result is ``{"id", "status"}`` with status ``deleted`` or ``not_found``.
+    """
+    ids = [str(item_id) for item_id in ids]
+    deleted = {row["id"] for row in await repo.delete(id=ids, user_id=current_user.id) or []}
+    await tombstones_repo.record(item_type, list(deleted), current_user.id)
+    return {"results": [
+        {"id": item_id, "status": "deleted" if item_id in deleted else "not_found"}
+        for item_id in ids
+    ]}
+
 # ============ BOOKMARK ROUTES ============
 
 @api_router.post("/bookmarks", response_model=Bookmark)
@@ -480,17 +1758,38 @@ async def create_bookmark(bookmark_data: BookmarkCreate, current_user: User = De
         new_bookmark["id"] = str(uuid.uuid4())
         new_bookmark["created_at"] = datetime.now(timezone.utc).isoformat()
         
-        supabase.table("bookmarks").insert(new_bookmark).execute()
+        await bookmarks_repo.insert(new_bookmark)
         return Bookmark(**new_bookmark)
     except Exception as e:
         logger.error(f"Create bookmark error: {e}")
         raise HTTPException(status_code=500, detail="Error creating bookmark")
 
+@api_router.post("/bookmarks/batch")
+async def create_bookmarks(batch: BookmarkBatch, current_user: User = Depends(get_current_user)):
+    try:
+        return FastJSONResponse(await batch_create(bookmarks_repo, Bookmark, batch.items, current_user))
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Create bookmarks batch error: {e}")
+        raise HTTPException(status_code=500, detail="Error creating bookmarks")
+
+@api_router.post("/bookmarks/batch/delete")
+async def delete_bookmarks(batch: BatchDelete, current_user: User = Depends(get_current_user)):
+    try:
+        return await batch_delete(bookmarks_repo, "bookmark", batch.ids, current_user)
+    except Exception as e:
+        logger.error(f"Delete bookmarks batch error: {e}")
+        raise HTTPException(status_code=500, detail="Error deleting bookmarks")
+
 @api_router.get("/bookmarks/{book_id}", response_model=List[Bookmark])
-async def get_bookmarks(book_id: str, current_user: User = Depends(get_current_user)):
+async def get_bookmarks(book_id: str, request: Request, current_user: User = Depends(get_current_user)):
+    async def load():
+        rows = await bookmarks_repo.find(user_id=current_user.id, book_id=book_id)
+        return [Bookmark(**b) for b in rows], {}
+
     try:
-        response = supabase.table("bookmarks").select("*").eq("user_id", current_user.id).eq("book_id", book_id).execute()
-        return [Bookmark(**b) for b in response.data]
+        return await cached_json(request, "bookmarks", current_user.id, book_id, load)
     except Exception as e:
         logger.error(f"Get bookmarks error: {e}")
         return []
@@ -498,12 +1797,13 @@ async def get_bookmarks(book_id: str, current_user: User = Depends(get_current_u
 @api_router.delete("/bookmarks/{bookmark_id}")
 async def delete_bookmark(bookmark_id: str, current_user: User = Depends(get_current_user)):
     try:
-        response = supabase.table("bookmarks").delete().eq("id", bookmark_id).eq("user_id", current_user.id).execute()
-        if not response.data:
+        deleted = await bookmarks_repo.delete(id=bookmark_id, user_id=current_user.id)
+        if not deleted:
              # Supabase delete returns data of deleted rows. If empty, nothing was deleted.
              # However, sometimes it might be empty if return representation is off. 
              # Assuming standard behavior, if we want to be strict we'd check first.
              pass 
+        await tombstones_repo.record("bookmark", [row["id"] for row in deleted or []], current_user.id)
         return {"message": "Bookmark deleted"}
     except Exception as e:
         logger.error(f"Delete bookmark error: {e}")
@@ -519,17 +1819,38 @@ async def create_annotation(annotation_data: AnnotationCreate, current_user: Use
         new_annotation["id"] = str(uuid.uuid4())
         new_annotation["created_at"] = datetime.now(timezone.utc).isoformat()
         
-        supabase.table("annotations").insert(new_annotation).execute()
+        await annotations_repo.insert(new_annotation)
         return Annotation(**new_annotation)
     except Exception as e:
         logger.error(f"Create annotation error: {e}")
         raise HTTPException(status_code=500, detail="Error creating annotation")
 
+@api_router.post("/annotations/batch")
+async def create_annotations(batch: AnnotationBatch, current_user: User = Depends(get_current_user)):
+    try:
+        return FastJSONResponse(await batch_create(annotations_repo, Annotation, batch.items, current_user))
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Create annotations batch error: {e}")
+        raise HTTPException(status_code=500, detail="Error creating annotations")
+
+@api_router.post("/annotations/batch/delete")
+async def delete_annotations(batch: BatchDelete, current_user: User = Depends(get_current_user)):
+    try:
+        return await batch_delete(annotations_repo, "annotation", batch.ids, current_user)
+    except Exception as e:
+        logger.error(f"Delete annotations batch error: {e}")
+        raise HTTPException(status_code=500, detail="Error deleting annotations")
+
 @api_router.get("/annotations/{book_id}", response_model=List[Annotation])
-async def get_annotations(book_id: str, current_user: User = Depends(get_current_user)):
+async def get_annotations(book_id: str, request: Request, current_user: User = Depends(get_current_user)):
+    async def load():
+        rows = await annotations_repo.find(user_id=current_user.id, book_id=book_id)
+        return [Annotation(**a) for a in rows], {}
+
     try:
-        response = supabase.table("annotations").select("*").eq("user_id", current_user.id).eq("book_id", book_id).execute()
-        return [Annotation(**a) for a in response.data]
+        return await cached_json(request, "annotations", current_user.id, book_id, load)
     except Exception as e:
         logger.error(f"Get annotations error: {e}")
         return []
@@ -537,7 +1858,8 @@ async def get_annotations(book_id: str, current_user: User = Depends(get_current
 @api_router.delete("/annotations/{annotation_id}")
 async def delete_annotation(annotation_id: str, current_user: User = Depends(get_current_user)):
     try:
-        supabase.table("annotations").delete().eq("id", annotation_id).eq("user_id", current_user.id).execute()
+        deleted = await annotations_repo.delete(id=annotation_id, user_id=current_user.id)
+        await tombstones_repo.record("annotation", [row["id"] for row in deleted or []], current_user.id)
         return {"message": "Annotation deleted"}
     except Exception as e:
         logger.error(f"Delete annotation error: {e}")
@@ -546,20 +1868,23 @@ async def delete_annotation(annotation_id: str, current_user: User = Depends(get
 # ============ PREFERENCES ROUTES ============
 
 @api_router.get("/preferences", response_model=ReadingPreferences)
-async def get_preferences(current_user: User = Depends(get_current_user)):
-    try:
-        response = supabase.table("reading_preferences").select("*").eq("user_id", current_user.id).execute()
+async def get_preferences(request: Request, current_user: User = Depends(get_current_user)):
+    async def load():
+        prefs_row = await preferences_repo.get(user_id=current_user.id)
         
-        if not response.data:
+        if not prefs_row:
             prefs = {
                 "id": str(uuid.uuid4()),
                 "user_id": current_user.id,
                 "created_at": datetime.now(timezone.utc).isoformat()
             }
-            supabase.table("reading_preferences").insert(prefs).execute()
-            return ReadingPreferences(**prefs)
+            await preferences_repo.insert(prefs)
+            return ReadingPreferences(**prefs), {}
         
-        return ReadingPreferences(**response.data[0])
+        return ReadingPreferences(**prefs_row), {}
+
+    try:
+        return await cached_json(request, "reading_preferences", current_user.id, None, load)
     except Exception as e:
         logger.error(f"Get preferences error: {e}")
         raise HTTPException(status_code=500, detail="Error fetching preferences")
@@ -568,103 +1893,1780 @@ async def get_preferences(current_user: User = Depends(get_current_user)):
 async def update_preferences(update: PreferencesUpdate, current_user: User = Depends(get_current_user)):
     try:
         update_data = {k: v for k, v in update.model_dump().items() if v is not None}
+        update_data["user_id"] = current_user.id
+        update_data["updated_at"] = datetime.now(timezone.utc).isoformat()
         
-        # Check if exists
-        check = supabase.table("reading_preferences").select("id").eq("user_id", current_user.id).execute()
-        
-        if check.data:
-            supabase.table("reading_preferences").update(update_data).eq("user_id", current_user.id).execute()
-        else:
-            update_data["user_id"] = current_user.id
-            supabase.table("reading_preferences").insert(update_data).execute()
-            
-        updated = supabase.table("reading_preferences").select("*").eq("user_id", current_user.id).execute()
-        return ReadingPreferences(**updated.data[0])
+        # Atomic insert-or-update on unique(user_id)
+        updated = await preferences_repo.upsert(update_data, on_conflict="user_id")
+        return ReadingPreferences(**updated[0])
     except Exception as e:
         logger.error(f"Update preferences error: {e}")
         raise HTTPException(status_code=500, detail="Error updating preferences")
 
+# ============ SYNC ROUTES ============
+
+def _parse_time(value: str) -> datetime:
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+@api_router.get("/sync")
+async def sync(since: Optional[str] = None, current_user: User = Depends(get_current_user)):
+    """Return the user's reading state changed since a previous sync.
+
+    Without ``since`` everything is returned. The response carries the
+    ``cursor`` to pass as ``since`` next time, and ``deleted`` tombstones
+    (``item_type`` of ``bookmark``, ``annotation`` or ``book``) for items
+    removed in the meantime.
+    """
+    since_time = None
+    if since is not None:
+        values = decode_cursor(since)
+        try:
+            since_time = _parse_time(values[0]).isoformat()
+        except (IndexError, TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    started = datetime.now(timezone.utc)
+    try:
+        progress_rows, bookmark_rows, annotation_rows, preferences, deleted = await asyncio.gather(
+            progress_repo.find_since("last_read_at", since_time, user_id=current_user.id),
+            bookmarks_repo.find_since("created_at", since_time, user_id=current_user.id),
+            annotations_repo.find_since("created_at", since_time, user_id=current_user.id),
+            preferences_repo.get(user_id=current_user.id),
+            tombstones_repo.since(current_user.id, since_time),
+        )
+    except Exception as e:
+        logger.error(f"Sync error: {e}")
+        raise HTTPException(status_code=500, detail="Error syncing reading state")
+
+    # Progress saves still in the write-behind buffer are newer than any stored row
+    progress = {row["book_id"]: progress_buffer.overlay(row) for row in progress_rows}
+    for pending in progress_buffer.pending_for_user(current_user.id):
+        progress[pending["book_id"]] = {**progress.get(pending["book_id"], {}), **pending}
+
+    if preferences and since_time:
+        changed_at = preferences.get("updated_at") or preferences.get("created_at")
+        if not changed_at or _parse_time(changed_at) < _parse_time(since_time):
+            preferences = None
+
+    return FastJSONResponse({
+        "progress": [ReadingProgress(**row) for row in progress.values()],
+        "bookmarks": [Bookmark(**row) for row in bookmark_rows],
+        "annotations": [Annotation(**row) for row in annotation_rows],
+        "preferences": ReadingPreferences(**preferences) if preferences else None,
+        "deleted": deleted,
+        "cursor": encode_cursor([(started - timedelta(seconds=SYNC_OVERLAP_SECONDS)).isoformat()]),
+    })
+
 import pypdf
-import base64
+
+# ============ EXTRACTION CACHE ============
+
+class ExtractionCache:
+    """Two-tier LRU cache of extracted book pages.
+
+    Entries are keyed by book id plus the sha256 of the stored file, so a
+    replaced file never serves stale pages. Each entry is persisted on disk as
+    ``<root>/<book_id>/<file_hash>/pages.ndjson`` (one page per line) with an
+    ``index.json`` of line offsets, which lets a page window be read with a
+    single seek. Images embedded in pages live next to it in ``images/``. Recently used entries are also kept in memory. Both tiers are
+    bounded in bytes and evict the least recently used entries first.
+
+    Original book files are kept under ``<root>/sources/<file_hash>.<format>``
+    so re-extractions neither download nor rewrite them.
+
+    When ``root`` cannot be written the cache moves to ``fallback_root``
+    (by default a directory under the system temp dir).
+    """
+
+    def __init__(self, root: Path, memory_limit: int, disk_limit: int, fallback_root: Optional[Path] = None):
+        self._root = Path(root)
+        self._fallback_root = Path(fallback_root or Path(tempfile.gettempdir()) / "extraction-cache")
+        self._root_checked = False
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self._memory: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def root(self) -> Path:
+        if not self._root_checked:
+            try:
+                self._root.mkdir(parents=True, exist_ok=True)
+                with tempfile.TemporaryFile(dir=self._root):
+                    pass
+            except OSError as e:
+                logger.warning(f"Extraction cache {self._root} is not writable ({e}), using {self._fallback_root}")
+                self._root = self._fallback_root
+            self._root_checked = True
+        return self._root
+
+    def _entry_dir(self, book_id: str, file_hash: str) -> Path:
+        return self.root / book_id / file_hash
+
+    def _read_index(self, entry: Path) -> Optional[List[int]]:
+        try:
+            return json.loads((entry / "index.json").read_text())["offsets"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def page_count(self, book_id: str, file_hash: str) -> Optional[int]:
+        with self._lock:
+            hit = self._memory.get((book_id, file_hash))
+            if hit is not None:
+                return len(hit[0])
+        offsets = self._read_index(self._entry_dir(book_id, file_hash))
+        return None if offsets is None else len(offsets) - 1
+
+    def get_pages(self, book_id: str, file_hash: str, start: int = 1, end: Optional[int] = None) -> Optional[List[dict]]:
+        """Return pages ``start..end`` (1-based, inclusive) or None on a miss."""
+        key = (book_id, file_hash)
+        with self._lock:
+            hit = self._memory.get(key)
+            if hit is not None:
+                self._memory.move_to_end(key)
+                return hit[0][start - 1:end]
+
+        lines = self.iter_lines(book_id, file_hash, start, end)
+        if lines is None:
+            return None
+        pages = [json.loads(line) for line in lines]
+
+        # Only whole books are promoted to memory; windows stay on disk
+        if start == 1 and end is None:
+            self._remember(key, pages, sum(len(json.dumps(p)) for p in pages))
+        return pages
+
+    def iter_lines(self, book_id: str, file_hash: str, start: int = 1, end: Optional[int] = None):
+        """Return an iterator over the NDJSON lines of a page window, or None on a miss.
+
+        Lines are read lazily from disk, so streaming a cached book holds one
+        page in memory at a time.
+        """
+        entry = self._entry_dir(book_id, file_hash)
+        offsets = self._read_index(entry)
+        if offsets is None:
+            return None
+        os.utime(entry / "index.json")
+
+        page_count = len(offsets) - 1
+        first = min(max(start, 1), page_count + 1) - 1
+        last = page_count if end is None else min(end, page_count)
+
+        def lines():
+            if last <= first:
+                return
+            with open(entry / "pages.ndjson", "rb") as f:
+                f.seek(offsets[first])
+                for _ in range(last - first):
+                    yield f.readline()
+
+        return lines()
+
+    def image_path(self, book_id: str, file_hash: str, page: int, index: int) -> Optional[Path]:
+        matches = list((self._entry_dir(book_id, file_hash) / "images").glob(f"{page}-{index}.*"))
+        return matches[0] if matches else None
+
+    def _source_path(self, file_hash: str, file_format: str) -> Path:
+        return self.root / "sources" / f"{file_hash}.{file_format}"
+
+    def get_source(self, file_hash: str, file_format: str) -> Optional[Path]:
+        path = self._source_path(file_hash, file_format)
+        try:
+            os.utime(path)  # Mark as recently used for eviction
+        except OSError:
+            return None
+        return path
+
+    def put_source(self, file_hash: str, file_format: str, data: Optional[bytes] = None, file_path: Optional[Path] = None) -> Path:
+        """Store a book file from ``data`` or by moving ``file_path`` into the cache."""
+        path = self._source_path(file_hash, file_format)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+        if file_path is not None:
+            shutil.move(str(file_path), tmp_path)
+        else:
+            tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+        self._evict_disk()
+        return path
+
+    def text_index(self, book_id: str, file_hash: str) -> Optional[dict]:
+        try:
+            return json.loads((self._entry_dir(book_id, file_hash) / "text-index.json").read_text())
+        except (OSError, ValueError):
+            return None
+
+    def put_text_index(self, book_id: str, file_hash: str, index: dict) -> None:
+        entry = self._entry_dir(book_id, file_hash)
+        entry.mkdir(parents=True, exist_ok=True)
+        tmp_path = entry / f"text-index.{uuid.uuid4().hex}.tmp"
+        tmp_path.write_text(json.dumps(index))
+        os.replace(tmp_path, entry / "text-index.json")
+
+    def put_image(self, book_id: str, file_hash: str, page: int, index: int, name: str, data: bytes) -> None:
+        images_dir = self._entry_dir(book_id, file_hash) / "images"
+        images_dir.mkdir(parents=True, exist_ok=True)
+        suffix = Path(name).suffix.lower() or ".jpg"
+        tmp_path = images_dir / f"{page}-{index}.{uuid.uuid4().hex}.tmp"
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, images_dir / f"{page}-{index}{suffix}")
+
+    def adopt(self, book_id: str, file_hash: str) -> bool:
+        """Reuse another book's entry for the same file, if one is cached.
+
+        Pages are re-encoded so image URLs point at ``book_id``; images are
+        hard-linked where the filesystem allows it.
+        """
+        for index in self.root.glob(f"*/{file_hash}/index.json"):
+            source = index.parent
+            source_book_id = source.parent.name
+            if source_book_id == book_id:
+                continue
+            try:
+                images = source / "images"
+                if images.is_dir():
+                    target = self._entry_dir(book_id, file_hash) / "images"
+                    target.mkdir(parents=True, exist_ok=True)
+                    for image in images.iterdir():
+                        try:
+                            os.link(image, target / image.name)
+                        except FileExistsError:
+                            pass
+                        except OSError:
+                            shutil.copyfile(image, target / image.name)
+
+                old_prefix = f"/api/books/{source_book_id}/"
+                new_prefix = f"/api/books/{book_id}/"
+                writer = self.writer(book_id, file_hash)
+                try:
+                    with open(source / "pages.ndjson", "rb") as f:
+                        for line in f:
+                            page = json.loads(line)
+                            page["images"] = [url.replace(old_prefix, new_prefix, 1) for url in page["images"]]
+                            writer.append(page)
+                except BaseException:
+                    writer.abort()
+                    raise
+                writer.commit()
+                return True
+            except OSError:
+                continue
+        return False
+
+    def writer(self, book_id: str, file_hash: str) -> "ExtractionCacheWriter":
+        return ExtractionCacheWriter(self, book_id, file_hash)
+
+    def put_pages(self, book_id: str, file_hash: str, pages: List[dict]) -> None:
+        writer = self.writer(book_id, file_hash)
+        for page in pages:
+            writer.append(page)
+        writer.commit()
+
+    def invalidate(self, book_id: str) -> None:
+        with self._lock:
+            for key in [k for k in self._memory if k[0] == book_id]:
+                self._memory_bytes -= self._memory.pop(key)[1]
+        shutil.rmtree(self.root / book_id, ignore_errors=True)
+
+    def _remember(self, key: tuple, pages: List[dict], size: int) -> None:
+        if size > self.memory_limit:
+            return
+        with self._lock:
+            previous = self._memory.pop(key, None)
+            if previous is not None:
+                self._memory_bytes -= previous[1]
+            self._memory[key] = (pages, size)
+            self._memory_bytes += size
+            while self._memory_bytes > self.memory_limit:
+                _, (_, evicted_size) = self._memory.popitem(last=False)
+                self._memory_bytes -= evicted_size
+
+    def _evict_disk(self) -> None:
+        entries = []
+        total = 0
+        # Every entry directory counts, complete or not: windowed extractions
+        # leave images and text indexes without an index.json
+        for entry in self.root.glob("*/*"):
+            if entry.parent.name == "sources" or not entry.is_dir():
+                continue
+            size, mtime = 0, 0.0
+            try:
+                for path in entry.rglob("*"):
+                    stat = path.stat()
+                    mtime = max(mtime, stat.st_mtime)
+                    if path.is_file():
+                        size += stat.st_size
+            except OSError:
+                continue
+            entries.append((mtime, size, entry))
+            total += size
+        for source in self.root.glob("sources/*"):
+            try:
+                stat = source.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, source))
+            total += stat.st_size
+
+        for _, size, entry in sorted(entries, key=lambda e: e[0]):
+            if total <= self.disk_limit:
+                break
+            total -= size
+            if entry.parent.name == "sources":
+                entry.unlink(missing_ok=True)
+                continue
+            shutil.rmtree(entry, ignore_errors=True)
+            try:
+                entry.parent.rmdir()  # The book's last entry
+            except OSError:
+                pass
+            with self._lock:
+                key = (entry.parent.name, entry.name)
+                if key in self._memory:
+                    self._memory_bytes -= self._memory.pop(key)[1]
+
+
+class ExtractionCacheWriter:
+    """Appends pages to a cache entry as they are extracted.
+
+    The entry only becomes visible on ``commit()``; an aborted or abandoned
+    writer (e.g. a client disconnecting mid-stream) leaves no partial entry.
+    """
+
+    def __init__(self, cache: ExtractionCache, book_id: str, file_hash: str):
+        self.cache = cache
+        self.book_id = book_id
+        self.file_hash = file_hash
+        self.entry = cache._entry_dir(book_id, file_hash)
+        self.entry.mkdir(parents=True, exist_ok=True)
+        self._tmp_pages = self.entry / f"pages.ndjson.{uuid.uuid4().hex}.tmp"
+        self._file = open(self._tmp_pages, "wb")
+        self._offsets = [0]
+
+    def append(self, page: dict) -> bytes:
+        """Write one page and return its encoded NDJSON line."""
+        line = json.dumps(page, ensure_ascii=False).encode("utf-8") + b"\n"
+        self._file.write(line)
+        self._offsets.append(self._file.tell())
+        return line
+
+    def commit(self) -> None:
+        self._file.close()
+        os.replace(self._tmp_pages, self.entry / "pages.ndjson")
+
+        # The index is written last: its presence marks the entry as complete.
+        tmp_index = self.entry / f"index.json.{uuid.uuid4().hex}.tmp"
+        tmp_index.write_text(json.dumps({"page_count": len(self._offsets) - 1, "offsets": self._offsets}))
+        os.replace(tmp_index, self.entry / "index.json")
+        self.cache._evict_disk()
+
+    def abort(self) -> None:
+        if not self._file.closed:
+            self._file.close()
+        if self._tmp_pages.exists():
+            os.unlink(self._tmp_pages)
+
+
+extraction_cache = ExtractionCache(
+    EXTRACTION_CACHE_DIR,
+    memory_limit=EXTRACTION_CACHE_MEMORY_MB * 1024 * 1024,
+    disk_limit=EXTRACTION_CACHE_DISK_MB * 1024 * 1024,
+)
+
+# ============ TEXT EXTRACTION ============
+
+IMAGE_MIME_TYPES = {".png": "image/png", ".webp": "image/webp", ".gif": "image/gif", ".svg": "image/svg+xml"}
+
+EPUB_NAMESPACES = {
+    "container": "urn:oasis:names:tc:opendocument:xmlns:container",
+    "opf": "http://www.idpf.org/2007/opf",
+    "ncx": "http://www.daisy.org/z3986/2005/ncx/",
+    "xhtml": "http://www.w3.org/1999/xhtml",
+    "epub": "http://www.idpf.org/2007/ops",
+}
+
+class _ChapterParser(HTMLParser):
+    """Collect the visible text and image references of an XHTML chapter."""
+
+    BLOCK_TAGS = {"p", "div", "br", "li", "tr", "h1", "h2", "h3", "h4", "h5", "h6", "blockquote", "section", "pre"}
+    SKIP_TAGS = {"head", "script", "style"}
+
+    def __init__(self):
+        super().__init__()
+        self.parts = []
+        self.images = []
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self._skip += 1
+        elif tag in self.BLOCK_TAGS:
+            self.parts.append("\n")
+        attrs = dict(attrs)
+        if tag == "img" and attrs.get("src"):
+            self.images.append(attrs["src"])
+        elif tag == "image" and (attrs.get("xlink:href") or attrs.get("href")):
+            self.images.append(attrs.get("xlink:href") or attrs.get("href"))
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS:
+            self._skip = max(0, self._skip - 1)
+        elif tag in self.BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if not self._skip:
+            self.parts.append(data)
+
+    def text(self) -> str:
+        lines = (" ".join(line.split()) for line in "".join(self.parts).splitlines())
+        return "\n".join(line for line in lines if line)
+
+@contextmanager
+def open_book_buffer(file_path: Path, file_format: str):
+    """Memory-map a book file read-only.
+
+    Parsers read straight from the OS page cache, so concurrent extractions
+    of the same source file share its pages instead of each holding a copy.
+    EPUBs get the plain file object, which zipfile needs to be seekable.
+    """
+    with open(file_path, "rb") as f:
+        if file_format == "epub":
+            yield f
+            return
+        if os.fstat(f.fileno()).st_size == 0:
+            # Empty files cannot be mapped
+            yield b""
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            yield buffer
+
+class EpubReader:
+    """Spine-ordered access to the chapters of an EPUB file.
+
+    Only the container, the OPF package and the central directory are read
+    up front; each chapter is inflated on demand when it is requested.
+    """
+
+    def __init__(self, file):
+        self.zip = zipfile.ZipFile(file)
+        container = ElementTree.fromstring(self.zip.read("META-INF/container.xml"))
+        rootfile = container.find(".//container:rootfile", EPUB_NAMESPACES)
+        self.opf_path = rootfile.get("full-path")
+        self.base = posixpath.dirname(self.opf_path)
+
+        package = ElementTree.fromstring(self.zip.read(self.opf_path))
+        self.manifest = {
+            item.get("id"): {
+                "href": self._resolve(self.base, item.get("href")),
+                "media_type": item.get("media-type"),
+                "properties": (item.get("properties") or "").split(),
+            }
+            for item in package.iterfind("opf:manifest/opf:item", EPUB_NAMESPACES)
+        }
+        spine = package.find("opf:spine", EPUB_NAMESPACES)
+        self.toc_id = spine.get("toc") if spine is not None else None
+        self.spine = [
+            self.manifest[ref.get("idref")]["href"]
+            for ref in (spine.iterfind("opf:itemref", EPUB_NAMESPACES) if spine is not None else [])
+            if ref.get("idref") in self.manifest and ref.get("linear") != "no"
+        ]
+        cover_meta = package.find("opf:metadata/opf:meta[@name='cover']", EPUB_NAMESPACES)
+        self.cover_id = cover_meta.get("content") if cover_meta is not None else None
+
+    @staticmethod
+    def _resolve(base: str, href: str) -> str:
+        return posixpath.normpath(posixpath.join(base, unquote(href.split("#")[0])))
+
+    def __len__(self) -> int:
+        return len(self.spine)
+
+    def close(self) -> None:
+        self.zip.close()
+
+    def chapter(self, index: int) -> dict:
+        """Return ``{"text", "images"}`` for spine item ``index`` (0-based).
+
+        ``images`` holds ``(archive name, bytes)`` pairs for referenced images.
+        """
+        href = self.spine[index]
+        parser = _ChapterParser()
+        parser.feed(self.zip.read(href).decode("utf-8", errors="replace"))
+        parser.close()
+
+        images = []
+        for src in parser.images:
+            name = self._resolve(posixpath.dirname(href), src)
+            try:
+                images.append((name, self.zip.read(name)))
+            except KeyError:
+                continue
+        return {"text": parser.text(), "images": images}
+
+    def cover(self) -> Optional[tuple]:
+        """Return ``(archive name, bytes)`` for the declared cover image."""
+        for item_id, item in self.manifest.items():
+            if item_id == self.cover_id or "cover-image" in item["properties"]:
+                if (item["media_type"] or "").startswith("image/"):
+                    return item["href"], self.zip.read(item["href"])
+        return None
+
+    def outline(self) -> List[dict]:
+        """Table of contents from the EPUB 3 nav document or the EPUB 2 NCX."""
+        chapter_pages = {href: i + 1 for i, href in enumerate(self.spine)}
+        entries = []
+
+        nav = next((item for item in self.manifest.values() if "nav" in item["properties"]), None)
+        if nav:
+            root = ElementTree.fromstring(self.zip.read(nav["href"]))
+            toc = next(
+                (el for el in root.iter(f"{{{EPUB_NAMESPACES['xhtml']}}}nav")
+                 if el.get(f"{{{EPUB_NAMESPACES['epub']}}}type") == "toc"),
+                None,
+            )
+
+            def walk_nav(ol, level):
+                for li in ol.iterfind("xhtml:li", EPUB_NAMESPACES):
+                    link = li.find("xhtml:a", EPUB_NAMESPACES)
+                    if link is not None:
+                        target = self._resolve(posixpath.dirname(nav["href"]), link.get("href", ""))
+                        title = " ".join("".join(link.itertext()).split())
+                        entries.append({"title": title, "page": chapter_pages.get(target), "level": level})
+                    for child in li.iterfind("xhtml:ol", EPUB_NAMESPACES):
+                        walk_nav(child, level + 1)
+
+            if toc is not None:
+                for ol in toc.iterfind("xhtml:ol", EPUB_NAMESPACES):
+                    walk_nav(ol, 0)
+                return entries
+
+        ncx = self.manifest.get(self.toc_id)
+        if ncx:
+            root = ElementTree.fromstring(self.zip.read(ncx["href"]))
+
+            def walk_ncx(parent, level):
+                for point in parent.iterfind("ncx:navPoint", EPUB_NAMESPACES):
+                    label = point.findtext("ncx:navLabel/ncx:text", "", EPUB_NAMESPACES)
+                    content = point.find("ncx:content", EPUB_NAMESPACES)
+                    target = self._resolve(posixpath.dirname(ncx["href"]), content.get("src", "")) if content is not None else None
+                    entries.append({"title": label.strip(), "page": chapter_pages.get(target), "level": level})
+                    walk_ncx(point, level + 1)
+
+            nav_map = root.find("ncx:navMap", EPUB_NAMESPACES)
+            if nav_map is not None:
+                walk_ncx(nav_map, 0)
+        return entries
+
+def page_image_url(book_id: str, page: int, index: int) -> str:
+    return f"/api/books/{book_id}/pages/{page}/images/{index}"
+
+TEXT_BOMS = [
+    (codecs.BOM_UTF32_LE, "utf-32-le"),
+    (codecs.BOM_UTF32_BE, "utf-32-be"),
+    (codecs.BOM_UTF8, "utf-8"),
+    (codecs.BOM_UTF16_LE, "utf-16-le"),
+    (codecs.BOM_UTF16_BE, "utf-16-be"),
+]
+
+def detect_text_encoding(sample: bytes) -> tuple:
+    """Guess ``(encoding, BOM length)`` from the first bytes of a text file."""
+    for bom, encoding in TEXT_BOMS:
+        if sample.startswith(bom):
+            return encoding, len(bom)
+    try:
+        # Incremental, so a character cut at the end of the sample is fine
+        codecs.getincrementaldecoder("utf-8")().decode(sample, final=False)
+        return "utf-8", 0
+    except UnicodeDecodeError:
+        return "latin-1", 0
+
+class TxtPaginator:
+    """Splits a plain-text book into pages on paragraph boundaries.
+
+    One pass over the file records the byte offset where each page starts,
+    so any page is then served with a single seek and read. Pages end at the
+    first blank line after ``page_chars`` characters, or at any line break
+    after twice that; longer lines are broken at whitespace.
+    """
+
+    SAMPLE_BYTES = 64 * 1024
+
+    def __init__(self, encoding: str, offsets: List[int]):
+        self.encoding = encoding
+        self.offsets = offsets
+
+    @classmethod
+    def open(cls, file_path: Path, book_id: Optional[str] = None, file_hash: Optional[str] = None, page_chars: Optional[int] = None) -> "TxtPaginator":
+        """Load the page index from the extraction cache, or build and store it."""
+        page_chars = page_chars or TXT_PAGE_CHARS
+        if book_id and file_hash:
+            index = extraction_cache.text_index(book_id, file_hash)
+            if index and index.get("page_chars") == page_chars:
+                return cls(index["encoding"], index["offsets"])
+
+        paginator = cls.build(file_path, page_chars)
+        if book_id and file_hash:
+            extraction_cache.put_text_index(book_id, file_hash, {
+                "page_chars": page_chars,
+                "encoding": paginator.encoding,
+                "offsets": paginator.offsets,
+            })
+        return paginator
+
+    @classmethod
+    def build(cls, file_path: Path, page_chars: Optional[int] = None) -> "TxtPaginator":
+        page_chars = max(1, page_chars or TXT_PAGE_CHARS)
+        with open(file_path, "rb") as f:
+            encoding, position = detect_text_encoding(f.read(cls.SAMPLE_BYTES))
+            f.seek(position)
+            offsets = [position]
+            size = 0
+            # surrogateescape keeps undecodable bytes, so re-encoding gives exact byte lengths
+            text = io.TextIOWrapper(f, encoding=encoding, errors="surrogateescape", newline="")
+            for line in text:
+                while line:
+                    piece = line
+                    if len(piece) > page_chars:
+                        piece = line[:line.rfind(" ", 0, page_chars) + 1 or page_chars]
+                    line = line[len(piece):]
+                    position += len(piece.encode(encoding, "surrogateescape"))
+                    size += len(piece)
+                    if size >= page_chars and (not piece.strip() or size >= 2 * page_chars):
+                        offsets.append(position)
+                        size = 0
+            text.detach()
+        if len(offsets) == 1 or position > offsets[-1]:
+            offsets.append(position)
+        return cls(encoding, offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def read(self, buffer, index: int) -> str:
+        """Return page ``index`` (0-based) from a mapped or in-memory copy of the file."""
+        raw = buffer[self.offsets[index]:self.offsets[index + 1]]
+        return raw.decode(self.encoding, errors="replace").strip("\r\n")
+
+def iter_pages(file_path: Path, file_format: str, book_id: str, file_hash: str, start: int = 1, end: Optional[int] = None):
+    """Yield extracted pages ``start..end`` (1-based, inclusive) one at a time.
+
+    Embedded images are written to the extraction cache and referenced by URL.
+    """
+    if file_format == "txt":
+        # Builds (or loads) the page index before the file is mapped
+        paginator = TxtPaginator.open(file_path, book_id, file_hash)
+
+    with open_book_buffer(file_path, file_format) as buffer:
+        if file_format == "pdf":
+            reader = pypdf.PdfReader(buffer)
+            last = len(reader.pages) if end is None else min(end, len(reader.pages))
+            for i in range(start - 1, last):
+                page = reader.pages[i]
+                page_text = page.extract_text()
+                page_images = []
+
+                try:
+                    for image_file in page.images:
+                        index = len(page_images) + 1
+                        extraction_cache.put_image(book_id, file_hash, i + 1, index, image_file.name, image_file.data)
+                        page_images.append(page_image_url(book_id, i + 1, index))
+                except Exception:
+                    pass # Ignore image errors
+
+                yield {
+                    "page": i + 1,
+                    "text": page_text,
+                    "images": page_images
+                }
+
+        elif file_format == "epub":
+            # One page per spine chapter
+            reader = EpubReader(buffer)
+            try:
+                last = len(reader) if end is None else min(end, len(reader))
+                for i in range(start - 1, last):
+                    chapter = reader.chapter(i)
+                    page_images = []
+                    for name, data in chapter["images"]:
+                        index = len(page_images) + 1
+                        extraction_cache.put_image(book_id, file_hash, i + 1, index, posixpath.basename(name), data)
+                        page_images.append(page_image_url(book_id, i + 1, index))
+                    yield {
+                        "page": i + 1,
+                        "text": chapter["text"],
+                        "images": page_images
+                    }
+            finally:
+                reader.close()
+
+        elif file_format == "txt":
+            last = len(paginator) if end is None else min(end, len(paginator))
+            for i in range(start - 1, last):
+                yield {
+                    "page": i + 1,
+                    "text": paginator.read(buffer, i),
+                    "images": []
+                }
+
+def count_pages(file_path: Path, file_format: str, book_id: Optional[str] = None, file_hash: Optional[str] = None) -> int:
+    if file_format == "pdf":
+        with open_book_buffer(file_path, file_format) as buffer:
+            return len(pypdf.PdfReader(buffer).pages)
+    if file_format == "epub":
+        with open_book_buffer(file_path, file_format) as buffer:
+            return len(EpubReader(buffer))
+    if file_format == "txt":
+        return len(TxtPaginator.open(file_path, book_id, file_hash))
+    return 0
+
+def read_outline(file_path: Path, file_format: str) -> List[dict]:
+    """Flatten the document outline into ``{"title", "page", "level"}`` entries."""
+    if file_format not in ("pdf", "epub"):
+        return []
+    with open_book_buffer(file_path, file_format) as buffer:
+        if file_format == "epub":
+            try:
+                return EpubReader(buffer).outline()
+            except Exception:
+                return []
+        return _pdf_outline(pypdf.PdfReader(buffer))
+
+def _pdf_outline(reader: "pypdf.PdfReader") -> List[dict]:
+    entries = []
+
+    def walk(items, level):
+        for item in items:
+            if isinstance(item, list):
+                walk(item, level + 1)
+                continue
+            try:
+                page = reader.get_destination_page_number(item) + 1
+            except Exception:
+                page = None
+            entries.append({"title": item.title, "page": page, "level": level})
+
+    try:
+        walk(reader.outline, 0)
+    except Exception:
+        return []
+    return entries
+
+def extract_cover(file_path: Path, file_format: str) -> Optional[tuple]:
+    """Return ``(image bytes, extension)`` for a cover thumbnail, if one is found.
+
+    Uses the EPUB's declared cover image, or the largest image on the first
+    PDF page, resized to a JPEG thumbnail. An image Pillow cannot decode
+    gives no cover.
+    """
+    try:
+        if file_format not in ("pdf", "epub"):
+            return None
+        with open_book_buffer(file_path, file_format) as buffer:
+            if file_format == "pdf":
+                images = pypdf.PdfReader(buffer).pages[0].images
+                image_file = max(images, key=lambda image: len(image.data), default=None)
+                cover = (image_file.name, image_file.data) if image_file else None
+            else:
+                cover = EpubReader(buffer).cover()
+    except Exception:
+        return None
+    if cover is None:
+        return None
+
+    name, data = cover
+    try:
+        from PIL import Image
+    except ImportError:
+        return data, Path(name).suffix.lower() or ".jpg"
+
+    try:
+        thumbnail = Image.open(io.BytesIO(data)).convert("RGB")
+        thumbnail.thumbnail((COVER_THUMBNAIL_WIDTH, COVER_THUMBNAIL_WIDTH * 2))
+        buffer = io.BytesIO()
+        thumbnail.save(buffer, format="JPEG", quality=85)
+    except Exception:
+        return None
+    return buffer.getvalue(), ".jpg"
+
+# ============ EXTRACTION ENGINE ============
+
+@contextmanager
+def _job_timeout(seconds: float):
+    """Abort the current job after ``seconds`` using SIGALRM.
+
+    Only available in the main thread of a POSIX process (i.e. pool workers);
+    elsewhere the caller's ``asyncio.wait_for`` is the only limit.
+    """
+    if not hasattr(signal, "SIGALRM") or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def on_timeout(signum, frame):
+        raise TimeoutError(f"Extraction job exceeded {seconds}s")
+
+    previous = signal.signal(signal.SIGALRM, on_timeout)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+def _count_pages_job(file_path: str, file_format: str, book_id: str, file_hash: str, timeout: float) -> int:
+    with _job_timeout(timeout):
+        return count_pages(Path(file_path), file_format, book_id, file_hash)
+
+def _ingest_job(file_path: str, file_format: str, book_id: str, file_hash: str, timeout: float) -> dict:
+    with _job_timeout(timeout):
+        path = Path(file_path)
+        return {
+            "total_pages": count_pages(path, file_format, book_id, file_hash),
+            "outline": read_outline(path, file_format),
+            "cover": extract_cover(path, file_format),
+        }
+
+def _extract_chunk_job(file_path: str, file_format: str, book_id: str, file_hash: str, start: int, end: int, timeout: float) -> tuple:
+    """Return the pages and the seconds spent extracting each of them.
+
+    Timings travel back with the pages because worker processes cannot
+    record metrics in the API process.
+    """
+    pages, durations = [], []
+    with _job_timeout(timeout):
+        started = time.perf_counter()
+        for page in iter_pages(Path(file_path), file_format, book_id, file_hash, start, end):
+            finished = time.perf_counter()
+            pages.append(page)
+            durations.append(finished - started)
+            started = finished
+    return pages, durations
+
+class ExtractionEngine:
+    """Runs book parsing off the event loop in a bounded worker pool.
+
+    Books are parsed in chunks of ``chunk_pages`` pages so the first pages are
+    available quickly and one large book can use several workers. At most
+    ``queue_limit`` extractions are admitted at once; callers beyond that get
+    a 503 instead of queueing indefinitely. A worker process that dies
+    breaks its pool; the jobs caught in it fail with a 503 and the next job
+    starts a fresh pool.
+    """
+
+    def __init__(self, workers: int, queue_limit: int, timeout: float, chunk_pages: int, processes: bool = True):
+        self.workers = max(1, workers)
+        self.processes = processes
+        self.queue_limit = queue_limit
+        self.timeout = timeout
+        self.chunk_pages = max(1, chunk_pages)
+        self.active = 0
+        self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.processes:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="extraction")
+        return self._executor
+
+    def acquire(self) -> None:
+        if self.active >= self.queue_limit:
+            raise HTTPException(
+                status_code=503,
+                detail="Extraction queue is full, try again shortly",
+                headers={"Retry-After": "5"},
+            )
+        self.active += 1
+
+    def release(self) -> None:
+        self.active -= 1
+
+    async def run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        executor = self._get_executor()
+        try:
+            future = loop.run_in_executor(executor, fn, *args, self.timeout)
+            # Workers enforce the timeout themselves; this is a backstop
+            return await asyncio.wait_for(future, self.timeout + 5)
+        except (asyncio.TimeoutError, TimeoutError):
+            raise HTTPException(status_code=504, detail="Extraction timed out")
+        except BrokenProcessPool as e:
+            logger.error(f"Extraction worker died: {e}")
+            if self._executor is executor:
+                executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+            raise HTTPException(
+                status_code=503,
+                detail="Extraction worker failed, try again shortly",
+                headers={"Retry-After": "1"},
+            )
+
+    async def iter_pages(self, file_path: Path, file_format: str, book_id: str, file_hash: str, start: int, end: Optional[int]):
+        """Yield pages ``start..end`` in order, keeping the next chunk in flight."""
+        if end is None:
+            end = await self.run(_count_pages_job, str(file_path), file_format, book_id, file_hash)
+
+        chunks = [(first, min(first + self.chunk_pages - 1, end)) for first in range(start, end + 1, self.chunk_pages)]
+        pending = None
+        for i, (first, last) in enumerate(chunks):
+            current = pending or asyncio.ensure_future(
+                self.run(_extract_chunk_job, str(file_path), file_format, book_id, file_hash, first, last)
+            )
+            pending = None
+            if i + 1 < len(chunks):
+                next_first, next_last = chunks[i + 1]
+                pending = asyncio.ensure_future(
+                    self.run(_extract_chunk_job, str(file_path), file_format, book_id, file_hash, next_first, next_last)
+                )
+            try:
+                pages, durations = await current
+            except BaseException:
+                if pending:
+                    pending.cancel()
+                raise
+            for duration in durations:
+                extraction_page_latency.observe(duration, format=file_format)
+            for page in pages:
+                yield page
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+extraction_engine = ExtractionEngine(
+    workers=EXTRACTION_WORKERS,
+    processes=EXTRACTION_PROCESSES,
+    queue_limit=EXTRACTION_QUEUE_LIMIT,
+    timeout=EXTRACTION_TIMEOUT_SECONDS,
+    chunk_pages=EXTRACTION_CHUNK_PAGES,
+)
+
+async def _extract_and_cache(book_id: str, file_hash: str, source_path: Path, file_format: str, start: int, end: Optional[int], holds_slot: bool = True):
+    """Yield NDJSON page lines as the extraction engine produces them.
+
+    Whole-book runs are written through to the extraction cache as they go;
+    windowed runs only parse the requested pages. Unless ``holds_slot`` is
+    False the caller must have acquired an engine slot, which is released
+    here once the generator is exhausted or closed.
+    """
+    writer = extraction_cache.writer(book_id, file_hash) if start == 1 and end is None else None
+    try:
+        async for page in extraction_engine.iter_pages(source_path, file_format, book_id, file_hash, start, end):
+            if writer:
+                yield writer.append(page)
+            else:
+                yield json.dumps(page, ensure_ascii=False).encode("utf-8") + b"\n"
+        if writer:
+            # Eviction walks the whole cache directory
+            await run_in_threadpool(writer.commit)
+            writer = None
+            try:
+                await run_in_threadpool(search_index.index_cached_pages, book_id, file_hash)
+            except Exception as index_err:
+                logger.warning(f"Search index error: {index_err}")
+    finally:
+        if holds_slot:
+            extraction_engine.release()
+        if writer:
+            writer.abort()
+
+# Serialises work on one source file or storage object on this host
+# (downloads, dedup checks, removals): key -> [lock, holders]
+_source_locks: dict = {}
+
+@asynccontextmanager
+async def _source_lock(key: str):
+    entry = _source_locks.setdefault(key, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _source_locks[key]
+
+async def fetch_source(book: dict) -> tuple:
+    """Return ``(file_hash, path)`` of the book's file in the source store.
+
+    Downloads it only when it is not stored yet, streamed to a temp file, and
+    backfills ``file_hash`` for books uploaded before hashing was introduced.
+    Concurrent requests for the same file wait for a single download.
+    """
+    file_hash = book.get("file_hash")
+    if file_hash:
+        # Local storage already holds the file on this host
+        path = storage.local_path(book["file_url"]) or extraction_cache.get_source(file_hash, book["file_format"])
+        if path is not None:
+            return file_hash, path
+
+    async with _source_lock(file_hash or book["file_url"]):
+        if file_hash:
+            path = extraction_cache.get_source(file_hash, book["file_format"])
+            if path is not None:
+                return file_hash, path
+
+        with tempfile.NamedTemporaryFile(delete=False, suffix=f".{book['file_format']}") as tmp_file:
+            tmp_path = Path(tmp_file.name)
+        try:
+            downloaded_hash = await storage.download_to(book["file_url"], tmp_path)
+            if not file_hash:
+                file_hash = downloaded_hash
+                await books_repo.update({"file_hash": file_hash}, id=book["id"])
+            path = await run_in_threadpool(extraction_cache.put_source, file_hash, book["file_format"], None, tmp_path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+    return file_hash, path
+
+async def _cached_pages_response(book_id: str, file_hash: str, start: int, end: Optional[int], stream: bool):
+    """A response for cached pages, or None on a miss. Disk reads run off the event loop."""
+    if stream:
+        lines = await run_in_threadpool(extraction_cache.iter_lines, book_id, file_hash, start, end)
+        if lines is None:
+            return None
+        # Iterated in the threadpool by StreamingResponse
+        return StreamingResponse(lines, media_type="application/x-ndjson")
+
+    pages = await run_in_threadpool(extraction_cache.get_pages, book_id, file_hash, start, end)
+    if pages is None:
+        return None
+    return {"pages": pages}
 
 @api_router.get("/books/{book_id}/extract-text")
-async def extract_book_text(book_id: str):
+async def extract_book_text(
+    book_id: str,
+    from_page: int = Query(1, alias="from", ge=1),
+    to_page: Optional[int] = Query(None, alias="to", ge=1),
+    stream: bool = False,
+):
+    """Extract a book's pages.
+
+    ``from``/``to`` select an inclusive page window. With ``stream=true`` the
+    pages are sent as NDJSON while they are being parsed instead of as one
+    ``{"pages": [...]}`` document.
+    """
+    if to_page is not None and to_page < from_page:
+        raise HTTPException(status_code=400, detail="'to' must be greater than or equal to 'from'")
+
     try:
         # Get book info
-        response = supabase.table("books").select("*").eq("id", book_id).execute()
-        if not response.data:
+        book = await books_repo.get(id=book_id)
+        if not book:
             raise HTTPException(status_code=404, detail="Book not found")
+
+        return await book_pages(book, from_page, to_page, stream)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Extract text error: {e}")
+        raise HTTPException(status_code=500, detail="Error extracting content")
+
+async def book_pages(book: dict, from_page: int, to_page: Optional[int], stream: bool = False):
+    """Pages ``from_page..to_page`` of ``book``, from cache or freshly extracted."""
+    book_id = book["id"]
+    file_hash = book.get("file_hash")
+
+    # Serve from cache without touching storage or pypdf
+    if file_hash:
+        cached = await _cached_pages_response(book_id, file_hash, from_page, to_page, stream)
+        if cached is None and await run_in_threadpool(extraction_cache.adopt, book_id, file_hash):
+            # Same file already extracted for another book (deduplicated upload)
+            try:
+                await run_in_threadpool(search_index.index_cached_pages, book_id, file_hash)
+            except Exception as index_err:
+                logger.warning(f"Search index error: {index_err}")
+            cached = await _cached_pages_response(book_id, file_hash, from_page, to_page, stream)
+        if cached is not None:
+            return cached
+
+    # Reject before downloading anything if the engine is saturated
+    extraction_engine.acquire()
+    lines = None
+
+    try:
+        had_hash = bool(file_hash)
+        file_hash, source_path = await fetch_source(book)
+        if not had_hash:
+            cached = await _cached_pages_response(book_id, file_hash, from_page, to_page, stream)
+            if cached is not None:
+                return cached
         
-        book = response.data[0]
-        # file_url is the path in bucket
-        file_path_in_bucket = book["file_url"]
-        
-        # Download to temp file
         try:
-            # Download bytes
-            res = supabase.storage.from_(STORAGE_BUCKET).download(file_path_in_bucket)
-            # res is bytes
-            
-            with tempfile.NamedTemporaryFile(delete=False, suffix=f".{book['file_format']}") as tmp_file:
-                tmp_file.write(res)
-                tmp_path = Path(tmp_file.name)
-                
-            content_data = []
-            
-            try:
-                if book["file_format"] == "pdf":
-                    reader = pypdf.PdfReader(str(tmp_path))
-                    for i, page in enumerate(reader.pages):
-                        page_text = page.extract_text()
-                        page_images = []
-                        
-                        try:
-                            for image_file in page.images:
-                                base64_str = base64.b64encode(image_file.data).decode('utf-8')
-                                mime_type = "image/jpeg"
-                                if image_file.name.lower().endswith('.png'):
-                                    mime_type = "image/png"
-                                elif image_file.name.lower().endswith('.webp'):
-                                    mime_type = "image/webp"
-                                page_images.append(f"data:{mime_type};base64,{base64_str}")
-                        except Exception:
-                            pass # Ignore image errors
-                            
-                        content_data.append({
-                            "page": i + 1,
-                            "text": page_text,
-                            "images": page_images
-                        })
-                        
-                elif book["file_format"] == "txt":
-                    with open(tmp_path, "rb") as f:
-                        raw = f.read()
-                        try:
-                            text = raw.decode("utf-8")
-                        except UnicodeDecodeError:
-                            text = raw.decode("latin-1")
-                            
-                    content_data.append({
-                        "page": 1,
-                        "text": text,
-                        "images": []
-                    })
-            finally:
-                # Cleanup temp file
-                if tmp_path.exists():
-                     os.unlink(tmp_path)
-                     
+            if not await run_in_threadpool(search_index.has_book, book_id):
+                # Books created before search existed get indexed on first extraction
+                await run_in_threadpool(search_index.index_book, book)
+        except Exception as index_err:
+            logger.warning(f"Search index error: {index_err}")
+
+        lines = _extract_and_cache(book_id, file_hash, source_path, book["file_format"], from_page, to_page)
+        if stream:
+            return StreamingResponse(lines, media_type="application/x-ndjson")
+
+        try:
+            content_data = [json.loads(line) async for line in lines]
+        finally:
+            await lines.aclose()
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Download/Process error: {e}")
+        raise HTTPException(status_code=500, detail="Error processing file from storage")
+    finally:
+        # The slot is handed over to the generator once it exists
+        if lines is None:
+            extraction_engine.release()
+
+    return {"pages": content_data}
+
+@api_router.get("/books/{book_id}/pages/{page}/images/{index}")
+async def get_page_image(book_id: str, page: int, index: int, request: Request):
+    """Serve one image embedded in a PDF page or EPUB chapter as raw bytes.
+
+    Images are content-addressed by the book's file hash, so they get a strong
+    ETag and can be cached by browsers and CDNs.
+    """
+    book = await books_repo.get("file_url, file_format, file_hash", id=book_id)
+    if not book or not book.get("file_hash"):
+        raise HTTPException(status_code=404, detail="Image not found")
+
+    file_hash = book["file_hash"]
+    headers = {
+        "ETag": f'"{file_hash[:16]}-{page}-{index}"',
+        "Cache-Control": "public, max-age=86400",
+    }
+    if etag_matches(request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+
+    image_path = extraction_cache.image_path(book_id, file_hash, page, index)
+    if image_path is None and book["file_format"] in ("pdf", "epub"):
+        # Evicted from the asset store: re-extract just this page
+        extraction_engine.acquire()
+        try:
+            _, source_path = await fetch_source(book)
+            await extraction_engine.run(_extract_chunk_job, str(source_path), book["file_format"], book_id, file_hash, page, page)
+        except HTTPException:
+            raise
         except Exception as e:
-            logger.error(f"Download/Process error: {e}")
-            raise HTTPException(status_code=500, detail="Error processing file from storage")
+            logger.error(f"Image extraction error: {e}")
+            raise HTTPException(status_code=500, detail="Error extracting image")
+        finally:
+            extraction_engine.release()
+        image_path = extraction_cache.image_path(book_id, file_hash, page, index)
 
-        return {"pages": content_data}
-        
+    if image_path is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+
+    return FileResponse(
+        image_path,
+        media_type=IMAGE_MIME_TYPES.get(image_path.suffix, "image/jpeg"),
+        headers=headers,
+    )
+
+BOOK_MIME_TYPES = {"pdf": "application/pdf", "epub": "application/epub+zip", "txt": "text/plain; charset=utf-8"}
+
+class FileRangeResponse(Response):
+    """206 Partial Content for bytes ``start..end`` (inclusive) of a file.
+
+    Uses the ASGI zero-copy extension (sendfile) when the server offers it,
+    otherwise reads the range in chunks off the event loop.
+    """
+
+    chunk_size = 256 * 1024
+
+    def __init__(self, path: Path, start: int, end: int, size: int, media_type: str, headers: dict):
+        super().__init__(status_code=206, headers=headers, media_type=media_type)
+        self.path = path
+        self.start = start
+        self.count = end - start + 1
+        self.headers["content-range"] = f"bytes {start}-{end}/{size}"
+        self.headers["content-length"] = str(self.count)
+
+    async def __call__(self, scope, receive, send) -> None:
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if scope["method"] == "HEAD":
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        with open(self.path, "rb") as f:
+            if "http.response.zerocopy" in scope.get("extensions", {}):
+                await send({"type": "http.response.zerocopy", "file": f.fileno(), "offset": self.start, "count": self.count})
+                return
+            f.seek(self.start)
+            remaining = self.count
+            while remaining > 0:
+                chunk = await run_in_threadpool(f.read, min(self.chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+        if remaining > 0:
+            # File shrank underneath us; end the response rather than hang
+            await send({"type": "http.response.body", "body": b""})
+
+def parse_byte_range(header: str, size: int) -> Optional[tuple]:
+    """``(start, end)`` for a single ``bytes=`` range, or None to send the whole file.
+
+    Raises 416 for a range that lies outside the file.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+        else:
+            # Suffix range: the last N bytes
+            start, end = max(0, size - int(last)), size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        raise HTTPException(status_code=416, detail="Range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+    return start, min(end, size - 1)
+
+@api_router.get("/books/{book_id}/file")
+async def get_book_file(book_id: str, request: Request):
+    """Serve the original book file with HTTP Range, ETag and Last-Modified.
+
+    Local storage serves the stored file directly; with Supabase the file is
+    fetched once into the extraction source store and served from there, so
+    PDF viewers can read it progressively.
+    """
+    book = await books_repo.get("id, file_url, file_format, file_hash", id=book_id)
+    if not book:
+        raise HTTPException(status_code=404, detail="Book not found")
+
+    try:
+        file_hash, path = await fetch_source(book)
+        stat = await run_in_threadpool(os.stat, path)
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Extract text error: {e}")
-        raise HTTPException(status_code=500, detail="Error extracting content")
+        logger.error(f"Book file error: {e}")
+        raise HTTPException(status_code=500, detail="Error reading book file")
+
+    etag = f'"{file_hash}"'
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "private, max-age=86400",
+    }
+
+    if request.headers.get("if-none-match"):
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers=headers)
+    elif request.headers.get("if-modified-since"):
+        try:
+            if int(stat.st_mtime) <= parsedate_to_datetime(request.headers["if-modified-since"]).timestamp():
+                return Response(status_code=304, headers=headers)
+        except (TypeError, ValueError):
+            pass
+
+    media_type = BOOK_MIME_TYPES.get(book["file_format"], "application/octet-stream")
+    range_header = request.headers.get("range")
+    # A stale If-Range means the client's partial copy is outdated: send everything
+    if range_header and request.headers.get("if-range", etag) in (etag, headers["Last-Modified"]):
+        byte_range = parse_byte_range(range_header, stat.st_size)
+        if byte_range:
+            return FileRangeResponse(path, *byte_range, stat.st_size, media_type, headers)
+
+    return FileResponse(path, media_type=media_type, headers=headers, stat_result=stat)
+
+# ============ READER SESSION ============
+
+@api_router.get("/books/{book_id}/session")
+async def get_book_session(
+    book_id: str,
+    window: int = Query(2, ge=0, le=50),
+    pages: bool = True,
+    current_user: User = Depends(get_current_user),
+):
+    """Everything the reader needs to open a book, in one response.
+
+    The book, progress, bookmarks, annotations and preferences are read
+    concurrently. With ``pages`` the pages within ``window`` of the saved
+    page are included; they are ``null`` when extraction is unavailable, so
+    the rest of the session still loads. Nothing is created here: missing
+    progress and preferences come back as defaults and are stored by the
+    first update.
+    """
+    try:
+        book, progress, bookmarks, annotations, preferences = await asyncio.gather(
+            books_repo.get(id=book_id),
+            progress_repo.get(user_id=current_user.id, book_id=book_id),
+            bookmarks_repo.find(user_id=current_user.id, book_id=book_id),
+            annotations_repo.find(user_id=current_user.id, book_id=book_id),
+            preferences_repo.get(user_id=current_user.id),
+        )
+    except Exception as e:
+        logger.error(f"Book session error: {e}")
+        raise HTTPException(status_code=500, detail="Error loading book")
+
+    if not book:
+        raise HTTPException(status_code=404, detail="Book not found")
+
+    if progress:
+        progress_buffer.remember(progress)
+        progress = progress_buffer.overlay(progress)
+    else:
+        progress = progress_buffer.pending(current_user.id, book_id) or {"user_id": current_user.id, "book_id": book_id}
+    progress = ReadingProgress(**progress)
+
+    page_data = None
+    if pages:
+        first = max(1, progress.current_page - window)
+        last = progress.current_page + window
+        if book.get("total_pages"):
+            last = max(first, min(last, book["total_pages"]))
+        try:
+            page_data = (await book_pages(book, first, last))["pages"]
+        except HTTPException as e:
+            logger.warning(f"Book session pages unavailable: {e.detail}")
+
+    return FastJSONResponse({
+        "book": Book(**book),
+        "progress": progress,
+        "bookmarks": [Bookmark(**row) for row in bookmarks],
+        "annotations": [Annotation(**row) for row in annotations],
+        "preferences": ReadingPreferences(**(preferences or {"user_id": current_user.id})),
+        "pages": page_data,
+    })
+
+# ============ INGESTION ============
+
+class IngestionQueue:
+    """Background jobs that derive book metadata right after upload.
+
+    Each job computes the real page count and outline, stores a cover
+    thumbnail when the book has none, updates the ``books`` row and warms the
+    extraction cache, so the first reader open is served from cache. Job
+    state is kept in memory for ``GET /api/books/{id}/ingestion``.
+    """
+
+    def __init__(self, workers: int, max_jobs: int = 1000):
+        self.workers = workers
+        self.max_jobs = max_jobs
+        self.jobs: "OrderedDict[str, dict]" = OrderedDict()
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks = []
+
+    def submit(self, book: dict, file_path: Path) -> dict:
+        job = {
+            "id": str(uuid.uuid4()),
+            "book_id": book["id"],
+            "status": "queued",
+            "error": None,
+            "result": None,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "finished_at": None,
+        }
+        self.jobs[book["id"]] = job
+        while len(self.jobs) > self.max_jobs:
+            _, dropped = self.jobs.popitem(last=False)
+            if dropped["status"] in ("queued", "running"):
+                self.jobs[dropped["book_id"]] = dropped
+                break
+
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        self._queue.put_nowait((job, book, file_path))
+        return job
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    def status(self, book_id: str) -> Optional[dict]:
+        return self.jobs.get(book_id)
+
+    async def _worker(self) -> None:
+        while True:
+            job, book, file_path = await self._queue.get()
+            job["status"] = "running"
+            try:
+                job["result"] = await self._ingest(book, file_path)
+                job["status"] = "done"
+            except Exception as e:
+                logger.error(f"Ingestion error for book {book['id']}: {e}")
+                job["status"] = "failed"
+                job["error"] = str(getattr(e, "detail", e))
+            finally:
+                job["finished_at"] = datetime.now(timezone.utc).isoformat()
+                if file_path.exists():
+                    os.unlink(file_path)
+                self._queue.task_done()
+
+    async def _ingest(self, book: dict, file_path: Path) -> dict:
+        book_id, file_hash, file_format = book["id"], book["file_hash"], book["file_format"]
+        # The spooled upload becomes the stored source, so extraction never downloads it
+        file_path = storage.local_path(book["file_url"]) or await run_in_threadpool(extraction_cache.put_source, file_hash, file_format, None, file_path)
+        info = await extraction_engine.run(_ingest_job, str(file_path), file_format, book_id, file_hash)
+
+        updates = {
+            "total_pages": info["total_pages"],
+            "total_chapters": sum(1 for entry in info["outline"] if entry["level"] == 0),
+            "outline": info["outline"],
+        }
+        await books_repo.update(updates, id=book_id)
+
+        if info["cover"] and not book.get("cover_url"):
+            data, extension = info["cover"]
+            cover_path = f"covers/{file_hash}{extension}"
+            try:
+                await storage.upload_bytes(cover_path, data, IMAGE_MIME_TYPES.get(extension, "image/jpeg"))
+                updates["cover_url"] = await storage.public_url(cover_path)
+                await books_repo.update({"cover_url": updates["cover_url"]}, id=book_id)
+            except Exception as e:
+                # Pages and outline are already stored; the book just has no cover
+                logger.warning(f"Cover upload error for {book_id}: {e}")
+
+        # Warm the text cache
+        if await run_in_threadpool(extraction_cache.page_count, book_id, file_hash) is None and not await run_in_threadpool(extraction_cache.adopt, book_id, file_hash):
+            async for _ in _extract_and_cache(book_id, file_hash, file_path, file_format, 1, None, holds_slot=False):
+                pass
+
+        return {k: v for k, v in updates.items() if k != "outline"}
+
+    def start(self) -> None:
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        if not self._tasks:
+            self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(max(1, self.workers))]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+
+ingestion_queue = IngestionQueue(INGESTION_WORKERS)
+
+@api_router.get("/books/{book_id}/ingestion")
+async def get_ingestion_status(book_id: str, current_user: User = Depends(get_current_user)):
+    job = ingestion_queue.status(book_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="No ingestion job for this book")
+    return job
+
+@api_router.get("/books/{book_id}/outline")
+async def get_book_outline(book_id: str, current_user: User = Depends(get_current_user)):
+    book = await books_repo.get("outline", id=book_id)
+    if not book:
+        raise HTTPException(status_code=404, detail="Book not found")
+    return {"outline": book.get("outline") or []}
+
+# ============ SEARCH ============
+
+class SearchIndex:
+    """Full-text index over book metadata and extracted page text.
+
+    Backed by SQLite FTS5 with BM25 ranking. Metadata is indexed when a book
+    is created (and backfilled from ``books`` on startup) and page text once
+    its extraction is cached; both are removed with the book. Visibility
+    columns are stored alongside so a search only returns books the caller
+    may read.
+
+    The database is opened on first use. When it is disabled or cannot be
+    created, writes are skipped and ``search`` returns None.
+    """
+
+    def __init__(self, path: Path, enabled: bool = True):
+        self.path = Path(path)
+        self.available = enabled
+        self._db = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        """The open database, or None when unavailable. Call with the lock held."""
+        if self._db is None and self.available:
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                db = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+                db.execute("pragma journal_mode=wal")
+                db.execute(
+                    "create virtual table if not exists book_fts using fts5("
+                    "title, author, description, book_id unindexed, is_public unindexed, uploaded_by unindexed, "
+                    "tokenize='unicode61 remove_diacritics 2')"
+                )
+                db.execute(
+                    "create virtual table if not exists page_fts using fts5("
+                    "text, book_id unindexed, page unindexed, "
+                    "tokenize='unicode61 remove_diacritics 2')"
+                )
+                self._db = db
+            except (OSError, sqlite3.Error) as e:
+                logger.warning(f"Search index unavailable at {self.path}: {e}")
+                self.available = False
+        return self._db
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            db = self._connect()
+            if db is None:
+                yield None
+                return
+            db.execute("begin")
+            try:
+                yield db
+            except BaseException:
+                db.execute("rollback")
+                raise
+            db.execute("commit")
+
+    @staticmethod
+    def _book_values(book: dict) -> tuple:
+        return (
+            book["title"], book["author"], book.get("description") or "",
+            book["id"], int(book.get("is_public", True)), book["uploaded_by"],
+        )
+
+    def index_book(self, book: dict) -> None:
+        with self._transaction() as db:
+            if db is None:
+                return
+            db.execute("delete from book_fts where book_id = ?", (book["id"],))
+            db.execute(
+                "insert into book_fts (title, author, description, book_id, is_public, uploaded_by) values (?, ?, ?, ?, ?, ?)",
+                self._book_values(book),
+            )
+
+    def add_missing_books(self, books: List[dict]) -> int:
+        """Index the metadata of ``books`` not indexed yet; returns how many."""
+        with self._transaction() as db:
+            if db is None:
+                return 0
+            indexed = {row[0] for row in db.execute("select book_id from book_fts")}
+            missing = [book for book in books if book["id"] not in indexed]
+            db.executemany(
+                "insert into book_fts (title, author, description, book_id, is_public, uploaded_by) values (?, ?, ?, ?, ?, ?)",
+                [self._book_values(book) for book in missing],
+            )
+            return len(missing)
+
+    async def backfill(self) -> None:
+        """Index books stored before the index existed, or uploaded on other hosts."""
+        if not self.available:
+            return
+        added = 0
+        try:
+            async for books in books_repo.scan("id, title, author, description, is_public, uploaded_by"):
+                added += await run_in_threadpool(self.add_missing_books, books)
+        except Exception as e:
+            logger.warning(f"Search backfill error: {e}")
+        if added:
+            logger.info(f"Search backfill indexed {added} books")
+
+    def has_book(self, book_id: str) -> bool:
+        with self._lock:
+            db = self._connect()
+            return db is not None and db.execute("select 1 from book_fts where book_id = ?", (book_id,)).fetchone() is not None
+
+    def index_pages(self, book_id: str, pages) -> None:
+        with self._transaction() as db:
+            if db is None:
+                return
+            db.execute("delete from page_fts where book_id = ?", (book_id,))
+            db.executemany(
+                "insert into page_fts (text, book_id, page) values (?, ?, ?)",
+                ((page["text"] or "", book_id, page["page"]) for page in pages),
+            )
+
+    def index_cached_pages(self, book_id: str, file_hash: str) -> None:
+        lines = extraction_cache.iter_lines(book_id, file_hash)
+        if lines is not None:
+            self.index_pages(book_id, (json.loads(line) for line in lines))
+
+    def remove_book(self, book_id: str) -> None:
+        with self._transaction() as db:
+            if db is None:
+                return
+            db.execute("delete from book_fts where book_id = ?", (book_id,))
+            db.execute("delete from page_fts where book_id = ?", (book_id,))
+
+    @staticmethod
+    def to_match_query(text: str) -> Optional[str]:
+        """Turn free text into an FTS5 query: all terms, last one as a prefix."""
+        terms = re.findall(r"\w+", text)
+        if not terms:
+            return None
+        quoted = [f'"{t}"' for t in terms]
+        quoted[-1] += "*"
+        return " ".join(quoted)
+
+    def search(self, text: str, user_id: str, limit: int = 20, offset: int = 0) -> Optional[List[dict]]:
+        match = self.to_match_query(text)
+        if match is None:
+            return []
+        # Metadata matches (page is null) are weighted above page text matches
+        sql = """
+            with visible as (
+                select book_id, title, author from book_fts
+                where is_public = 1 or uploaded_by = :user_id
+            )
+            select * from (
+                select b.book_id, b.title, b.author, null as page,
+                       snippet(book_fts, -1, '<mark>', '</mark>', '…', 12) as snippet,
+                       bm25(book_fts, 10.0, 5.0, 1.0) * 2 as score
+                from book_fts b
+                where book_fts match :match and (b.is_public = 1 or b.uploaded_by = :user_id)
+                union all
+                select p.book_id, v.title, v.author, p.page,
+                       snippet(page_fts, 0, '<mark>', '</mark>', '…', 12) as snippet,
+                       bm25(page_fts) as score
+                from page_fts p join visible v on v.book_id = p.book_id
+                where page_fts match :match
+            )
+            order by score
+            limit :limit offset :offset
+        """
+        with self._lock:
+            db = self._connect()
+            if db is None:
+                return None
+            rows = db.execute(
+                sql, {"match": match, "user_id": user_id, "limit": limit, "offset": offset}
+            ).fetchall()
+        return [
+            {"book_id": r[0], "title": r[1], "author": r[2], "page": r[3], "snippet": r[4], "score": -r[5]}
+            for r in rows
+        ]
+
+
+search_index = SearchIndex(SEARCH_INDEX_PATH, enabled=SEARCH_ENABLED)
+
+@api_router.get("/search")
+async def search_books(
+    q: str = Query(..., min_length=1),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    current_user: User = Depends(get_current_user),
+):
+    """Ranked search over titles, authors, descriptions and page text.
+
+    Hits with ``page: null`` matched the book's metadata. Without a local
+    index only metadata is searched, in Supabase, ordered by title.
+    """
+    hits = await run_in_threadpool(search_index.search, q, current_user.id, limit + 1, offset)
+    if hits is None:
+        try:
+            hits = await books_repo.search_metadata(q, current_user.id, limit + 1, offset)
+        except Exception as e:
+            logger.error(f"Search error: {e}")
+            raise HTTPException(status_code=500, detail="Error searching books")
+    next_offset = offset + limit if len(hits) > limit else None
+    return {"hits": hits[:limit], "next_offset": next_offset}
+
+@app.on_event("startup")
+async def start_background_tasks():
+    if PROGRESS_WRITE_BEHIND:
+        progress_buffer.start()
+    if INGESTION_ENABLED:
+        ingestion_queue.start()
+    # In the background: startup should not wait for the whole catalog
+    asyncio.ensure_future(search_index.backfill())
+
+@app.on_event("shutdown")
+async def shutdown_clients():
+    await progress_buffer.stop()
+    await ingestion_queue.stop()
+    extraction_engine.shutdown()
+    password_hasher.shutdown()
+    await supabase_http.aclose()
+
+# Middleware is pure ASGI rather than @app.middleware("http"): the latter
+# only passes http.response.body messages through, which would break
+# FileRangeResponse's zero-copy path
+
+class UploadSizeLimitMiddleware:
+    """Refuse declared over-limit uploads before the multipart body is read."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["method"] == "POST" and scope["path"] == "/api/books":
+            content_length = Headers(scope=scope).get("content-length")
+            # Allow 1 MB on top of the file for the other form fields
+            if content_length and content_length.isdigit() and int(content_length) > (MAX_UPLOAD_MB + 1) * 1024 * 1024:
+                response = JSONResponse(status_code=413, content={"detail": f"File exceeds the {MAX_UPLOAD_MB} MB limit"})
+                await response(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+class RequestMetricsMiddleware:
+    """Record request latency by route, and log a sample of slow requests."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timings = {}
+        token = request_timings.set(timings)
+        started = time.perf_counter()
+        recorded = False
+
+        def record(status_code: int):
+            nonlocal recorded
+            recorded = True
+            # Time to response start; streamed bodies are not included
+            elapsed = time.perf_counter() - started
+            route = scope.get("route")
+            request_latency.observe(
+                elapsed,
+                method=scope["method"],
+                route=route.path if route is not None else "unmatched",
+                status=status_code,
+            )
+            if SLOW_REQUEST_SECONDS and elapsed >= SLOW_REQUEST_SECONDS and random.random() < SLOW_REQUEST_SAMPLE_RATE:
+                breakdown = ", ".join(f"{name}={total:.3f}s/{count}" for name, (total, count) in timings.items())
+                logger.warning(f"Slow request: {scope['method']} {scope['path']} {status_code} {elapsed:.3f}s [{breakdown}]")
+
+        async def send_recorded(message):
+            if message["type"] == "http.response.start" and not recorded:
+                record(message["status"])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_recorded)
+        finally:
+            if not recorded:
+                record(500)
+            request_timings.reset(token)
+
+app.add_middleware(UploadSizeLimitMiddleware)
+app.add_middleware(RequestMetricsMiddleware)
+
+@api_router.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
+
+metrics.gauge("extraction_jobs_active", "Extractions admitted to the engine.", lambda: extraction_engine.active)
+metrics.gauge("password_hash_calls", "Password hashing calls by state.", lambda: {
+    "active": password_hasher.active,
+    "queued": password_hasher.stats()["queued"],
+}, label="state")
+metrics.gauge("password_hash_rejected", "Password hashing calls rejected as over capacity.", lambda: password_hasher.rejected)
+metrics.gauge("progress_writes_pending", "Reading progress updates waiting to be flushed.", lambda: len(progress_buffer._changes))
+metrics.gauge("ingestion_jobs", "Ingestion jobs by status.", lambda: {
+    status: sum(1 for job in ingestion_queue.jobs.values() if job["status"] == status)
+    for status in ("queued", "running", "done", "failed")
+}, label="status")
 
 # Include router
 app.include_router(api_router)
@@ -682,11 +3684,14 @@ app.add_middleware(
     ] + os.environ.get('CORS_ORIGINS', '').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
-# Remove static mount for uploads since we use Supabase now, 
-# but keep it in case someone really wants local for testing if configured differently (omitted here for cleanliness)
-# app.mount("/uploads", StaticFiles(directory=UPLOAD_DIR), name="uploads")
+# Local storage serves its objects (e.g. covers) statically; book files are
+# better fetched through /api/books/{id}/file, which supports ranges
+if STORAGE_BACKEND == "local":
+    LOCAL_STORAGE_DIR.mkdir(parents=True, exist_ok=True)
+    app.mount("/uploads", StaticFiles(directory=LOCAL_STORAGE_DIR), name="uploads")
 
 logging.basicConfig(
     level=logging.INFO,
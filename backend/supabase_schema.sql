@@ -20,10 +20,12 @@ create table books (
   file_url text not null,
   file_format text not null,
   file_size bigint not null,
+  file_hash text,
   language text default 'pt',
   category text default 'fiction',
   total_pages integer default 0,
   total_chapters integer default 0,
+  outline jsonb,
   rating float default 0.0,
   reviews integer default 0,
   trending boolean default false,
@@ -86,9 +88,20 @@ create table reading_preferences (
   auto_night_mode boolean default true,
   page_turn_animation boolean default true,
   created_at timestamp with time zone default timezone('utc'::text, now()) not null,
+  updated_at timestamp with time zone,
   unique(user_id)
 );
 
+-- Deletion tombstones for delta sync (user_id null = applies to every user)
+create table deleted_items (
+  id uuid primary key default uuid_generate_v4(),
+  user_id uuid references users(id) on delete cascade,
+  item_type text not null,
+  item_id uuid not null,
+  deleted_at timestamp with time zone default timezone('utc'::text, now()) not null
+);
+create index deleted_items_user_deleted_at on deleted_items (user_id, deleted_at);
+
 -- RLS Policies (Optional but recommended - enabling basic access for now)
 alter table users enable row level security;
 alter table books enable row level security;
@@ -96,6 +109,7 @@ alter table reading_progress enable row level security;
 alter table bookmarks enable row level security;
 alter table annotations enable row level security;
 alter table reading_preferences enable row level security;
+alter table deleted_items enable row level security;
 
 -- Create policies to allow service_role to do everything (our backend uses service key usually, or we can just disable RLS for simplicity if using direct connection)
 -- For this implementation, we will disable RLS to avoid permission issues since the backend handles auth logic.
@@ -105,3 +119,4 @@ alter table reading_progress disable row level security;
 alter table bookmarks disable row level security;
 alter table annotations disable row level security;
 alter table reading_preferences disable row level security;
+alter table deleted_items disable row level security;
@@ -39,17 +39,15 @@ const ReaderPage = ({ user }) => {
 
   const fetchData = async () => {
     try {
-      const [bookRes, progressRes, bookmarksRes, prefsRes] = await Promise.all([
-        api.get(`/books/${bookId}`),
-        api.get(`/reading/progress/${bookId}`),
-        api.get(`/bookmarks/${bookId}`),
-        api.get("/preferences"),
-      ]);
+      // One round-trip for everything the reader needs; the text view
+      // still loads the full extracted content on demand
+      const res = await api.get(`/books/${bookId}/session`, { params: { pages: false } });
 
-      setBook(bookRes.data);
-      setProgress(progressRes.data);
-      setBookmarks(bookmarksRes.data);
-      setPreferences(prefsRes.data);
+      setBook(res.data.book);
+      setProgress(res.data.progress);
+      setBookmarks(res.data.bookmarks);
+      setPreferences(res.data.preferences);
+    } catch (error) {
       console.error(error);
       toast.error("Erro ao carregar livro");
       navigate("/library");
@@ -338,7 +336,7 @@ const ReaderPage = ({ user }) => {
                         {page.images && page.images.map((img, imgIdx) => (
                             <img 
                                 key={imgIdx} 
-                                src={img} 
+                                src={`${import.meta.env.VITE_BACKEND_URL || "http://localhost:8000"}${img}`} 
                                 alt={`Ilustração página ${page.page}`} 
                                 className="max-w-full h-auto mx-auto my-6 rounded-lg shadow-md"
                                 style={{ maxHeight: '80vh' }}
@@ -352,14 +350,14 @@ const ReaderPage = ({ user }) => {
            </div>
         ) : book.file_format === 'pdf' ? (
           <iframe 
-            src={`${import.meta.env.VITE_BACKEND_URL || "http://localhost:8000"}${book.file_url}`}
+            src={`${import.meta.env.VITE_BACKEND_URL || "http://localhost:8000"}/api/books/${bookId}/file`}
             className="w-full h-full"
             title="PDF Viewer"
           />
         ) : book.file_format === 'epub' ? (
           <div className="h-full relative">
             <ReactReader
-              url={`${import.meta.env.VITE_BACKEND_URL || "http://localhost:8000"}${book.file_url}`}
+              url={`${import.meta.env.VITE_BACKEND_URL || "http://localhost:8000"}/api/books/${bookId}/file`}
               location={location}
               locationChanged={handleLocationChanged}
               epubInitOptions={{
@@ -378,7 +376,7 @@ const ReaderPage = ({ user }) => {
           <div className="flex flex-col items-center justify-center h-full text-center p-8">
             <p className="text-xl mb-4">Formato {book.file_format} não suportado para leitura online.</p>
             <Button 
-              onClick={() => window.open(`${import.meta.env.VITE_BACKEND_URL || "http://localhost:8000"}${book.file_url}`, '_blank')}
+              onClick={() => window.open(`${import.meta.env.VITE_BACKEND_URL || "http://localhost:8000"}/api/books/${bookId}/file`, '_blank')}
             >
               Baixar Arquivo
             </Button>
@@ -0,0 +1,418 @@
+"""Load tests for the API hot paths against an in-process Supabase stand-in.
+
+Run from the repository root:
+
+    python -m tests.benchmark                        # every scenario
+    python -m tests.benchmark login library -n 0.2   # a subset, 20% of the load
+    python -m tests.benchmark --json results.json
+    python -m tests.benchmark --baseline results.json --tolerance 0.25
+
+Requests go through the real ASGI app (httpx.ASGITransport, no network) with
+``server.supabase`` replaced by ``tests.fake_supabase.FakeSupabase``, which
+waits a seeded log-normal delay on every query and storage call. Each
+scenario reports p50/p95/p99 latency, throughput and Supabase calls per
+request. With ``--baseline`` the run fails (exit code 1) when a scenario's
+p95 grows, or its throughput drops, by more than ``--tolerance``.
+
+Scenarios:
+
+- ``login``: a burst of concurrent logins (bcrypt verification).
+- ``progress``: a flood of page-turn progress updates from many readers.
+- ``library``: readers paging through a 10k-book library with the cursor.
+- ``extraction``: concurrent cold extraction of every book in ``backend/uploads``.
+- ``lists``: unpaginated large lists (the whole library, thousands of
+  bookmarks and annotations, a full sync), with the response cache off so
+  every request pays for validation and serialization.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from contextlib import ExitStack
+from pathlib import Path
+from typing import List, Optional
+from unittest.mock import patch
+
+import httpx
+
+from tests.fake_supabase import FakeSupabase, Latency
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+UPLOADS_DIR = ROOT_DIR / "backend" / "uploads"
+PASSWORD = "benchmark-password"
+
+
+class Result:
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies: List[float] = []
+        self.errors = 0
+        self.elapsed = 0.0
+        self.supabase_calls = 0
+
+    def percentile(self, p: float) -> float:
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        # Nearest-rank percentile
+        index = max(0, min(len(ordered) - 1, int(-(-p * len(ordered) // 100)) - 1))
+        return ordered[index]
+
+    def summary(self) -> dict:
+        requests = len(self.latencies) + self.errors
+        return {
+            "requests": requests,
+            "errors": self.errors,
+            "p50_ms": round(self.percentile(50) * 1000, 2),
+            "p95_ms": round(self.percentile(95) * 1000, 2),
+            "p99_ms": round(self.percentile(99) * 1000, 2),
+            "throughput_rps": round(requests / self.elapsed, 1) if self.elapsed else 0.0,
+            "supabase_calls_per_request": round(self.supabase_calls / requests, 2) if requests else 0.0,
+        }
+
+
+async def _timed(result: Result, send, expected: int = 200) -> Optional[httpx.Response]:
+    started = time.perf_counter()
+    try:
+        response = await send()
+    except Exception:
+        result.errors += 1
+        return None
+    if response.status_code != expected:
+        result.errors += 1
+        return response
+    result.latencies.append(time.perf_counter() - started)
+    return response
+
+
+async def _concurrently(count: int, concurrency: int, job) -> None:
+    """Run ``job(i)`` for every i in ``range(count)``, ``concurrency`` at a time."""
+    indexes = iter(range(count))
+
+    async def worker():
+        for i in indexes:
+            await job(i)
+
+    await asyncio.gather(*(worker() for _ in range(max(1, min(concurrency, count)))))
+
+
+def _users(fake: FakeSupabase, count: int, password_hash: str = "") -> List[dict]:
+    import server
+    users = [
+        {
+            "id": f"user-{i}",
+            "email": f"reader{i}@example.com",
+            "username": f"reader{i}",
+            "password_hash": password_hash,
+            "created_at": "2024-01-01T00:00:00+00:00",
+        }
+        for i in range(count)
+    ]
+    fake.seed("users", users)
+    for user in users:
+        user["headers"] = {"Authorization": f"Bearer {server.create_access_token(user['id'])}"}
+    return users
+
+
+def _scaled(value: int, options) -> int:
+    return max(1, int(value * options.scale))
+
+
+# ---------------------------------------------------------------------------
+# Scenarios
+# ---------------------------------------------------------------------------
+
+async def login_burst(client: httpx.AsyncClient, fake: FakeSupabase, options) -> Result:
+    import server
+    result = Result("login")
+    # One hash for everyone: seeding should not cost as much as the burst
+    users = _users(fake, _scaled(options.users, options), server.hash_password(PASSWORD))
+    total = _scaled(options.logins, options)
+
+    async def login(i):
+        user = users[i % len(users)]
+        await _timed(result, lambda: client.post("/api/auth/login", json={"email": user["email"], "password": PASSWORD}))
+
+    started = time.perf_counter()
+    await _concurrently(total, options.concurrency, login)
+    result.elapsed = time.perf_counter() - started
+    return result
+
+
+async def progress_flood(client: httpx.AsyncClient, fake: FakeSupabase, options) -> Result:
+    import server
+    result = Result("progress")
+    users = _users(fake, _scaled(options.users, options))
+    total = _scaled(options.progress_updates, options)
+    books_per_user = 3
+
+    async def turn_page(i):
+        user = users[i % len(users)]
+        book = f"book-{(i // len(users)) % books_per_user}"
+        page = i // (len(users) * books_per_user) + 1
+        await _timed(result, lambda: client.put(
+            f"/api/reading/progress/{book}",
+            json={"current_page": page, "percentage_complete": min(100.0, page / 3)},
+            headers=user["headers"],
+        ))
+
+    if server.PROGRESS_WRITE_BEHIND:
+        server.progress_buffer.start()
+    started = time.perf_counter()
+    await _concurrently(total, options.concurrency, turn_page)
+    # Buffered updates are only done once they reach the database
+    await server.progress_buffer.stop()
+    result.elapsed = time.perf_counter() - started
+    return result
+
+
+def _seed_books(fake: FakeSupabase, count: int, users: List[dict]) -> None:
+    categories = ["fiction", "science", "history", "poetry", "technology"]
+    fake.seed("books", [
+        {
+            "id": f"book-{i:06d}",
+            "title": f"Livro {i}",
+            "author": f"Autor {i % 500}",
+            "description": "Uma descrição curta do livro. " * 4,
+            "cover_url": f"https://covers.example.com/{i}.jpg",
+            "file_url": f"{i:064x}.pdf",
+            "file_format": "pdf",
+            "file_size": 1_000_000 + i,
+            "category": categories[i % len(categories)],
+            "rating": round((i * 37 % 50) / 10, 1),
+            "reviews": i % 1000,
+            # A tenth are private uploads spread over the readers
+            "is_public": i % 10 != 0,
+            "uploaded_by": f"user-{i % len(users)}",
+            "created_at": f"2024-{1 + i % 12:02d}-{1 + i % 28:02d}T{i % 24:02d}:{i % 60:02d}:00+00:00",
+        }
+        for i in range(count)
+    ])
+
+
+async def library_listing(client: httpx.AsyncClient, fake: FakeSupabase, options) -> Result:
+    result = Result("library")
+    users = _users(fake, _scaled(options.readers, options))
+    _seed_books(fake, _scaled(options.books, options), users)
+
+    async def browse(i):
+        user = users[i]
+        cursor = None
+        for _ in range(options.library_pages):
+            params = {"limit": options.page_size, "fields": "id,title,author,cover_url"}
+            if cursor:
+                params["cursor"] = cursor
+            response = await _timed(result, lambda: client.get("/api/books", params=params, headers=user["headers"]))
+            cursor = response.headers.get("x-next-cursor") if response is not None else None
+            if not cursor:
+                break
+
+    started = time.perf_counter()
+    await _concurrently(len(users), options.concurrency, browse)
+    result.elapsed = time.perf_counter() - started
+    return result
+
+
+async def concurrent_extraction(client: httpx.AsyncClient, fake: FakeSupabase, options) -> Result:
+    import server
+    result = Result("extraction")
+    users = _users(fake, 1)
+    sources = sorted(p for p in Path(options.uploads).iterdir() if p.suffix.lower() in (".pdf", ".epub", ".txt"))
+    books = []
+    for path in sources:
+        fake.objects.setdefault(server.STORAGE_BUCKET, {})[path.name] = path.read_bytes()
+        books.append({
+            "id": f"book-{path.stem}",
+            "title": path.stem,
+            "author": "Benchmark",
+            "file_url": path.name,
+            "file_format": path.suffix.lower().lstrip("."),
+            "file_size": path.stat().st_size,
+            "is_public": True,
+            "uploaded_by": users[0]["id"],
+        })
+    fake.seed("books", books)
+
+    async def extract(i):
+        book = books[i % len(books)]
+        await _timed(result, lambda: client.get(f"/api/books/{book['id']}/extract-text", headers=users[0]["headers"], timeout=None))
+
+    started = time.perf_counter()
+    for _ in range(options.extraction_rounds):
+        # Cold every round: pages are dropped, downloaded sources are kept
+        for book in books:
+            server.extraction_cache.invalidate(book["id"])
+        await _concurrently(len(books), len(books), extract)
+    result.elapsed = time.perf_counter() - started
+    return result
+
+
+async def large_lists(client: httpx.AsyncClient, fake: FakeSupabase, options) -> Result:
+    import server
+    result = Result("lists")
+    users = _users(fake, 1)
+    user_id = users[0]["id"]
+    _seed_books(fake, _scaled(options.books, options), users)
+    items = _scaled(options.list_items, options)
+    fake.seed("bookmarks", [
+        {"id": f"bm-{i}", "user_id": user_id, "book_id": "book-000000", "position": str(i), "note": f"Nota {i}",
+         "created_at": "2024-05-01T00:00:00+00:00"}
+        for i in range(items)
+    ])
+    fake.seed("annotations", [
+        {"id": f"an-{i}", "user_id": user_id, "book_id": "book-000000", "highlighted_text": "Trecho destacado " * 5,
+         "position_start": str(i), "note": f"Comentário {i}", "created_at": "2024-05-01T00:00:00+00:00"}
+        for i in range(items)
+    ])
+    paths = ["/api/books", "/api/bookmarks/book-000000", "/api/annotations/book-000000", "/api/sync"]
+
+    async def fetch(i):
+        await _timed(result, lambda: client.get(paths[i % len(paths)], headers=users[0]["headers"]))
+
+    with patch.object(server, "response_cache", server.ResponseCache(0)):
+        started = time.perf_counter()
+        await _concurrently(_scaled(options.list_requests, options), options.list_concurrency, fetch)
+        result.elapsed = time.perf_counter() - started
+    return result
+
+
+SCENARIOS = {
+    "login": login_burst,
+    "progress": progress_flood,
+    "library": library_listing,
+    "extraction": concurrent_extraction,
+    "lists": large_lists,
+}
+
+
+# ---------------------------------------------------------------------------
+# Runner
+# ---------------------------------------------------------------------------
+
+async def run(names: List[str], options) -> List[Result]:
+    import server
+    results = []
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+        for name in names:
+            fake = FakeSupabase(
+                latency=Latency(options.latency_ms, options.latency_sigma),
+                storage_latency=Latency(options.storage_latency_ms, options.latency_sigma, options.storage_mbps),
+                seed=options.seed,
+            )
+            with ExitStack() as stack:
+                stack.enter_context(patch.object(server, "supabase", fake))
+                stack.enter_context(patch.object(server, "supabase_http", fake.http_client()))
+                stack.enter_context(patch.object(server, "storage", server.SupabaseStorage(server.STORAGE_BUCKET)))
+                # Every scenario starts with cold user lookups
+                stack.enter_context(patch.object(server, "principal_cache", server.PrincipalCache(server.PRINCIPAL_CACHE_TTL_SECONDS)))
+                result = await SCENARIOS[name](client, fake, options)
+            result.supabase_calls = sum(fake.calls.values())
+            results.append(result)
+    return results
+
+
+def compare(results: List[Result], baseline: dict, tolerance: float) -> List[str]:
+    """Describe every scenario that regressed against ``baseline``."""
+    regressions = []
+    for result in results:
+        before = baseline.get(result.name)
+        if not before:
+            continue
+        after = result.summary()
+        if after["errors"] > before["errors"]:
+            regressions.append(f"{result.name}: {after['errors']} errors (was {before['errors']})")
+        if before["p95_ms"] and after["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{result.name}: p95 {after['p95_ms']} ms (was {before['p95_ms']} ms)")
+        if after["throughput_rps"] < before["throughput_rps"] / (1 + tolerance):
+            regressions.append(f"{result.name}: {after['throughput_rps']} req/s (was {before['throughput_rps']} req/s)")
+    return regressions
+
+
+def format_table(results: List[Result]) -> str:
+    columns = ["requests", "errors", "p50_ms", "p95_ms", "p99_ms", "throughput_rps", "supabase_calls_per_request"]
+    headers = ["scenario", "requests", "errors", "p50 ms", "p95 ms", "p99 ms", "req/s", "db calls/req"]
+    rows = [[r.name] + [str(r.summary()[c]) for c in columns] for r in results]
+    widths = [max(len(row[i]) for row in [headers] + rows) for i in range(len(headers))]
+    return "\n".join(
+        "  ".join(cell.ljust(widths[i]) if i == 0 else cell.rjust(widths[i]) for i, cell in enumerate(row))
+        for row in [headers] + rows
+    )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("scenarios", nargs="*", help=f"Scenarios to run: {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument("-n", "--scale", type=float, default=1.0, help="Multiplier for users, requests and books")
+    parser.add_argument("-c", "--concurrency", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--latency-ms", type=float, default=8.0, help="Median Supabase query latency")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="Spread of the latency distribution")
+    parser.add_argument("--storage-latency-ms", type=float, default=25.0, help="Median storage call latency")
+    parser.add_argument("--storage-mbps", type=float, default=200.0, help="Storage download bandwidth")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--progress-updates", type=int, default=5000)
+    parser.add_argument("--books", type=int, default=10000)
+    parser.add_argument("--readers", type=int, default=50, help="Readers paging through the library at once")
+    parser.add_argument("--library-pages", type=int, default=10, help="Pages each reader browses")
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--list-items", type=int, default=2000, help="Bookmarks and annotations in the large lists")
+    parser.add_argument("--list-requests", type=int, default=80)
+    parser.add_argument("--list-concurrency", type=int, default=4)
+    parser.add_argument("--uploads", default=str(UPLOADS_DIR), help="Directory with the books to extract")
+    parser.add_argument("--extraction-rounds", type=int, default=3)
+    parser.add_argument("--json", dest="json_path", help="Write the results to this file")
+    parser.add_argument("--baseline", help="Results file of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed slowdown against the baseline")
+    options = parser.parse_args(argv)
+    unknown = set(options.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    return options
+
+
+async def _main(options) -> int:
+    import server
+    names = options.scenarios or list(SCENARIOS)
+    await server.app.router.startup()
+    try:
+        results = await run(names, options)
+    finally:
+        await server.app.router.shutdown()
+
+    print(format_table(results))
+    summaries = {r.name: r.summary() for r in results}
+    if options.json_path:
+        Path(options.json_path).write_text(json.dumps(summaries, indent=2) + "\n")
+
+    if options.baseline:
+        regressions = compare(results, json.loads(Path(options.baseline).read_text()), options.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+def main(argv=None) -> int:
+    options = parse_args(argv)
+    # Keep caches and the search index of the run away from the real ones;
+    # set before the server is imported so extraction workers inherit them
+    workdir = tempfile.mkdtemp(prefix="bookhaven-benchmark-")
+    os.environ.setdefault("SUPABASE_URL", "http://fake.supabase.local")
+    os.environ.setdefault("SUPABASE_KEY", "benchmark")
+    os.environ["EXTRACTION_CACHE_DIR"] = os.path.join(workdir, "extraction")
+    os.environ["SEARCH_INDEX_PATH"] = os.path.join(workdir, "search.db")
+    os.environ["INGESTION_ENABLED"] = "false"
+    os.environ.pop("PRINCIPAL_CACHE_PATH", None)
+    sys.path.insert(0, str(ROOT_DIR / "backend"))
+    import logging
+    logging.disable(logging.WARNING)
+    return asyncio.run(_main(options))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,427 @@
+"""In-process stand-in for the Supabase table and storage APIs.
+
+Implements the subset of the PostgREST query builder and storage client that
+``backend/server.py`` uses, over plain dicts, with configurable latency on
+every call so load tests see the same waiting pattern as a remote project:
+
+    fake = FakeSupabase(latency=Latency(median_ms=8), seed=1)
+    fake.seed("books", [{"id": "b1", "title": "Dom Casmurro", "is_public": True}])
+    with patch("server.supabase", fake), patch("server.supabase_http", fake.http_client()):
+        ...
+
+Only what the server needs is covered; an unsupported filter raises
+``NotImplementedError`` rather than silently matching everything.
+"""
+import asyncio
+import math
+import random
+import re
+import uuid
+from collections import Counter
+from pathlib import Path
+from typing import Callable, List, Optional
+
+import httpx
+
+
+class Latency:
+    """Log-normal delay around ``median_ms``; ``sigma`` controls the tail."""
+
+    def __init__(self, median_ms: float = 0.0, sigma: float = 0.5, bandwidth_mbps: Optional[float] = None):
+        self.median_ms = median_ms
+        self.sigma = sigma
+        self.bandwidth_mbps = bandwidth_mbps
+
+    def delay(self, rng: random.Random, size: int = 0) -> float:
+        seconds = 0.0
+        if self.median_ms > 0:
+            seconds = rng.lognormvariate(math.log(self.median_ms / 1000), self.sigma)
+        if self.bandwidth_mbps and size:
+            seconds += size * 8 / (self.bandwidth_mbps * 1_000_000)
+        return seconds
+
+
+class FakeResponse:
+    def __init__(self, data: List[dict]):
+        self.data = data
+        self.count = len(data)
+
+
+# ---------------------------------------------------------------------------
+# Filters
+# ---------------------------------------------------------------------------
+
+def _coerce(value, sample):
+    """Convert a PostgREST filter literal to the type of the stored value."""
+    if not isinstance(value, str):
+        return value
+    if isinstance(sample, bool):
+        return value == "true"
+    if isinstance(sample, (int, float)):
+        return float(value)
+    return value
+
+
+def _compare(op: str, column: str, value) -> Callable[[dict], bool]:
+    if op == "is":
+        expected = {"null": None, "true": True, "false": False}.get(str(value).lower(), value)
+        return lambda row: row.get(column) is expected
+    if op == "in":
+        allowed = set(value)
+        return lambda row: row.get(column) in allowed
+    if op in ("like", "ilike"):
+        pattern = re.compile(
+            "".join(".*" if c == "%" else "." if c == "_" else re.escape(c) for c in value) + r"\Z",
+            re.IGNORECASE if op == "ilike" else 0,
+        )
+        return lambda row: row.get(column) is not None and pattern.match(str(row[column])) is not None
+
+    compare = {
+        "eq": lambda a, b: a == b,
+        "neq": lambda a, b: a != b,
+        "gt": lambda a, b: a > b,
+        "gte": lambda a, b: a >= b,
+        "lt": lambda a, b: a < b,
+        "lte": lambda a, b: a <= b,
+    }.get(op)
+    if compare is None:
+        raise NotImplementedError(f"Unsupported filter operator: {op}")
+
+    def match(row):
+        stored = row.get(column)
+        # SQL comparisons with NULL are never true
+        return stored is not None and compare(stored, _coerce(value, stored))
+    return match
+
+
+def _parse_logic(text: str) -> Callable[[dict], bool]:
+    """Compile a PostgREST logical filter such as ``a.eq.1,and(b.gt."x",c.is.null)``."""
+    position = 0
+
+    def parse_list(end: str):
+        nonlocal position
+        items = [parse_item()]
+        while position < len(text) and text[position] == ",":
+            position += 1
+            items.append(parse_item())
+        if end:
+            if text[position:position + 1] != end:
+                raise ValueError(f"Expected {end!r} at {position} in {text!r}")
+            position += 1
+        return items
+
+    def parse_value() -> str:
+        nonlocal position
+        if text[position:position + 1] == '"':
+            position += 1
+            chars = []
+            while text[position] != '"':
+                if text[position] == "\\":
+                    position += 1
+                chars.append(text[position])
+                position += 1
+            position += 1
+            return "".join(chars)
+        start = position
+        while position < len(text) and text[position] not in ",)":
+            position += 1
+        return text[start:position]
+
+    def parse_item():
+        nonlocal position
+        for keyword, combine in (("and(", all), ("or(", any)):
+            if text.startswith(keyword, position):
+                position += len(keyword)
+                parts = parse_list(")")
+                return lambda row, parts=parts, combine=combine: combine(part(row) for part in parts)
+        column_end = text.index(".", position)
+        op_end = text.index(".", column_end + 1)
+        column, op = text[position:column_end], text[column_end + 1:op_end]
+        position = op_end + 1
+        return _compare(op, column, parse_value())
+
+    parts = parse_list("")
+    if position != len(text):
+        raise ValueError(f"Unexpected input at {position} in {text!r}")
+    return lambda row: any(part(row) for part in parts)
+
+
+def _project(row: dict, columns: List[str]) -> dict:
+    if columns == ["*"]:
+        return dict(row)
+    return {column: row.get(column) for column in columns}
+
+
+# ---------------------------------------------------------------------------
+# Tables
+# ---------------------------------------------------------------------------
+
+class FakeQuery:
+    def __init__(self, client: "FakeSupabase", table: str):
+        self.client = client
+        self.table = table
+        self.operation = None
+        self.payload = None
+        self.columns = ["*"]
+        self.on_conflict = "id"
+        self.ignore_duplicates = False
+        self.filters: List[Callable[[dict], bool]] = []
+        self.id_filter = None
+        self.orders: List[tuple] = []
+        self.max_rows = None
+        self.offset = 0
+
+    # Operations
+    def select(self, columns: str = "*", **kwargs):
+        self.operation = "select"
+        self.columns = [c.strip() for c in columns.split(",") if c.strip()]
+        return self
+
+    def insert(self, rows, **kwargs):
+        self.operation, self.payload = "insert", rows
+        return self
+
+    def upsert(self, rows, on_conflict: str = "id", ignore_duplicates: bool = False, **kwargs):
+        self.operation, self.payload = "upsert", rows
+        self.on_conflict = on_conflict
+        self.ignore_duplicates = ignore_duplicates
+        return self
+
+    def update(self, values: dict, **kwargs):
+        self.operation, self.payload = "update", values
+        return self
+
+    def delete(self, **kwargs):
+        self.operation = "delete"
+        return self
+
+    # Filters
+    def _where(self, op: str, column: str, value):
+        if op == "eq" and column == "id" and self.id_filter is None:
+            # Primary key lookups skip the table scan
+            self.id_filter = value
+        else:
+            self.filters.append(_compare(op, column, value))
+        return self
+
+    def eq(self, column, value):
+        return self._where("eq", column, value)
+
+    def neq(self, column, value):
+        return self._where("neq", column, value)
+
+    def gt(self, column, value):
+        return self._where("gt", column, value)
+
+    def gte(self, column, value):
+        return self._where("gte", column, value)
+
+    def lt(self, column, value):
+        return self._where("lt", column, value)
+
+    def lte(self, column, value):
+        return self._where("lte", column, value)
+
+    def in_(self, column, values):
+        return self._where("in", column, values)
+
+    def is_(self, column, value):
+        return self._where("is", column, value)
+
+    def like(self, column, pattern):
+        return self._where("like", column, pattern)
+
+    def ilike(self, column, pattern):
+        return self._where("ilike", column, pattern)
+
+    def or_(self, filters: str, **kwargs):
+        self.filters.append(_parse_logic(filters))
+        return self
+
+    # Modifiers
+    def order(self, column: str, desc: bool = False, **kwargs):
+        self.orders.append((column, desc))
+        return self
+
+    def limit(self, size: int, **kwargs):
+        self.max_rows = size
+        return self
+
+    def range(self, start: int, end: int, **kwargs):
+        self.offset, self.max_rows = start, end - start + 1
+        return self
+
+    # Execution
+    def _matching(self, candidates=None, stop: Optional[int] = None) -> List[dict]:
+        rows = self.client.tables.setdefault(self.table, {})
+        if self.id_filter is not None:
+            row = rows.get(self.id_filter)
+            candidates = [row] if row is not None else []
+        elif candidates is None:
+            candidates = rows.values()
+        matched = []
+        for row in candidates:
+            if all(match(row) for match in self.filters):
+                matched.append(row)
+                if len(matched) == stop:
+                    break
+        return matched
+
+    def _select(self) -> List[dict]:
+        end = None if self.max_rows is None else self.offset + self.max_rows
+        if self.orders and self.id_filter is None:
+            # Walk the table in order and stop at the limit, like an index scan
+            rows = self._matching(self.client.ordered(self.table, tuple(self.orders)), end)
+        else:
+            rows = self._matching()
+        return [_project(row, self.columns) for row in rows[self.offset:end]]
+
+    def _write(self) -> List[dict]:
+        table = self.client.tables.setdefault(self.table, {})
+        self.client.changed(self.table)
+        if self.operation == "update":
+            matched = self._matching()
+            for row in matched:
+                row.update(self.payload)
+            return [dict(row) for row in matched]
+        if self.operation == "delete":
+            matched = self._matching()
+            for row in matched:
+                del table[row["id"]]
+            return [dict(row) for row in matched]
+
+        rows = self.payload if isinstance(self.payload, list) else [self.payload]
+        keys = [k.strip() for k in self.on_conflict.split(",")]
+        existing = {}
+        if self.operation == "upsert":
+            existing = {tuple(row.get(k) for k in keys): row for row in table.values()}
+        written = []
+        for row in rows:
+            current = existing.get(tuple(row.get(k) for k in keys))
+            if current is not None:
+                if not self.ignore_duplicates:
+                    current.update(row)
+                    written.append(dict(current))
+                continue
+            stored = {"id": str(uuid.uuid4()), **row}
+            if self.operation == "insert" and stored["id"] in table:
+                raise FakeAPIError(f'duplicate key value violates unique constraint "{self.table}_pkey"')
+            table[stored["id"]] = stored
+            if self.operation == "upsert":
+                existing[tuple(stored.get(k) for k in keys)] = stored
+            written.append(dict(stored))
+        return written
+
+    async def execute(self) -> FakeResponse:
+        self.client.calls[(self.table, self.operation)] += 1
+        await self.client.wait()
+        return FakeResponse(self._select() if self.operation == "select" else self._write())
+
+
+class FakeAPIError(Exception):
+    pass
+
+
+# ---------------------------------------------------------------------------
+# Storage
+# ---------------------------------------------------------------------------
+
+class FakeBucket:
+    def __init__(self, client: "FakeSupabase", name: str):
+        self.client = client
+        self.name = name
+
+    @property
+    def objects(self) -> dict:
+        return self.client.objects.setdefault(self.name, {})
+
+    async def upload(self, path: str, file, file_options: Optional[dict] = None):
+        data = Path(file).read_bytes() if isinstance(file, (str, Path)) else bytes(file)
+        self.client.calls[("storage", "upload")] += 1
+        await self.client.wait(len(data), storage=True)
+        self.objects[path] = data
+
+    async def download(self, path: str) -> bytes:
+        self.client.calls[("storage", "download")] += 1
+        data = self.objects.get(path)
+        if data is None:
+            raise FakeAPIError(f"Object not found: {path}")
+        await self.client.wait(len(data), storage=True)
+        return data
+
+    async def remove(self, paths: List[str]):
+        self.client.calls[("storage", "remove")] += 1
+        await self.client.wait(storage=True)
+        for path in paths:
+            self.objects.pop(path, None)
+
+    async def get_public_url(self, path: str) -> str:
+        return f"https://fake.supabase.local/storage/v1/object/public/{self.name}/{path}"
+
+
+class FakeStorage:
+    def __init__(self, client: "FakeSupabase"):
+        self.client = client
+
+    def from_(self, bucket: str) -> FakeBucket:
+        return FakeBucket(self.client, bucket)
+
+
+class FakeSupabase:
+    """Drop-in for ``server.supabase`` backed by in-memory tables and buckets.
+
+    ``calls`` counts executed queries by ``(table, operation)`` and storage
+    calls by ``("storage", operation)``.
+    """
+
+    def __init__(self, latency: Optional[Latency] = None, storage_latency: Optional[Latency] = None, seed: int = 0):
+        self.latency = latency or Latency()
+        self.storage_latency = storage_latency or self.latency
+        self.rng = random.Random(seed)
+        self.tables: dict = {}
+        self.objects: dict = {}
+        self.calls: Counter = Counter()
+        self.storage = FakeStorage(self)
+        self._ordered: dict = {}
+
+    def changed(self, table: str) -> None:
+        self._ordered = {key: rows for key, rows in self._ordered.items() if key[0] != table}
+
+    def ordered(self, table: str, orders: tuple) -> List[dict]:
+        """Rows of ``table`` sorted by ``orders``, kept until the table changes."""
+        key = (table, orders)
+        if key not in self._ordered:
+            rows = list(self.tables.get(table, {}).values())
+            # Stable sorts from the last key to the first; NULLs sort last
+            # ascending and first descending, like PostgreSQL
+            for column, desc in reversed(orders):
+                rows.sort(key=lambda row: (row.get(column) is None, row.get(column) if row.get(column) is not None else 0), reverse=desc)
+            self._ordered[key] = rows
+        return self._ordered[key]
+
+    def table(self, name: str) -> FakeQuery:
+        return FakeQuery(self, name)
+
+    def seed(self, table: str, rows: List[dict]) -> None:
+        self.changed(table)
+        target = self.tables.setdefault(table, {})
+        for row in rows:
+            target[row["id"]] = dict(row)
+
+    async def wait(self, size: int = 0, storage: bool = False) -> None:
+        delay = (self.storage_latency if storage else self.latency).delay(self.rng, size)
+        await asyncio.sleep(delay)
+
+    def http_client(self) -> httpx.AsyncClient:
+        """Drop-in for ``server.supabase_http`` serving object downloads from the buckets."""
+        async def handle(request: httpx.Request) -> httpx.Response:
+            prefix = "/storage/v1/object/"
+            if request.method != "GET" or not request.url.path.startswith(prefix):
+                raise NotImplementedError(f"Unsupported request: {request.method} {request.url.path}")
+            bucket, _, path = request.url.path[len(prefix):].partition("/")
+            try:
+                return httpx.Response(200, content=await self.storage.from_(bucket).download(path))
+            except FakeAPIError:
+                return httpx.Response(404)
+
+        return httpx.AsyncClient(transport=httpx.MockTransport(handle))
@@ -1,7 +1,8 @@
 import pytest
 from fastapi.testclient import TestClient
-from unittest.mock import MagicMock, patch
+from unittest.mock import AsyncMock, MagicMock, patch
 import sys
+import json
 import os
 
 # Add backend to path
@@ -11,10 +12,28 @@ from server import app
 
 client = TestClient(app)
 
+class AsyncSupabaseMock(MagicMock):
+    """MagicMock whose query ``execute()`` and storage calls are awaitable."""
+
+    ASYNC_METHODS = {"execute", "upload", "remove", "get_public_url"}
+
+    def _get_child_mock(self, **kwargs):
+        if kwargs.get("name") in self.ASYNC_METHODS:
+            return AsyncMock(**kwargs)
+        return AsyncSupabaseMock(**kwargs)
+
+@pytest.fixture(autouse=True)
+def response_cache():
+    # Cached responses must not leak from one test's mock data into another
+    from server import ResponseCache
+    cache = ResponseCache(ttl=60)
+    with patch("server.response_cache", cache):
+        yield cache
+
 # Mock Supabase client
 @pytest.fixture
 def mock_supabase():
-    with patch("server.supabase") as mock:
+    with patch("server.supabase", new=AsyncSupabaseMock()) as mock:
         yield mock
 
 def test_read_main():
@@ -80,3 +99,1081 @@ def test_login_user(mock_supabase):
 def test_get_books_unauthorized():
     response = client.get("/api/books")
     assert response.status_code == 403 # HTTPBearer returns 403 if no header
+
+class StorageObjects(dict):
+    """Objects served by a stand-in for the Storage download endpoint."""
+    downloads = 0
+
+@pytest.fixture
+def storage_objects():
+    import httpx
+    from server import STORAGE_BUCKET
+    objects = StorageObjects()
+
+    def handler(request):
+        name = request.url.path.split(f"/storage/v1/object/{STORAGE_BUCKET}/", 1)[-1]
+        if name not in objects:
+            return httpx.Response(404)
+        if request.method == "HEAD":
+            return httpx.Response(200)
+        objects.downloads += 1
+        return httpx.Response(200, content=objects[name])
+
+    with patch("server.supabase_http", httpx.AsyncClient(transport=httpx.MockTransport(handler))):
+        yield objects
+
+@pytest.fixture
+def extraction_cache(tmp_path):
+    from server import ExtractionCache, ExtractionEngine, SearchIndex
+    cache = ExtractionCache(tmp_path / "cache", memory_limit=1024 * 1024, disk_limit=1024 * 1024)
+    # Threaded engine so extracted images land in this cache, not in a worker
+    # process's; extraction also feeds the search index, so keep that out of the real one
+    engine = ExtractionEngine(workers=2, processes=False, queue_limit=4, timeout=30, chunk_pages=16)
+    with patch("server.extraction_cache", cache), patch("server.extraction_engine", engine), \
+            patch("server.search_index", SearchIndex(tmp_path / "search.db")):
+        yield cache
+    engine.shutdown()
+
+def test_extract_text_is_cached(mock_supabase, extraction_cache, storage_objects):
+    book = {"id": "b1", "file_url": "b1.txt", "file_format": "txt", "file_hash": "abc"}
+    mock_supabase.table.return_value.select.return_value.eq.return_value.execute.return_value.data = [book]
+    storage_objects["b1.txt"] = b"Hello world"
+
+    first = client.get("/api/books/b1/extract-text")
+    second = client.get("/api/books/b1/extract-text")
+
+    assert first.status_code == 200
+    assert second.json() == first.json()
+    assert first.json()["pages"][0]["text"] == "Hello world"
+    assert storage_objects.downloads == 1
+
+def test_extraction_cache_falls_back_when_its_dir_is_not_writable(mock_supabase, tmp_path, storage_objects):
+    from server import ExtractionCache, ExtractionEngine, SearchIndex
+    blocked = tmp_path / "read-only"
+    blocked.write_text("")
+    cache = ExtractionCache(blocked / "cache", memory_limit=1024 * 1024, disk_limit=1024 * 1024, fallback_root=tmp_path / "fallback")
+    engine = ExtractionEngine(workers=2, processes=False, queue_limit=4, timeout=30, chunk_pages=16)
+    book = {"id": "b1", "file_url": "b1.txt", "file_format": "txt", "file_hash": "abc"}
+    mock_supabase.table.return_value.select.return_value.eq.return_value.execute.return_value.data = [book]
+    storage_objects["b1.txt"] = b"Hello world"
+
+    with patch("server.extraction_cache", cache), patch("server.extraction_engine", engine), \
+            patch("server.search_index", SearchIndex(tmp_path / "search.db")):
+        response = client.get("/api/books/b1/extract-text")
+    engine.shutdown()
+
+    assert response.status_code == 200
+    assert response.json()["pages"][0]["text"] == "Hello world"
+    assert cache.root == tmp_path / "fallback" and cache.page_count("b1", "abc") == 1
+
+def test_extraction_cache_disk_work_runs_off_the_event_loop(mock_supabase, extraction_cache, storage_objects):
+    import asyncio
+    book = {"id": "b1", "file_url": "b1.txt", "file_format": "txt", "file_hash": "abc"}
+    mock_supabase.table.return_value.select.return_value.eq.return_value.execute.return_value.data = [book]
+    storage_objects["b1.txt"] = b"Hello world"
+    on_loop = []
+
+    def tracked(method):
+        def call(*args, **kwargs):
+            try:
+                asyncio.get_running_loop()
+                on_loop.append(method.__name__)
+            except RuntimeError:
+                pass
+            return method(*args, **kwargs)
+        return call
+
+    with patch.object(extraction_cache, "_evict_disk", tracked(extraction_cache._evict_disk)), \
+            patch.object(extraction_cache, "get_pages", tracked(extraction_cache.get_pages)), \
+            patch.object(extraction_cache, "iter_lines", tracked(extraction_cache.iter_lines)):
+        assert client.get("/api/books/b1/extract-text").status_code == 200
+        assert client.get("/api/books/b1/extract-text").json()["pages"][0]["text"] == "Hello world"
+        assert client.get("/api/books/b1/extract-text?stream=true").status_code == 200
+
+    assert on_loop == []
+
+def test_extraction_cache_evicts_and_invalidates(tmp_path):
+    from server import ExtractionCache
+    cache = ExtractionCache(tmp_path, memory_limit=0, disk_limit=1024 * 1024)
+    pages = [{"page": i, "text": f"page {i}", "images": []} for i in range(1, 6)]
+    cache.put_pages("b1", "h1", pages)
+
+    # memory_limit=0 forces the window to be read back from disk
+    assert cache.get_pages("b1", "h1", 2, 3) == pages[1:3]
+    cache.invalidate("b1")
+    assert cache.get_pages("b1", "h1") is None
+
+def test_extraction_cache_evicts_entries_without_an_index(tmp_path):
+    from server import ExtractionCache
+    cache = ExtractionCache(tmp_path, memory_limit=0, disk_limit=200)
+    # Left behind by windowed extractions: no index.json
+    cache.put_image("b1", "h1", 1, 0, "cover.png", b"x" * 600)
+    cache.put_text_index("b2", "h2", {"offsets": list(range(100))})
+    for age, old in enumerate((tmp_path / "b1" / "h1", tmp_path / "b2" / "h2"), 1):
+        for path in [old, *old.rglob("*")]:
+            os.utime(path, (age, age))
+
+    cache.put_pages("b3", "h3", [{"page": 1, "text": "recent", "images": []}])
+
+    assert not (tmp_path / "b1").exists() and not (tmp_path / "b2").exists()
+    assert cache.page_count("b3", "h3") == 1
+
+def _pdf_bytes(page_count):
+    import io
+    import pypdf
+    writer = pypdf.PdfWriter()
+    for _ in range(page_count):
+        writer.add_blank_page(width=72, height=72)
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+def test_extract_text_page_window_and_stream(mock_supabase, extraction_cache, storage_objects):
+    book = {"id": "b2", "file_url": "b2.pdf", "file_format": "pdf", "file_hash": "def"}
+    mock_supabase.table.return_value.select.return_value.eq.return_value.execute.return_value.data = [book]
+    storage_objects["b2.pdf"] = _pdf_bytes(5)
+
+    window = client.get("/api/books/b2/extract-text?from=2&to=3")
+    assert [p["page"] for p in window.json()["pages"]] == [2, 3]
+    # Windowed extraction does not populate the cache
+    assert extraction_cache.page_count("b2", "def") is None
+
+    streamed = client.get("/api/books/b2/extract-text?stream=true")
+    assert streamed.headers["content-type"].startswith("application/x-ndjson")
+    assert [json.loads(line)["page"] for line in streamed.text.splitlines()] == [1, 2, 3, 4, 5]
+    assert extraction_cache.page_count("b2", "def") == 5
+
+    cached = client.get("/api/books/b2/extract-text?from=4&stream=true")
+    assert [json.loads(line)["page"] for line in cached.text.splitlines()] == [4, 5]
+
+def test_extract_text_rejects_inverted_window():
+    response = client.get("/api/books/b2/extract-text?from=3&to=2")
+    assert response.status_code == 400
+
+def test_page_image_served_with_etag(mock_supabase, extraction_cache, storage_objects):
+    book = {"file_url": "b3.pdf", "file_format": "pdf", "file_hash": "0123456789abcdef0123"}
+    mock_supabase.table.return_value.select.return_value.eq.return_value.execute.return_value.data = [book]
+    extraction_cache.put_image("b3", book["file_hash"], 2, 1, "Im0.png", b"\x89PNG fake")
+
+    response = client.get("/api/books/b3/pages/2/images/1")
+    assert response.status_code == 200
+    assert response.content == b"\x89PNG fake"
+    assert response.headers["content-type"] == "image/png"
+    assert "max-age" in response.headers["cache-control"]
+
+    etag = response.headers["etag"]
+    not_modified = client.get("/api/books/b3/pages/2/images/1", headers={"If-None-Match": etag})
+    assert not_modified.status_code == 304
+    assert storage_objects.downloads == 0
+
+def test_extract_text_rejects_when_engine_is_saturated(mock_supabase, extraction_cache, storage_objects):
+    from server import extraction_engine
+    book = {"id": "b4", "file_url": "b4.pdf", "file_format": "pdf", "file_hash": "ghi"}
+    mock_supabase.table.return_value.select.return_value.eq.return_value.execute.return_value.data = [book]
+
+    with patch.object(extraction_engine, "active", extraction_engine.queue_limit):
+        response = client.get("/api/books/b4/extract-text")
+
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "5"
+    assert storage_objects.downloads == 0
+
+@pytest.fixture
+def principal_cache():
+    from server import PrincipalCache
+    cache = PrincipalCache(ttl=60)
+    with patch("server.principal_cache", cache):
+        yield cache
+
+def test_current_user_is_cached(mock_supabase, principal_cache):
+    from server import create_access_token
+    user_row = {"id": "u1", "email": "reader@example.com", "username": "reader", "created_at": "2024-01-01T00:00:00Z"}
+    users_query = mock_supabase.table.return_value.select.return_value.eq.return_value.execute
+    users_query.return_value.data = [user_row]
+    headers = {"Authorization": f"Bearer {create_access_token('u1')}"}
+
+    assert client.get("/api/auth/me", headers=headers).json()["username"] == "reader"
+    assert client.get("/api/auth/me", headers=headers).json()["username"] == "reader"
+    assert users_query.call_count == 1
+
+    principal_cache.invalidate("u1")
+    client.get("/api/auth/me", headers=headers)
+    assert users_query.call_count == 2
+
+def test_current_user_from_trusted_claims(mock_supabase, principal_cache):
+    from server import User, create_access_token
+    user = User(id="u2", email="claims@example.com", username="claims")
+    headers = {"Authorization": f"Bearer {create_access_token(user.id, user)}"}
+
+    with patch("server.AUTH_TRUST_TOKEN_CLAIMS", True):
+        response = client.get("/api/auth/me", headers=headers)
+
+    assert response.json()["email"] == "claims@example.com"
+    mock_supabase.table.assert_not_called()
+
+def test_principal_cache_shared_store(tmp_path):
+    from server import PrincipalCache
+    path = str(tmp_path / "principals.db")
+    PrincipalCache(ttl=60, path=path).set("u3", {"id": "u3"})
+    assert PrincipalCache(ttl=60, path=path).get("u3") == {"id": "u3"}
+
+def _auth_headers(principal_cache, user_id="u1"):
+    from server import create_access_token
+    principal_cache.set(user_id, {"id": user_id, "email": f"{user_id}@example.com", "username": user_id})
+    return {"Authorization": f"Bearer {create_access_token(user_id)}"}
+
+def test_update_progress_is_a_single_upsert(mock_supabase, principal_cache):
+    stored = {"id": "p1", "user_id": "u1", "book_id": "b1", "current_page": 42}
+    upsert = mock_supabase.table.return_value.upsert
+    upsert.return_value.execute.return_value.data = [stored]
+
+    with patch("server.PROGRESS_WRITE_BEHIND", False):
+        response = client.put("/api/reading/progress/b1", json={"current_page": 42}, headers=_auth_headers(principal_cache))
+
+    assert response.status_code == 200
+    assert response.json()["current_page"] == 42
+    row = upsert.call_args.args[0]
+    assert (row["user_id"], row["book_id"], row["current_page"]) == ("u1", "b1", 42)
+    assert upsert.call_args.kwargs["on_conflict"] == "user_id,book_id"
+    mock_supabase.table.return_value.select.assert_not_called()
+    mock_supabase.table.return_value.insert.assert_not_called()
+
+@pytest.fixture
+def progress_buffer():
+    from server import ProgressWriteBuffer
+    buffer = ProgressWriteBuffer(interval=60, max_pending=100)
+    with patch("server.progress_buffer", buffer), patch("server.PROGRESS_WRITE_BEHIND", True):
+        yield buffer
+
+def test_progress_updates_are_coalesced(mock_supabase, principal_cache, progress_buffer):
+    import asyncio
+    headers = _auth_headers(principal_cache)
+    upsert = mock_supabase.table.return_value.upsert
+    upsert.return_value.execute.return_value.data = []
+    mock_supabase.table.return_value.select.return_value.eq.return_value.eq.return_value.execute.return_value.data = [
+        {"id": "p1", "user_id": "u1", "book_id": "b1", "current_page": 1}
+    ]
+
+    for page in (2, 3, 4):
+        client.put("/api/reading/progress/b1", json={"current_page": page}, headers=headers)
+    client.put("/api/reading/progress/b2", json={"current_page": 9}, headers=headers)
+    upsert.assert_not_called()
+
+    # Reads see buffered state on top of the stored row
+    progress = client.get("/api/reading/progress/b1", headers=headers).json()
+    assert (progress["id"], progress["current_page"]) == ("p1", 4)
+
+    asyncio.run(progress_buffer.flush())
+    assert upsert.call_count == 1
+    rows = upsert.call_args.args[0]
+    assert sorted((r["book_id"], r["current_page"]) for r in rows) == [("b1", 4), ("b2", 9)]
+    assert progress_buffer.pending("u1", "b1") is None
+
+def test_progress_flush_failure_is_requeued(mock_supabase, progress_buffer):
+    import asyncio
+    mock_supabase.table.return_value.upsert.return_value.execute.side_effect = Exception("down")
+    progress_buffer.put("u1", "b1", {"current_page": 5})
+
+    asyncio.run(progress_buffer.flush())
+
+    assert progress_buffer.pending("u1", "b1")["current_page"] == 5
+
+def test_progress_flush_drops_rows_the_database_rejects(mock_supabase, progress_buffer):
+    import asyncio
+
+    class APIError(Exception):
+        code = "23503"  # foreign key violation
+
+    stored = []
+    def upsert(rows, on_conflict):
+        query = MagicMock()
+        if any(row["book_id"] == "deleted" for row in rows):
+            query.execute = AsyncMock(side_effect=APIError("violates foreign key constraint"))
+        else:
+            stored.extend(rows)
+            query.execute = AsyncMock(return_value=MagicMock(data=rows))
+        return query
+    mock_supabase.table.return_value.upsert.side_effect = upsert
+    for i in range(5):
+        progress_buffer.put(f"u{i}", "b1", {"current_page": i})
+    progress_buffer.put("u9", "deleted", {"current_page": 3})
+
+    asyncio.run(progress_buffer.flush())
+
+    # The good rows are written and the bad one is dropped, not requeued
+    assert sorted(row["user_id"] for row in stored) == ["u0", "u1", "u2", "u3", "u4"]
+    assert progress_buffer.pending("u9", "deleted") is None
+    assert progress_buffer.pending("u0", "b1") is None
+
+def test_progress_flush_gives_up_after_max_attempts(mock_supabase, progress_buffer):
+    import asyncio
+    mock_supabase.table.return_value.upsert.return_value.execute.side_effect = Exception("down")
+    progress_buffer.max_attempts = 2
+    progress_buffer.put("u1", "b1", {"current_page": 5})
+
+    asyncio.run(progress_buffer.flush())
+    assert progress_buffer.pending("u1", "b1") is not None
+    asyncio.run(progress_buffer.flush())
+    assert progress_buffer.pending("u1", "b1") is None
+
+def test_progress_put_without_stored_row_is_partial(mock_supabase, principal_cache, progress_buffer):
+    response = client.put("/api/reading/progress/b1", json={"current_page": 7}, headers=_auth_headers(principal_cache))
+
+    assert response.headers["x-progress-partial"] == "true"
+    body = response.json()
+    assert body["current_page"] == 7 and "id" not in body
+
+def _books_query(mock_supabase, rows):
+    query = mock_supabase.table.return_value.select.return_value.or_.return_value
+    for method in ("eq", "ilike", "order", "limit"):
+        getattr(query, method).return_value = query
+    query.execute.return_value.data = rows
+    return query
+
+def test_get_books_keyset_pagination_and_projection(mock_supabase, principal_cache):
+    headers = _auth_headers(principal_cache)
+    rows = [{"id": f"b{i}", "title": f"Book {i}", "created_at": f"2024-01-0{i}"} for i in (3, 2, 1)]
+    query = _books_query(mock_supabase, rows)
+
+    first = client.get("/api/books?limit=2&fields=id,title&category=poetry", headers=headers)
+    assert first.json() == [{"id": "b3", "title": "Book 3"}, {"id": "b2", "title": "Book 2"}]
+    assert mock_supabase.table.return_value.select.call_args.args[0] == "id,title,created_at"
+    query.eq.assert_called_with("category", "poetry")
+    query.limit.assert_called_with(3)
+
+    cursor = first.headers["x-next-cursor"]
+    query.execute.return_value.data = rows[2:]
+    second = client.get(f"/api/books?limit=2&fields=id,title&cursor={cursor}", headers=headers)
+    assert second.json() == [{"id": "b1", "title": "Book 1"}]
+    assert "x-next-cursor" not in second.headers
+    keyset = mock_supabase.table.return_value.select.return_value.or_.call_args.args[0]
+    assert 'created_at.lt."2024-01-02"' in keyset and 'id.lt."b2"' in keyset
+
+def test_get_books_documents_its_response_model():
+    schema = app.openapi()["paths"]["/api/books"]["get"]["responses"]["200"]["content"]["application/json"]["schema"]
+    assert schema["type"] == "array" and schema["items"]["$ref"].endswith("/Book")
+
+def test_get_books_rejects_bad_parameters(principal_cache):
+    headers = _auth_headers(principal_cache)
+    assert client.get("/api/books?sort=password_hash", headers=headers).status_code == 400
+    assert client.get("/api/books?fields=id,password_hash", headers=headers).status_code == 400
+    assert client.get("/api/books?cursor=not-a-cursor", headers=headers).status_code == 400
+
+@pytest.fixture
+def search_index(tmp_path):
+    from server import SearchIndex
+    index = SearchIndex(tmp_path / "search.db")
+    with patch("server.search_index", index):
+        yield index
+
+def test_search_ranks_metadata_and_pages(principal_cache, search_index):
+    headers = _auth_headers(principal_cache)
+    search_index.index_book({"id": "b1", "title": "Dom Casmurro", "author": "Machado de Assis", "is_public": True, "uploaded_by": "u9"})
+    search_index.index_book({"id": "b2", "title": "Private Notes", "author": "Someone", "is_public": False, "uploaded_by": "u9"})
+    search_index.index_pages("b1", [{"page": 1, "text": "Capítulo primeiro"}, {"page": 7, "text": "Capitu e Bentinho"}])
+    search_index.index_pages("b2", [{"page": 1, "text": "Capitu private draft"}])
+
+    hits = client.get("/api/search?q=capitu bentinho", headers=headers).json()["hits"]
+    assert [(h["book_id"], h["page"]) for h in hits] == [("b1", 7)]
+    assert "<mark>Capitu</mark>" in hits[0]["snippet"]
+
+    hits = client.get("/api/search?q=machado", headers=headers).json()["hits"]
+    assert hits[0]["book_id"] == "b1" and hits[0]["page"] is None
+
+    search_index.remove_book("b1")
+    assert client.get("/api/search?q=bentinho", headers=headers).json()["hits"] == []
+
+def test_search_without_index_falls_back_to_metadata(principal_cache, tmp_path):
+    from server import SearchIndex
+    from tests.fake_supabase import FakeSupabase
+
+    fake = FakeSupabase()
+    fake.seed("books", [
+        {"id": "b1", "title": "Dom Casmurro", "author": "Machado de Assis", "description": "", "is_public": True, "uploaded_by": "u9"},
+        {"id": "b2", "title": "Private Machado", "author": "Someone", "description": "", "is_public": False, "uploaded_by": "u9"},
+    ])
+    blocked = tmp_path / "read-only"
+    blocked.write_text("")
+    # A file where the directory should be: the index cannot be created
+    index = SearchIndex(blocked / "search.db")
+    with patch("server.supabase", fake), patch("server.search_index", index):
+        hits = client.get("/api/search?q=machado", headers=_auth_headers(principal_cache)).json()["hits"]
+    assert not index.available
+    assert [(h["book_id"], h["page"]) for h in hits] == [("b1", None)]
+
+def test_search_backfills_existing_books(tmp_path):
+    import asyncio
+    from server import SearchIndex, books_repo
+    from tests.fake_supabase import FakeSupabase
+
+    fake = FakeSupabase()
+    fake.seed("books", [
+        {"id": f"b{i:02d}", "title": f"Book {i}", "author": "A", "description": None, "is_public": True, "uploaded_by": "u9"}
+        for i in range(5)
+    ])
+    index = SearchIndex(tmp_path / "search.db")
+    index.index_book({"id": "b00", "title": "Book 0", "author": "A", "is_public": True, "uploaded_by": "u9"})
+
+    async def scan_ids():
+        return [[book["id"] for book in page] async for page in books_repo.scan("id", page_size=2)]
+
+    with patch("server.supabase", fake):
+        assert asyncio.run(scan_ids()) == [["b00", "b01"], ["b02", "b03"], ["b04"]]
+        asyncio.run(index.backfill())
+    assert all(index.has_book(f"b{i:02d}") for i in range(5))
+    assert [h["book_id"] for h in index.search("book", "u1", limit=10)].count("b00") == 1
+
+def test_create_book_survives_search_index_errors(mock_supabase, principal_cache, search_index):
+    mock_supabase.table.return_value.select.return_value.eq.return_value.execute.return_value.data = []
+    import sqlite3
+    with patch.object(search_index, "index_book", side_effect=sqlite3.OperationalError("disk I/O error")):
+        response = client.post(
+            "/api/books",
+            data={"title": "T", "author": "A"},
+            files={"file": ("book.pdf", _pdf_bytes(1), "application/pdf")},
+            headers=_auth_headers(principal_cache),
+        )
+    assert response.status_code == 200
+    assert mock_supabase.table.return_value.insert.call_count == 1
+
+def test_create_book_streams_upload(mock_supabase, principal_cache, search_index):
+    import hashlib
+    headers = _auth_headers(principal_cache)
+    content = _pdf_bytes(2)
+    upload = mock_supabase.storage.from_.return_value.upload
+    mock_supabase.table.return_value.select.return_value.eq.return_value.execute.return_value.data = []
+
+    response = client.post(
+        "/api/books",
+        data={"title": "T", "author": "A"},
+        files={"file": ("book.pdf", content, "application/pdf")},
+        headers=headers,
+    )
+
+    assert response.status_code == 200
+    book = response.json()
+    assert book["file_size"] == len(content)
+    assert book["file_hash"] == hashlib.sha256(content).hexdigest()
+    # Uploaded from a spooled temp file, not from an in-memory bytes object
+    assert isinstance(upload.call_args.kwargs["file"], os.PathLike)
+
+def test_create_book_rejects_bad_content_and_size(mock_supabase, principal_cache):
+    headers = _auth_headers(principal_cache)
+    form = {"title": "T", "author": "A"}
+
+    mismatch = client.post("/api/books", data=form, files={"file": ("book.pdf", b"plain text", "application/pdf")}, headers=headers)
+    assert mismatch.status_code == 400
+
+    with patch("server.MAX_UPLOAD_MB", 0):
+        too_big = client.post("/api/books", data=form, files={"file": ("book.txt", b"x" * 10, "text/plain")}, headers=headers)
+    assert too_big.status_code == 413
+    mock_supabase.storage.from_.return_value.upload.assert_not_called()
+
+def test_resumable_upload_resumes_after_failed_part(tmp_path):
+    import asyncio
+    import httpx
+    from server import resumable_upload
+
+    received = bytearray()
+    failures = [True]
+
+    def handler(request):
+        if request.method == "POST":
+            return httpx.Response(201, headers={"Location": "https://storage.test/upload/1"})
+        if request.method == "HEAD":
+            return httpx.Response(200, headers={"Upload-Offset": str(len(received))})
+        if failures and int(request.headers["Upload-Offset"]) > 0:
+            failures.pop()
+            return httpx.Response(500)
+        received.extend(request.content)
+        return httpx.Response(204, headers={"Upload-Offset": str(len(received))})
+
+    data = os.urandom(2 * 1024 * 1024 + 10)
+    file_path = tmp_path / "book.pdf"
+    file_path.write_bytes(data)
+    http = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+    with patch("server.supabase_http", http), patch("server.RESUMABLE_CHUNK_BYTES", 1024 * 1024):
+        asyncio.run(resumable_upload(file_path, "book.pdf", "application/pdf", len(data)))
+
+    assert bytes(received) == data
+
+def test_duplicate_upload_reuses_storage_object(mock_supabase, principal_cache, search_index, storage_objects):
+    import hashlib
+    headers = _auth_headers(principal_cache)
+    content = _pdf_bytes(3)
+    path = f"{hashlib.sha256(content).hexdigest()}.pdf"
+    storage_objects[path] = content
+    mock_supabase.table.return_value.select.return_value.eq.return_value.execute.return_value.data = [{"id": "existing"}]
+    upload = mock_supabase.storage.from_.return_value.upload
+
+    def post():
+        return client.post(
+            "/api/books",
+            data={"title": "T", "author": "A"},
+            files={"file": ("copy.pdf", content, "application/pdf")},
+            headers=headers,
+        )
+
+    assert post().json()["file_url"] == path
+    mock_supabase.table.return_value.select.return_value.eq.assert_any_call("file_url", path)
+    upload.assert_not_called()
+
+    # The other book was deleted, with the object, before this row existed
+    del storage_objects[path]
+    assert post().status_code == 200
+    assert upload.call_count == 1 and upload.call_args.kwargs["path"] == path
+
+def test_delete_book_keeps_shared_storage_object(mock_supabase, principal_cache, search_index):
+    headers = _auth_headers(principal_cache)
+    lookup = mock_supabase.table.return_value.select.return_value.eq.return_value.execute
+    remove = mock_supabase.storage.from_.return_value.remove
+
+    # Another book still references the object
+    lookup.return_value.data = [{"id": "b1", "uploaded_by": "u1", "file_url": "h.pdf"}]
+    assert client.delete("/api/books/b1", headers=headers).status_code == 200
+    remove.assert_not_called()
+
+    # Last reference: the book row lookup succeeds, then no references remain
+    lookup.side_effect = [MagicMock(data=[{"uploaded_by": "u1", "file_url": "h.pdf"}]), MagicMock(data=[])]
+    assert client.delete("/api/books/b1", headers=headers).status_code == 200
+    remove.assert_called_once_with(["h.pdf"])
+
+def test_extraction_cache_adopts_entry_for_same_file(tmp_path):
+    from server import ExtractionCache
+    cache = ExtractionCache(tmp_path, memory_limit=0, disk_limit=1024 * 1024)
+    cache.put_image("b1", "h", 1, 1, "Im0.png", b"png")
+    cache.put_pages("b1", "h", [{"page": 1, "text": "x", "images": ["/api/books/b1/pages/1/images/1"]}])
+
+    assert cache.adopt("b2", "h")
+    assert cache.get_pages("b2", "h")[0]["images"] == ["/api/books/b2/pages/1/images/1"]
+    assert cache.image_path("b2", "h", 1, 1).read_bytes() == b"png"
+
+def test_ingestion_job_updates_metadata_and_warms_cache(mock_supabase, extraction_cache, tmp_path):
+    import asyncio
+    import io
+    import pypdf
+    from server import IngestionQueue
+    writer = pypdf.PdfWriter()
+    for _ in range(3):
+        writer.add_blank_page(width=72, height=72)
+    part = writer.add_outline_item("Part I", 0)
+    writer.add_outline_item("Chapter 1", 1, parent=part)
+    writer.add_outline_item("Part II", 2)
+    pdf = tmp_path / "upload.pdf"
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    pdf.write_bytes(buffer.getvalue())
+
+    queue = IngestionQueue(workers=1)
+    book = {"id": "b1", "file_url": "h1.pdf", "file_hash": "h1", "file_format": "pdf", "cover_url": "https://cover"}
+
+    async def run():
+        queue.start()
+        queue.submit(book, pdf)
+        await queue._queue.join()
+        await queue.stop()
+    asyncio.run(run())
+
+    job = queue.status("b1")
+    assert job["status"] == "done", job["error"]
+    update = mock_supabase.table.return_value.update.call_args.args[0]
+    assert update["total_pages"] == 3 and update["total_chapters"] == 2
+    assert [(e["title"], e["page"], e["level"]) for e in update["outline"]] == [
+        ("Part I", 1, 0), ("Chapter 1", 2, 1), ("Part II", 3, 0)]
+    assert extraction_cache.page_count("b1", "h1") == 3
+    # The spooled upload was moved into the source store
+    assert not pdf.exists()
+    assert extraction_cache.get_source("h1", "pdf").read_bytes() == buffer.getvalue()
+
+def _epub_bytes():
+    import io
+    import zipfile
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as z:
+        z.writestr("mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+        z.writestr("META-INF/container.xml", '<container xmlns="urn:oasis:names:tc:opendocument:xmlns:container"><rootfiles><rootfile full-path="OEBPS/content.opf"/></rootfiles></container>')
+        z.writestr("OEBPS/content.opf", """<package xmlns="http://www.idpf.org/2007/opf">
+            <manifest>
+                <item id="c2" href="text/two.xhtml" media-type="application/xhtml+xml"/>
+                <item id="c1" href="text/one.xhtml" media-type="application/xhtml+xml"/>
+                <item id="img" href="images/fig.png" media-type="image/png" properties="cover-image"/>
+                <item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>
+            </manifest>
+            <spine toc="ncx"><itemref idref="c1"/><itemref idref="c2"/></spine>
+        </package>""")
+        z.writestr("OEBPS/toc.ncx", """<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/"><navMap>
+            <navPoint><navLabel><text>Two</text></navLabel><content src="text/two.xhtml#start"/></navPoint>
+        </navMap></ncx>""")
+        z.writestr("OEBPS/text/one.xhtml", "<html><head><style>p{}</style></head><body><h1>One</h1><p>First  chapter</p><img src=\"../images/fig.png\"/></body></html>")
+        z.writestr("OEBPS/text/two.xhtml", "<html><body><p>Second &amp; last</p></body></html>")
+        z.writestr("OEBPS/images/fig.png", b"png")
+    return buffer.getvalue()
+
+def test_extract_cover_thumbnails_and_skips_undecodable_images(tmp_path):
+    import io
+    from PIL import Image
+    from server import extract_cover
+    epub = tmp_path / "book.epub"
+    # The fixture's cover image is not a real PNG
+    epub.write_bytes(_epub_bytes())
+    assert extract_cover(epub, "epub") is None
+
+    image = io.BytesIO()
+    Image.new("RGB", (1200, 1800), "red").save(image, format="PNG")
+    with patch("server.EpubReader.cover", return_value=("cover.png", image.getvalue())):
+        data, extension = extract_cover(epub, "epub")
+    assert extension == ".jpg"
+    assert Image.open(io.BytesIO(data)).size[0] == 320
+
+def test_ingestion_keeps_metadata_when_cover_upload_fails(mock_supabase, extraction_cache, tmp_path):
+    import asyncio
+    from server import IngestionQueue
+    pdf = tmp_path / "upload.pdf"
+    pdf.write_bytes(_pdf_bytes(2))
+    mock_supabase.storage.from_.return_value.upload.side_effect = RuntimeError("storage down")
+    queue = IngestionQueue(workers=1)
+    book = {"id": "b1", "file_url": "h1.pdf", "file_hash": "h1", "file_format": "pdf"}
+
+    async def run():
+        queue.start()
+        queue.submit(book, pdf)
+        await queue._queue.join()
+        await queue.stop()
+    with patch("server.extract_cover", return_value=(b"jpeg", ".jpg")):
+        asyncio.run(run())
+
+    assert queue.status("b1")["status"] == "done"
+    updates = [c.args[0] for c in mock_supabase.table.return_value.update.call_args_list]
+    assert updates == [{"total_pages": 2, "total_chapters": 0, "outline": []}]
+
+def test_extract_text_reads_epub_in_spine_order(mock_supabase, extraction_cache, tmp_path, storage_objects):
+    from server import read_outline
+    book = {"id": "b3", "file_url": "b3.epub", "file_format": "epub", "file_hash": "e1"}
+    mock_supabase.table.return_value.select.return_value.eq.return_value.execute.return_value.data = [book]
+    storage_objects["b3.epub"] = _epub_bytes()
+
+    response = client.get("/api/books/b3/extract-text")
+
+    assert response.status_code == 200
+    pages = response.json()["pages"]
+    assert [p["text"] for p in pages] == ["One\nFirst chapter", "Second & last"]
+    assert pages[0]["images"] == ["/api/books/b3/pages/1/images/1"]
+    assert extraction_cache.image_path("b3", "e1", 1, 1).read_bytes() == b"png"
+    assert client.get("/api/books/b3/extract-text?from=2&to=2").json()["pages"][0]["page"] == 2
+
+    epub = tmp_path / "book.epub"
+    epub.write_bytes(_epub_bytes())
+    assert read_outline(epub, "epub") == [{"title": "Two", "page": 2, "level": 0}]
+
+def test_sniff_format_accepts_utf16_and_utf32_text():
+    from server import sniff_format
+    for encoding in ("utf-16-le", "utf-16-be", "utf-32-le", "utf-32-be"):
+        assert sniff_format("\ufeffOlá, mundo".encode(encoding)) == "txt"
+        # Without a BOM, NUL bytes still mean binary content
+        assert sniff_format("Olá, mundo".encode(encoding)) is None
+
+def test_txt_paginator_splits_on_paragraphs_with_offsets(tmp_path):
+    from server import TxtPaginator
+    paragraphs = [f"Parágrafo {i} " + "palavra " * 30 for i in range(40)]
+    text = "\n\n".join(paragraphs)
+    path = tmp_path / "book.txt"
+    path.write_bytes(text.encode("utf-16"))
+
+    paginator = TxtPaginator.build(path, page_chars=1000)
+
+    assert paginator.encoding == "utf-16-le" and len(paginator) > 5
+    pages = [paginator.read(path.read_bytes(), i) for i in range(len(paginator))]
+    # Every page starts on a paragraph and nothing is lost between pages
+    assert all(page.startswith("Parágrafo") for page in pages)
+    assert "\n\n".join(pages) == text
+
+    # A single long line in Latin-1 is broken at spaces
+    text = "Coração não é razão, é emoção. " * 100
+    path.write_bytes(text.encode("latin-1"))
+    paginator = TxtPaginator.build(path, page_chars=1000)
+    assert "".join(paginator.read(path.read_bytes(), i) for i in range(len(paginator))) == text
+
+def test_extract_text_paginates_txt_window(mock_supabase, extraction_cache, storage_objects):
+    book = {"id": "b4", "file_url": "b4.txt", "file_format": "txt", "file_hash": "t1"}
+    mock_supabase.table.return_value.select.return_value.eq.return_value.execute.return_value.data = [book]
+    storage_objects["b4.txt"] = ("line of text\n" * 100 + "\n").encode() * 20
+
+    with patch("server.TXT_PAGE_CHARS", 1000):
+        window = client.get("/api/books/b4/extract-text?from=3&to=4").json()
+
+    assert [p["page"] for p in window["pages"]] == [3, 4]
+    assert extraction_cache.text_index("b4", "t1")["offsets"][:2] == [0, 1301]
+
+def test_extraction_reuses_stored_source_file(mock_supabase, extraction_cache, storage_objects):
+    book = {"id": "b5", "file_url": "b5.pdf", "file_format": "pdf", "file_hash": "s1"}
+    mock_supabase.table.return_value.select.return_value.eq.return_value.execute.return_value.data = [book]
+    storage_objects["b5.pdf"] = _pdf_bytes(4)
+
+    # Page windows are not cached as pages, but the source file is
+    assert [p["page"] for p in client.get("/api/books/b5/extract-text?from=1&to=2").json()["pages"]] == [1, 2]
+    assert [p["page"] for p in client.get("/api/books/b5/extract-text?from=3&to=4").json()["pages"]] == [3, 4]
+    assert storage_objects.downloads == 1
+
+def test_extraction_engine_replaces_a_broken_worker_pool():
+    import asyncio
+    from concurrent.futures import Future, ThreadPoolExecutor
+    from concurrent.futures.process import BrokenProcessPool
+    from fastapi import HTTPException
+    from server import ExtractionEngine
+
+    class BrokenPool(ThreadPoolExecutor):
+        def submit(self, fn, *args, **kwargs):
+            future = Future()
+            future.set_exception(BrokenProcessPool("A child process terminated abruptly"))
+            return future
+
+    engine = ExtractionEngine(workers=2, processes=False, queue_limit=4, timeout=5, chunk_pages=4)
+    engine._executor = BrokenPool()
+
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(engine.run(lambda timeout: "unreachable"))
+    assert error.value.status_code == 503
+    assert engine._executor is None
+    # The next job gets a working pool
+    assert asyncio.run(engine.run(lambda value, timeout: value * 2, 21)) == 42
+    engine.shutdown()
+
+def test_extraction_engine_threads_follow_the_worker_setting():
+    from server import ExtractionEngine
+    engine = ExtractionEngine(workers=5, processes=False, queue_limit=4, timeout=5, chunk_pages=4)
+    assert engine._get_executor()._max_workers == 5
+    engine.shutdown()
+
+def test_bookmark_batch_is_one_statement_with_per_item_results(mock_supabase, principal_cache):
+    headers = _auth_headers(principal_cache)
+    table = mock_supabase.table.return_value
+    first, second = "6f1c1c2e-0d5e-4a8e-9a43-3f0a9a3c1b01", "6f1c1c2e-0d5e-4a8e-9a43-3f0a9a3c1b02"
+    table.upsert.return_value.execute.return_value.data = [{"id": first}]
+
+    response = client.post("/api/bookmarks/batch", json={"items": [
+        {"id": first, "book_id": "b1", "position": "10"},
+        {"id": second.upper(), "book_id": "b1", "position": "20"},
+    ]}, headers=headers)
+
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [(r["id"], r["status"]) for r in results] == [(first, "created"), (second, "exists")]
+    assert results[0]["item"]["user_id"] == "u1"
+    rows = table.upsert.call_args.args[0]
+    assert table.upsert.call_count == 1 and len(rows) == 2
+    assert [row["id"] for row in rows] == [first, second]
+    assert table.upsert.call_args.kwargs == {"on_conflict": "id", "ignore_duplicates": True}
+
+    # One invalid item rejects the whole batch
+    bad = client.post("/api/bookmarks/batch", json={"items": [{"book_id": "b1", "position": "1"}, {"book_id": "b1"}]}, headers=headers)
+    assert bad.status_code == 422
+    # So does an id that is not a UUID, pointing at the item
+    bad_id = client.post("/api/annotations/batch", json={"items": [
+        {"book_id": "b1", "highlighted_text": "x"},
+        {"id": "not-a-uuid", "book_id": "b1", "highlighted_text": "y"},
+    ]}, headers=headers)
+    assert bad_id.status_code == 422
+    assert bad_id.json()["detail"][0]["loc"] == ["body", "items", 1, "id"]
+    assert table.upsert.call_count == 1
+
+def test_annotation_batch_delete_reports_missing_ids(mock_supabase, principal_cache):
+    headers = _auth_headers(principal_cache)
+    delete = mock_supabase.table.return_value.delete.return_value
+    a1, a2 = "0b7a4f0e-8a51-4c1e-b3d2-6d1f3c2a9e01", "0b7a4f0e-8a51-4c1e-b3d2-6d1f3c2a9e02"
+    delete.in_.return_value.eq.return_value.execute.return_value.data = [{"id": a1}]
+
+    response = client.post("/api/annotations/batch/delete", json={"ids": [a1, a2]}, headers=headers)
+
+    assert response.json()["results"] == [{"id": a1, "status": "deleted"}, {"id": a2, "status": "not_found"}]
+    delete.in_.assert_called_once_with("id", [a1, a2])
+    delete.in_.return_value.eq.assert_called_once_with("user_id", "u1")
+
+    bad = client.post("/api/annotations/batch/delete", json={"ids": [a1, "not-a-uuid"]}, headers=headers)
+    assert bad.status_code == 422
+    assert bad.json()["detail"][0]["loc"] == ["body", "ids", 1]
+    assert delete.in_.call_count == 1
+
+def test_bookmark_batch_for_a_missing_book_is_a_422(mock_supabase, principal_cache):
+    class APIError(Exception):
+        code = "23503"  # foreign key violation
+
+    mock_supabase.table.return_value.upsert.return_value.execute.side_effect = APIError("violates foreign key constraint")
+
+    response = client.post("/api/bookmarks/batch", json={"items": [{"book_id": "gone", "position": "1"}]},
+                           headers=_auth_headers(principal_cache))
+
+    assert response.status_code == 422
+
+def test_sync_returns_changes_since_cursor(mock_supabase, principal_cache, progress_buffer):
+    from server import encode_cursor
+    headers = _auth_headers(principal_cache)
+    tables = {name: AsyncSupabaseMock() for name in ["reading_progress", "bookmarks", "annotations", "reading_preferences", "deleted_items"]}
+    mock_supabase.table.side_effect = lambda name: tables[name]
+    since_rows = lambda name: tables[name].select.return_value.eq.return_value.gte.return_value.execute.return_value
+    since_rows("reading_progress").data = [{"id": "p1", "user_id": "u1", "book_id": "b1", "current_page": 3}]
+    since_rows("bookmarks").data = [{"id": "bm1", "user_id": "u1", "book_id": "b1", "position": "5"}]
+    since_rows("annotations").data = []
+    tables["reading_preferences"].select.return_value.eq.return_value.execute.return_value.data = [
+        {"id": "pr1", "user_id": "u1", "created_at": "2020-01-01T00:00:00+00:00", "updated_at": None}]
+    tombstones = tables["deleted_items"].select.return_value.or_.return_value.gte.return_value.execute.return_value
+    tombstones.data = [{"item_type": "annotation", "item_id": "a9", "deleted_at": "2024-06-01T00:00:00+00:00"}]
+    progress_buffer.put("u1", "b2", {"current_page": 40})
+
+    cursor = encode_cursor(["2024-01-01T00:00:00+00:00"])
+    response = client.get(f"/api/sync?since={cursor}", headers=headers)
+
+    assert response.status_code == 200
+    body = response.json()
+    assert {p["book_id"]: p["current_page"] for p in body["progress"]} == {"b1": 3, "b2": 40}
+    assert [b["id"] for b in body["bookmarks"]] == ["bm1"]
+    assert body["preferences"] is None  # unchanged since the cursor
+    assert body["deleted"] == tombstones.data
+    tables["bookmarks"].select.return_value.eq.return_value.gte.assert_called_once_with("created_at", "2024-01-01T00:00:00+00:00")
+    tables["deleted_items"].select.return_value.or_.assert_called_once_with("user_id.eq.u1,user_id.is.null")
+    assert client.get("/api/sync?since=bogus", headers=headers).status_code == 400
+
+    # The next cursor reaches back past the slowest buffered progress write
+    from datetime import datetime, timezone
+    from server import PROGRESS_FLUSH_INTERVAL_SECONDS, PROGRESS_FLUSH_MAX_ATTEMPTS, _parse_time, decode_cursor
+    next_since = _parse_time(decode_cursor(body["cursor"])[0])
+    assert (datetime.now(timezone.utc) - next_since).total_seconds() > PROGRESS_FLUSH_INTERVAL_SECONDS * PROGRESS_FLUSH_MAX_ATTEMPTS
+
+def test_deletes_record_tombstones(mock_supabase, principal_cache):
+    headers = _auth_headers(principal_cache)
+    tables = {name: AsyncSupabaseMock() for name in ["bookmarks", "deleted_items"]}
+    mock_supabase.table.side_effect = lambda name: tables[name]
+    tables["bookmarks"].delete.return_value.eq.return_value.eq.return_value.execute.return_value.data = [{"id": "bm1"}]
+
+    client.delete("/api/bookmarks/bm1", headers=headers)
+
+    row = tables["deleted_items"].insert.call_args.args[0][0]
+    assert (row["item_type"], row["item_id"], row["user_id"]) == ("bookmark", "bm1", "u1")
+
+def test_book_session_combines_state_and_pages_around_position(mock_supabase, principal_cache, extraction_cache, storage_objects):
+    headers = _auth_headers(principal_cache)
+    tables = {name: AsyncSupabaseMock() for name in ["books", "reading_progress", "bookmarks", "annotations", "reading_preferences"]}
+    mock_supabase.table.side_effect = lambda name: tables[name]
+    book = {"id": "b1", "title": "T", "author": "A", "file_url": "h.pdf", "file_format": "pdf", "file_size": 1,
+            "uploaded_by": "u9", "file_hash": "h", "total_pages": 6}
+    tables["books"].select.return_value.eq.return_value.execute.return_value.data = [book]
+    tables["reading_progress"].select.return_value.eq.return_value.eq.return_value.execute.return_value.data = [
+        {"id": "p1", "user_id": "u1", "book_id": "b1", "current_page": 5}]
+    tables["bookmarks"].select.return_value.eq.return_value.eq.return_value.execute.return_value.data = [
+        {"id": "bm1", "user_id": "u1", "book_id": "b1", "position": "5"}]
+    tables["annotations"].select.return_value.eq.return_value.eq.return_value.execute.return_value.data = []
+    tables["reading_preferences"].select.return_value.eq.return_value.execute.return_value.data = []
+    extraction_cache.put_pages("b1", "h", [{"page": i, "text": f"p{i}", "images": []} for i in range(1, 7)])
+
+    session = client.get("/api/books/b1/session?window=2", headers=headers).json()
+
+    assert session["book"]["id"] == "b1"
+    assert session["progress"]["current_page"] == 5
+    assert [b["id"] for b in session["bookmarks"]] == ["bm1"]
+    assert session["preferences"]["theme"] == "soft-beige"
+    assert [p["page"] for p in session["pages"]] == [3, 4, 5, 6]
+    assert storage_objects.downloads == 0
+    tables["reading_progress"].insert.assert_not_called()
+
+def test_login_rehashes_password_when_rounds_change(mock_supabase):
+    from passlib.context import CryptContext
+    old_hash = CryptContext(schemes=["bcrypt"], bcrypt__rounds=4).hash("password123")
+    users = mock_supabase.table.return_value
+    users.select.return_value.eq.return_value.execute.return_value.data = [
+        {"id": "123", "email": "test@example.com", "username": "testuser", "password_hash": old_hash}]
+
+    with patch("server.pwd_context", CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=5)):
+        response = client.post("/api/auth/login", json={"email": "test@example.com", "password": "password123"})
+        assert response.status_code == 200
+        new_hash = users.update.call_args.args[0]["password_hash"]
+        assert new_hash.startswith("$2b$05$")
+        assert client.post("/api/auth/login", json={"email": "test@example.com", "password": "wrong"}).status_code == 401
+
+def test_password_hasher_rejects_beyond_queue_limit():
+    import asyncio
+    import time
+    from fastapi import HTTPException
+    from server import PasswordHasher
+    hasher = PasswordHasher(workers=1, queue_limit=1)
+
+    async def run():
+        return await asyncio.gather(hasher.run(time.sleep, 0.05), hasher.run(time.sleep, 0), return_exceptions=True)
+
+    _, second = asyncio.run(run())
+    assert isinstance(second, HTTPException) and second.status_code == 503
+    assert hasher.stats()["completed"] == 1 and hasher.stats()["rejected"] == 1
+    hasher.shutdown()
+
+def test_book_file_supports_ranges_and_validators(mock_supabase, extraction_cache, tmp_path, storage_objects):
+    from server import LocalStorage
+    data = bytes(range(256)) * 40
+    storage = LocalStorage(tmp_path / "uploads", "http://localhost:8000/uploads")
+    (tmp_path / "uploads").mkdir()
+    (tmp_path / "uploads" / "f1.pdf").write_bytes(data)
+    book = {"id": "b1", "file_url": "f1.pdf", "file_format": "pdf", "file_hash": "f1"}
+    mock_supabase.table.return_value.select.return_value.eq.return_value.execute.return_value.data = [book]
+
+    with patch("server.storage", storage):
+        full = client.get("/api/books/b1/file")
+        part = client.get("/api/books/b1/file", headers={"Range": "bytes=100-199"})
+        suffix = client.get("/api/books/b1/file", headers={"Range": "bytes=-10"})
+        stale = client.get("/api/books/b1/file", headers={"Range": "bytes=0-9", "If-Range": '"other"'})
+        cached = client.get("/api/books/b1/file", headers={"If-None-Match": full.headers["etag"]})
+        outside = client.get("/api/books/b1/file", headers={"Range": f"bytes={len(data)}-"})
+
+    assert full.status_code == 200 and full.content == data
+    assert full.headers["accept-ranges"] == "bytes" and full.headers["etag"] == '"f1"' and "last-modified" in full.headers
+    assert part.status_code == 206 and part.content == data[100:200]
+    assert part.headers["content-range"] == f"bytes 100-199/{len(data)}"
+    assert suffix.content == data[-10:]
+    assert stale.status_code == 200
+    assert cached.status_code == 304
+    assert outside.status_code == 416
+    assert storage_objects.downloads == 0
+
+def test_concurrent_first_opens_download_the_book_once(mock_supabase, extraction_cache, storage_objects):
+    import asyncio
+    import hashlib
+    from server import fetch_source
+    data = _pdf_bytes(3)
+    storage_objects["f1.pdf"] = data
+    book = {"id": "b1", "file_url": "f1.pdf", "file_format": "pdf", "file_hash": hashlib.sha256(data).hexdigest()}
+
+    async def open_concurrently():
+        return await asyncio.gather(*(fetch_source(book) for _ in range(3)))
+
+    results = asyncio.run(open_concurrently())
+
+    assert storage_objects.downloads == 1
+    assert {path for _, path in results} == {extraction_cache.get_source(book["file_hash"], "pdf")}
+    assert results[0][1].read_bytes() == data
+
+def test_book_file_range_uses_zerocopy_through_middleware(mock_supabase, extraction_cache, tmp_path):
+    import asyncio
+    from server import LocalStorage
+    storage = LocalStorage(tmp_path / "uploads", "http://localhost:8000/uploads")
+    (tmp_path / "uploads").mkdir()
+    (tmp_path / "uploads" / "f1.pdf").write_bytes(bytes(1000))
+    book = {"id": "b1", "file_url": "f1.pdf", "file_format": "pdf", "file_hash": "f1"}
+    mock_supabase.table.return_value.select.return_value.eq.return_value.execute.return_value.data = [book]
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET", "scheme": "http",
+        "path": "/api/books/b1/file", "raw_path": b"/api/books/b1/file", "root_path": "", "query_string": b"",
+        "headers": [(b"host", b"testserver"), (b"range", b"bytes=100-199")],
+        "client": ("127.0.0.1", 1), "server": ("testserver", 80),
+        "extensions": {"http.response.zerocopy": {}},
+    }
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    with patch("server.storage", storage):
+        asyncio.run(app(scope, receive, send))
+
+    assert [m["type"] for m in sent] == ["http.response.start", "http.response.zerocopy"]
+    assert sent[0]["status"] == 206
+    assert (sent[1]["offset"], sent[1]["count"]) == (100, 100)
+
+def test_metrics_expose_route_and_supabase_latency(mock_supabase, principal_cache):
+    headers = _auth_headers(principal_cache)
+    mock_supabase.table.return_value.select.return_value.eq.return_value.eq.return_value.execute.return_value.data = []
+
+    client.get("/api/annotations/b1", headers=headers)
+    response = client.get("/api/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    body = response.text
+    assert 'http_request_duration_seconds_count{method="GET",route="/api/annotations/{book_id}",status="200"}' in body
+    assert 'supabase_query_duration_seconds_count{table="annotations",operation="select"}' in body
+    assert "# TYPE extraction_jobs_active gauge" in body
+
+def test_benchmark_scenarios_run_against_fake_supabase(extraction_cache, progress_buffer, tmp_path):
+    import asyncio
+    from tests import benchmark
+    (tmp_path / "uploads").mkdir()
+    (tmp_path / "uploads" / "short.pdf").write_bytes(_pdf_bytes(3))
+    options = benchmark.parse_args([
+        "--scale", "0.01", "--latency-ms", "0", "--storage-latency-ms", "0", "--concurrency", "4",
+        "--library-pages", "2", "--page-size", "20", "--extraction-rounds", "2", "--uploads", str(tmp_path / "uploads"),
+    ])
+
+    results = asyncio.run(benchmark.run(list(benchmark.SCENARIOS), options))
+
+    summaries = {r.name: r.summary() for r in results}
+    assert set(summaries) == {"login", "progress", "library", "extraction", "lists"}
+    assert all(s["errors"] == 0 and s["requests"] > 0 for s in summaries.values())
+    # One reader, two pages: the cursor was followed
+    assert summaries["library"]["requests"] == 2
+    assert benchmark.compare(results, summaries, 0.2) == []
+    assert benchmark.compare(results, {"library": {**summaries["library"], "throughput_rps": 1e9}}, 0.2)
+
+def test_bookmarks_are_cached_with_etag_until_a_write(mock_supabase, principal_cache):
+    headers = _auth_headers(principal_cache)
+    find = mock_supabase.table.return_value.select.return_value.eq.return_value.eq.return_value.execute
+    find.return_value.data = [{"id": "bm1", "user_id": "u1", "book_id": "b1", "position": "5"}]
+
+    first = client.get("/api/bookmarks/b1", headers=headers)
+    etag = first.headers["etag"]
+    revalidated = client.get("/api/bookmarks/b1", headers={**headers, "If-None-Match": etag})
+
+    assert first.json()[0]["id"] == "bm1"
+    assert revalidated.status_code == 304 and revalidated.content == b""
+    assert find.call_count == 1  # the second poll never reached Supabase
+
+    client.post("/api/bookmarks", json={"book_id": "b1", "position": "9"}, headers=headers)
+    find.return_value.data.append({"id": "bm2", "user_id": "u1", "book_id": "b1", "position": "9"})
+    changed = client.get("/api/bookmarks/b1", headers={**headers, "If-None-Match": etag})
+
+    assert changed.status_code == 200
+    assert [b["id"] for b in changed.json()] == ["bm1", "bm2"]
+    assert changed.headers["etag"] != etag
+
+def test_book_writes_invalidate_every_cached_listing(mock_supabase, principal_cache):
+    headers = _auth_headers(principal_cache)
+    listing = mock_supabase.table.return_value.select.return_value.or_.return_value.order.return_value.order.return_value.execute
+    listing.return_value.data = []
+
+    client.get("/api/books", headers=headers)
+    client.get("/api/books", headers=_auth_headers(principal_cache, "u2"))
+    client.get("/api/books", headers=headers)
+    assert listing.call_count == 2
+
+    # Ingestion updating another user's book changes what everyone sees
+    import asyncio
+    from server import books_repo
+    asyncio.run(books_repo.update({"total_pages": 10}, id="b9"))
+    client.get("/api/books", headers=headers)
+    assert listing.call_count == 3
+
+def test_response_cache_skips_results_of_reads_that_raced_a_write():
+    from server import ResponseCache
+    cache = ResponseCache(ttl=60)
+    generation = cache.generation("bookmarks")
+    cache.invalidate("bookmarks", "u1")  # a write lands while the read is in flight
+
+    cache.set("bookmarks", "u1", "b1", (b"[]", '"x"', {}), generation)
+
+    assert cache.get("bookmarks", "u1", "b1") is None
+
+def test_listings_are_encoded_from_validated_rows(mock_supabase, principal_cache):
+    import orjson
+    headers = _auth_headers(principal_cache)
+    listing = mock_supabase.table.return_value.select.return_value.or_.return_value.order.return_value.order.return_value.execute
+    listing.return_value.data = [{
+        "id": "b1", "title": "Iracema", "author": "José de Alencar", "file_url": "h.pdf", "file_format": "pdf",
+        "file_size": 10, "uploaded_by": "u1", "rating": 4, "outline": [{"title": "I", "page": 1}],
+    }]
+
+    with patch("server.orjson.dumps", wraps=orjson.dumps) as dumps:
+        response = client.get("/api/books", headers=headers)
+
+    book = response.json()[0]
+    assert response.headers["content-type"] == "application/json"
+    assert book["author"] == "José de Alencar" and book["rating"] == 4.0
+    assert "outline" not in book  # columns outside the model are still dropped
+    dumps.assert_called_once()